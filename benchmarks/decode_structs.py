@@ -0,0 +1,187 @@
+"""
+Micro-benchmark for the header decoders, per packet decode cost of the
+original read_* stream parsers (format string picked on every call, record
+template rebuilt with ''.join) against the precompiled struct.Struct
+decoders walking a buffer by offset
+
+python -m benchmarks.decode_structs --packets 1000000
+"""
+
+import argparse
+import io
+import struct
+import sys
+import time
+
+from network import ethernet
+from network import ipv4
+from network import pcap
+from network import rtp
+from network import udp
+from h264 import nalu
+
+__author__ = 'wmoorefi'
+
+
+def build_capture(packet_count, byte_order='<'):
+    """
+    Synthetic capture of identical Ethernet/IPv4/UDP/RTP/H.264 packets with
+    incrementing RTP sequence numbers
+    """
+    nal = b'\x65' + b'\x00' * 200
+    chunks = [struct.pack(byte_order + 'IHHiIII', 0xA1B2C3D4, 2, 4, 0, 0, 65535, 1)]
+    for index in range(packet_count):
+        rtp_hdr = struct.pack('>BBHII', 0x80, 96, index & 0xFFFF, index * 3000, 0x1234)
+        udp_hdr = struct.pack('>HHHH', 5000, 20010, 8 + len(rtp_hdr) + len(nal), 0)
+        ip_hdr = struct.pack('>BBHHBBBBHBBBBBBBB', 0x45, 0, 28 + len(rtp_hdr) + len(nal), index & 0xFFFF,
+                             0, 0, 64, ipv4.PROTOCOL_UDP, 0, 10, 0, 0, 1, 10, 0, 0, 2)
+        eth_hdr = b'\x01\x02\x03\x04\x05\x06\x0a\x0b\x0c\x0d\x0e\x0f' + struct.pack('>H', ethernet.ETHERTYPE_IPV4)
+        packet = b''.join([eth_hdr, ip_hdr, udp_hdr, rtp_hdr, nal])
+        chunks.append(struct.pack(byte_order + 'IIII', index // 1000, (index % 1000) * 1000,
+                                  len(packet), len(packet)))
+        chunks.append(packet)
+    return b''.join(chunks)
+
+
+# The decoders below reproduce the original read_* functions: a format
+# string picked per call and one read() per header
+
+
+def _legacy_read_pcap_record(pcap_hdr, input_file):
+    raw_header = input_file.read(16)
+    if len(raw_header) < 16:
+        return
+    if pcap_hdr.byte_swap:
+        unpack_template = ''.join(['>', 'IIII'])
+    else:
+        unpack_template = ''.join(['<', 'IIII'])
+    (ts_sec, ts_usec, incl_len, orig_len) = struct.unpack(unpack_template, raw_header)
+    return pcap.PcapRecordHeader(ts_sec, ts_usec, incl_len, orig_len)
+
+
+def _legacy_read_ethernet_header(input_stream, byte_swap):
+    chunk = input_stream.read(14)
+    if byte_swap:
+        raw_unpacked = struct.unpack('<BBBBBBBBBBBBH', chunk)
+    else:
+        raw_unpacked = struct.unpack('>BBBBBBBBBBBBH', chunk)
+    return ethernet.EthernetHeader(raw_unpacked[:6], raw_unpacked[6:12], raw_unpacked[-1])
+
+
+def _legacy_read_ipv4_header(input_stream, byte_swap):
+    chunk = input_stream.read(20)
+    if byte_swap:
+        raw_unpacked = struct.unpack('<BBHHBBBBHBBBBBBBB', chunk)
+    else:
+        raw_unpacked = struct.unpack('>BBHHBBBBHBBBBBBBB', chunk)
+    return ipv4.Ipv4Header(raw_unpacked[0] >> 4, (raw_unpacked[0] & 0x0F) * 4,
+                           raw_unpacked[1] >> 2, raw_unpacked[1] & 0x03,
+                           raw_unpacked[2], raw_unpacked[3], raw_unpacked[4] >> 5,
+                           ((raw_unpacked[4] & 0x1F) << 8) | raw_unpacked[5],
+                           raw_unpacked[6], raw_unpacked[7], raw_unpacked[8],
+                           raw_unpacked[9:13], raw_unpacked[13:17])
+
+
+def _legacy_read_udp_header(input_stream, byte_swap):
+    chunk = input_stream.read(8)
+    if byte_swap:
+        raw_unpacked = struct.unpack('<HHHH', chunk)
+    else:
+        raw_unpacked = struct.unpack('>HHHH', chunk)
+    return udp.UdpHeader(raw_unpacked[0], raw_unpacked[1], raw_unpacked[2], raw_unpacked[3])
+
+
+def _legacy_read_rtp_header(input_stream, byte_swap):
+    chunk = input_stream.read(12)
+    if byte_swap:
+        raw_unpacked = struct.unpack('<BBHII', chunk)
+    else:
+        raw_unpacked = struct.unpack('>BBHII', chunk)
+    csrc_list = []
+    for i in range(0, raw_unpacked[0] & 0x0F):
+        chunk = input_stream.read(4)
+        if byte_swap:
+            csrc_list.append(struct.unpack('<I', chunk)[0])
+        else:
+            csrc_list.append(struct.unpack('>I', chunk)[0])
+    return rtp.RtpHeader(raw_unpacked[0] >> 6, (raw_unpacked[0] >> 5) & 0x1,
+                         raw_unpacked[1] >> 7, raw_unpacked[1] & 0x7F,
+                         raw_unpacked[2], raw_unpacked[3], raw_unpacked[4],
+                         csrc_list, [])
+
+
+def _legacy_read_nalu_header(input_stream, byte_swap):
+    chunk = input_stream.read(1)
+    if byte_swap:
+        raw_unpacked = struct.unpack('<B', chunk)
+    else:
+        raw_unpacked = struct.unpack('>B', chunk)
+    return nalu.NaluHeader(raw_unpacked[0] & 0x01, (raw_unpacked[0] >> 5) & 0x03, raw_unpacked[0] & 0x1F)
+
+
+def decode_legacy(capture):
+    """
+    Decode every layer the way pcapfile.py did before the precompiled
+    decoders, reading each header from the file object
+    """
+    input_file = io.BytesIO(capture)
+    pcap_hdr = pcap.read_pcap_header(input_file)
+    count = 0
+    while True:
+        record_hdr = _legacy_read_pcap_record(pcap_hdr, input_file)
+        if record_hdr is None:
+            break
+        remaining_bytes = record_hdr.incl_len
+        remaining_bytes -= len(_legacy_read_ethernet_header(input_file, pcap_hdr.byte_swap))
+        remaining_bytes -= len(_legacy_read_ipv4_header(input_file, pcap_hdr.byte_swap))
+        remaining_bytes -= len(_legacy_read_udp_header(input_file, pcap_hdr.byte_swap))
+        remaining_bytes -= len(_legacy_read_rtp_header(input_file, pcap_hdr.byte_swap))
+        remaining_bytes -= len(_legacy_read_nalu_header(input_file, pcap_hdr.byte_swap))
+        input_file.read(remaining_bytes)
+        count += 1
+    return count
+
+
+def decode_structs(capture):
+    """
+    Decode every layer from the capture buffer with the precompiled decoders
+    """
+    view = memoryview(capture)
+    pcap_hdr = pcap.unpack_pcap_header(view)
+    count = 0
+    for record_hdr, packet in pcap.iter_pcap_records(pcap_hdr, view):
+        offset = 0
+        eth_hdr = ethernet.unpack_ethernet_header(packet, offset, pcap_hdr.byte_swap)
+        offset += len(eth_hdr)
+        ipv4_hdr = ipv4.unpack_ipv4_header(packet, offset, pcap_hdr.byte_swap)
+        offset += len(ipv4_hdr)
+        udp_hdr = udp.unpack_udp_header(packet, offset, pcap_hdr.byte_swap)
+        offset += len(udp_hdr)
+        rtp_hdr = rtp.unpack_rtp_header(packet, offset, pcap_hdr.byte_swap)
+        offset += len(rtp_hdr)
+        nalu.unpack_nalu_header(packet, offset, pcap_hdr.byte_swap)
+        count += 1
+    return count
+
+
+def _time(decoder, capture):
+    start = time.perf_counter()
+    count = decoder(capture)
+    return count, time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--packets', type=int, default=1000000)
+    parser.add_argument('--big-endian', action='store_true', help='write the pcap framing big endian')
+    args = parser.parse_args(argv)
+
+    capture = build_capture(args.packets, '>' if args.big_endian else '<')
+
+    for name, decoder in [('legacy', decode_legacy), ('structs', decode_structs)]:
+        count, elapsed = _time(decoder, capture)
+        print('%-8s %9d packets %8.3f s %8.0f ns/packet' % (name, count, elapsed, elapsed * 1e9 / count))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
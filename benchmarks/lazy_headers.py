@@ -0,0 +1,121 @@
+"""
+Micro-benchmark for the lazy header views on a filter-heavy workload, every
+packet is tested on ethertype, protocol, destination port and ssrc and only
+the matching ones have their remaining fields read. Compares the eager
+unpack_* decoders against the view_* decoders.
+
+python -m benchmarks.lazy_headers --packets 1000000 --match-every 100
+python -m benchmarks.lazy_headers --packets 1000000 --match-every 1
+"""
+
+import argparse
+import sys
+import time
+
+from benchmarks.decode_structs import build_capture
+from network import ethernet
+from network import ipv4
+from network import pcap
+from network import rtp
+from network import udp
+
+__author__ = 'wmoorefi'
+
+_MATCH_SSRC = 0x1234
+
+
+def _read_all(eth_hdr, ipv4_hdr, rtp_hdr):
+    # what a consumer of a matching packet looks at
+    return (eth_hdr.source_mac, eth_hdr.destination_mac,
+            ipv4_hdr.source_ip, ipv4_hdr.destination_ip, ipv4_hdr.time_to_live,
+            rtp_hdr.sequence_number, rtp_hdr.timestamp, rtp_hdr.marker_bit)
+
+
+def filter_eager(capture):
+    view = memoryview(capture)
+    pcap_hdr = pcap.unpack_pcap_header(view)
+    matched = 0
+    for record_hdr, packet in pcap.iter_pcap_records(pcap_hdr, view):
+        eth_hdr = ethernet.unpack_ethernet_header(packet, 0, pcap_hdr.byte_swap)
+        if eth_hdr.payload_ethertype != ethernet.ETHERTYPE_IPV4:
+            continue
+        offset = len(eth_hdr)
+        ipv4_hdr = ipv4.unpack_ipv4_header(packet, offset, pcap_hdr.byte_swap)
+        if ipv4_hdr.protocol != ipv4.PROTOCOL_UDP:
+            continue
+        offset += len(ipv4_hdr)
+        udp_hdr = udp.unpack_udp_header(packet, offset, pcap_hdr.byte_swap)
+        if udp_hdr.destination_port != 20010:
+            continue
+        rtp_hdr = rtp.unpack_rtp_header(packet, offset + 8, pcap_hdr.byte_swap)
+        if rtp_hdr.ssrc != _MATCH_SSRC:
+            continue
+        _read_all(eth_hdr, ipv4_hdr, rtp_hdr)
+        matched += 1
+    return matched
+
+
+def filter_lazy(capture):
+    view = memoryview(capture)
+    pcap_hdr = pcap.unpack_pcap_header(view)
+    matched = 0
+    for record_hdr, packet in pcap.iter_pcap_records(pcap_hdr, view):
+        eth_hdr = ethernet.view_ethernet_header(packet, 0)
+        if eth_hdr.payload_ethertype != ethernet.ETHERTYPE_IPV4:
+            continue
+        offset = len(eth_hdr)
+        ipv4_hdr = ipv4.view_ipv4_header(packet, offset)
+        if ipv4_hdr.protocol != ipv4.PROTOCOL_UDP:
+            continue
+        offset += len(ipv4_hdr)
+        udp_hdr = udp.unpack_udp_header(packet, offset, pcap_hdr.byte_swap)
+        if udp_hdr.destination_port != 20010:
+            continue
+        rtp_hdr = rtp.view_rtp_header(packet, offset + 8)
+        if rtp_hdr.ssrc != _MATCH_SSRC:
+            continue
+        # every field of a kept packet is read, decoded eagerly
+        _read_all(eth_hdr.unpack(), ipv4_hdr.unpack(), rtp_hdr.unpack())
+        matched += 1
+    return matched
+
+
+def build_filter_capture(packet_count, match_every):
+    """
+    Synthetic capture where one packet in match_every carries the matching
+    ssrc, the others differ only in the ssrc
+    """
+    capture = bytearray(build_capture(packet_count))
+    unpack_record = pcap.record_header_struct(pcap.unpack_pcap_header(capture)).unpack_from
+    offset = pcap.PCAP_HDR_LENGTH
+    for index in range(packet_count):
+        incl_len = unpack_record(capture, offset)[2]
+        if index % match_every:
+            # ssrc sits at 14 + 20 + 8 + 8 into the packet
+            capture[offset + 16 + 50:offset + 16 + 54] = b'\x00\x00\x43\x21'
+        offset += 16 + incl_len
+    return bytes(capture)
+
+
+def _time(decoder, capture):
+    start = time.perf_counter()
+    matched = decoder(capture)
+    return matched, time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--packets', type=int, default=1000000)
+    parser.add_argument('--match-every', type=int, default=100, help='one packet in N passes the filter')
+    args = parser.parse_args(argv)
+
+    capture = build_filter_capture(args.packets, args.match_every)
+
+    for name, decoder in [('eager', filter_eager), ('lazy', filter_lazy)]:
+        matched, elapsed = _time(decoder, capture)
+        print('%-6s %9d packets %8d matched %8.3f s %8.0f ns/packet' % (
+            name, args.packets, matched, elapsed, elapsed * 1e9 / args.packets))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,211 @@
+"""
+Benchmark harness for the decode pipeline, reports packets/s, bytes/s,
+peak RSS and the time spent in each read_* header decoder as JSON
+
+A synthetic capture (see benchmarks.synthetic) is written to a temporary
+file, or an existing capture is used, then decoded three times: through
+the read_* stream decoders, through the same decoders with every call
+timed to split the cost per layer, and through the memory-mapped unpack_*
+decoders. The timed pass is only used for the per layer figures, timing
+each call adds its own overhead.
+
+python -m benchmarks.pipeline --packets 200000 --flows 8 --vlan-tags 1 --output run.json
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+
+from benchmarks import synthetic
+from h264 import nalu
+from network import ethernet
+from network import ipv4
+from network import pcap
+from network import rtp
+from network import udp
+
+__author__ = 'wmoorefi'
+
+LAYERS = ['read_pcap_record', 'read_ethernet_header', 'read_ipv4_header',
+          'read_udp_header', 'read_rtp_header', 'read_nalu_header']
+
+_DECODERS = [pcap.read_pcap_record, ethernet.read_ethernet_header, ipv4.read_ipv4_header,
+             udp.read_udp_header, rtp.read_rtp_header, nalu.read_nalu_header]
+
+
+def _timed(function, index, totals, calls):
+    perf_counter = time.perf_counter
+
+    def timed(*args):
+        start = perf_counter()
+        result = function(*args)
+        totals[index] += perf_counter() - start
+        calls[index] += 1
+        return result
+
+    return timed
+
+
+def decode_stream(input_file, decoders=_DECODERS):
+    """
+    Decode every record of a pcap stream layer by layer with the read_*
+    decoders, returns (packets, bytes). The headers are read from a stream
+    over the incl_len bytes of the record, so a truncated or malformed
+    packet cannot make a decoder read into the next record, and the layer
+    chain stops at the first header that does not fit.
+    """
+    (read_record, read_ethernet, read_ipv4, read_udp, read_rtp, read_nalu) = decoders
+    pcap_hdr = pcap.read_pcap_header(input_file)
+    byte_swap = pcap_hdr.byte_swap
+    packets = 0
+    total_bytes = 0
+
+    while True:
+        record_hdr = read_record(pcap_hdr, input_file)
+        if record_hdr is None:
+            break
+        packets += 1
+        total_bytes += record_hdr.incl_len
+        packet = io.BytesIO(input_file.read(record_hdr.incl_len))
+
+        eth_hdr = read_ethernet(packet, byte_swap)
+        if eth_hdr is None or eth_hdr.payload_ethertype != ethernet.ETHERTYPE_IPV4:
+            continue
+        ipv4_hdr = read_ipv4(packet, byte_swap)
+        # later fragments carry no udp header
+        if ipv4_hdr is None or ipv4_hdr.protocol != ipv4.PROTOCOL_UDP or ipv4_hdr.fragment_offset:
+            continue
+        if read_udp(packet, byte_swap) is None:
+            continue
+        if read_rtp(packet, byte_swap) is None:
+            continue
+        read_nalu(packet, byte_swap)
+
+    return packets, total_bytes
+
+
+def decode_mapped(input_file):
+    """
+    Decode every record of a memory-mapped capture with the unpack_*
+    decoders, returns (packets, bytes)
+    """
+    packets = 0
+    total_bytes = 0
+    with pcap.MappedPcapFile(input_file) as capture:
+        byte_swap = capture.header.byte_swap
+        for record_hdr, packet in capture.records():
+            packets += 1
+            total_bytes += record_hdr.incl_len
+            eth_hdr = ethernet.unpack_ethernet_header(packet, 0, byte_swap)
+            if eth_hdr is None or eth_hdr.payload_ethertype != ethernet.ETHERTYPE_IPV4:
+                continue
+            offset = len(eth_hdr)
+            ipv4_hdr = ipv4.unpack_ipv4_header(packet, offset, byte_swap)
+            if ipv4_hdr is None or ipv4_hdr.protocol != ipv4.PROTOCOL_UDP or ipv4_hdr.fragment_offset:
+                continue
+            offset += len(ipv4_hdr)
+            udp_hdr = udp.unpack_udp_header(packet, offset, byte_swap)
+            if udp_hdr is None:
+                continue
+            offset += len(udp_hdr)
+            rtp_hdr = rtp.unpack_rtp_header(packet, offset, byte_swap)
+            if rtp_hdr is None:
+                continue
+            nalu.unpack_nalu_header(packet, offset + len(rtp_hdr), byte_swap)
+    return packets, total_bytes
+
+
+def _throughput(decoder, path):
+    with open(path, 'rb') as input_file:
+        start = time.perf_counter()
+        (packets, total_bytes) = decoder(input_file)
+        elapsed = time.perf_counter() - start
+    return {
+        'packets': packets,
+        'bytes': total_bytes,
+        'seconds': elapsed,
+        'packets_per_second': packets / elapsed if elapsed else None,
+        'bytes_per_second': total_bytes / elapsed if elapsed else None,
+    }
+
+
+def _layer_times(path):
+    totals = [0.0] * len(_DECODERS)
+    calls = [0] * len(_DECODERS)
+    decoders = [_timed(function, index, totals, calls) for index, function in enumerate(_DECODERS)]
+    with open(path, 'rb') as input_file:
+        decode_stream(input_file, decoders)
+
+    layers = {}
+    for index, name in enumerate(LAYERS):
+        layers[name] = {
+            'calls': calls[index],
+            'seconds': totals[index],
+            'ns_per_call': totals[index] * 1e9 / calls[index] if calls[index] else None,
+        }
+    return layers
+
+
+def peak_rss_bytes():
+    """
+    Peak resident set size of this process
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def run(path, config=None):
+    """
+    Benchmark the capture at path, returns the results as a dict
+    """
+    return {
+        'capture': {
+            'path': path,
+            'size': os.path.getsize(path),
+            'synthetic': config.to_dict() if config is not None else None,
+        },
+        'python': platform.python_version(),
+        'stream': _throughput(decode_stream, path),
+        'mapped': _throughput(decode_mapped, path),
+        'layers': _layer_times(path),
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--capture', help='benchmark this capture instead of a synthetic one')
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    synthetic.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    if args.capture:
+        results = run(args.capture)
+    else:
+        config = synthetic.config_from_arguments(args)
+        (handle, path) = tempfile.mkstemp(suffix='.pcap')
+        try:
+            with os.fdopen(handle, 'wb') as output_file:
+                synthetic.write_capture(output_file, config)
+            results = run(path, config)
+        finally:
+            os.remove(path)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
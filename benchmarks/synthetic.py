@@ -0,0 +1,230 @@
+"""
+Synthetic capture generator, Ethernet (optionally VLAN tagged) / IPv4 / UDP
+/ RTP / H.264 traffic of a number of interleaved flows
+
+Each flow carries one H.264 stream, an IDR frame every gop_length frames
+and non-IDR slices in between, every frame a single NAL unit of
+frame_size bytes sent as one RTP packet or split in FU-A fragments of at
+most rtp_payload_max bytes. Datagrams larger than ip_mtu are sent as IPv4
+fragments.
+
+with open('synthetic.pcap', 'wb') as fp:
+    write_capture(fp, SyntheticConfig(packets=100000, flows=8, vlan_tags=1))
+
+python -m benchmarks.synthetic synthetic.pcap --packets 100000 --flows 8
+"""
+
+import argparse
+import struct
+import sys
+
+from h264 import nalu
+from network import checksum
+from network import ethernet
+from network import ipv4
+from network import pcap
+
+__author__ = 'wmoorefi'
+
+_ETHERNET_MACS = b'\x00\x11\x22\x33\x44\x55\x00\x66\x77\x88\x99\xaa'
+_ETHERTYPE = struct.Struct('>H')
+# tag protocol id and tag control information
+_VLAN_TAG = struct.Struct('>HH')
+_IPV4_HDR = struct.Struct('>BBHHHBBHII')
+_UDP_HDR = struct.Struct('>HHHH')
+_RTP_HDR = struct.Struct('>BBHII')
+_FU_HDR = struct.Struct('>BB')
+
+# flows are sent from consecutive addresses to a single destination
+_SOURCE_IP = 0x0A000001
+_DESTINATION_IP = 0x0A010001
+
+_RTP_PAYLOAD_TYPE = 96
+_VIDEO_CLOCK_RATE = 90000
+
+
+class SyntheticConfig(object):
+    """
+    Parameters of a synthetic capture, frame_size is the size of every NAL
+    unit, frame_rate the frames per second of every flow
+    """
+    __slots__ = ['packets', 'flows', 'frame_size', 'frame_rate', 'gop_length', 'rtp_payload_max',
+                 'ip_mtu', 'vlan_tags', 'byte_order', 'timestamp_in_ns', 'base_port', 'start_time']
+
+    def __init__(self, packets=10000, flows=1, frame_size=1000, frame_rate=30, gop_length=30,
+                 rtp_payload_max=1400, ip_mtu=None, vlan_tags=0, byte_order='<',
+                 timestamp_in_ns=False, base_port=20000, start_time=1440000000):
+        self.packets = packets
+        self.flows = flows
+        self.frame_size = frame_size
+        self.frame_rate = frame_rate
+        self.gop_length = gop_length
+        self.rtp_payload_max = rtp_payload_max
+        self.ip_mtu = ip_mtu
+        self.vlan_tags = vlan_tags
+        self.byte_order = byte_order
+        self.timestamp_in_ns = timestamp_in_ns
+        self.base_port = base_port
+        self.start_time = start_time
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+def _link_header(config, flow_index):
+    # outer tags are service tags, the innermost one carries the flow vlan
+    chunks = [_ETHERNET_MACS]
+    for tag_index in range(config.vlan_tags):
+        if tag_index == config.vlan_tags - 1:
+            chunks.append(_VLAN_TAG.pack(ethernet.ETHERTYPE_8021Q, 100 + flow_index))
+        else:
+            chunks.append(_VLAN_TAG.pack(ethernet.ETHERTYPE_8021AD, 10))
+    chunks.append(_ETHERTYPE.pack(ethernet.ETHERTYPE_IPV4))
+    return b''.join(chunks)
+
+
+def _ip_packets(config, flow_index, identification, datagram):
+    """
+    IPv4 packets carrying datagram, fragmented to ip_mtu when set
+    """
+    source_ip = _SOURCE_IP + flow_index
+    destination_ip = _DESTINATION_IP
+    max_payload = len(datagram)
+    if config.ip_mtu is not None and 20 + len(datagram) > config.ip_mtu:
+        max_payload = (config.ip_mtu - 20) & ~7
+
+    packets = []
+    for start in range(0, len(datagram), max_payload):
+        chunk = datagram[start:start + max_payload]
+        more_fragments = 0x2000 if start + max_payload < len(datagram) else 0
+        header = bytearray(_IPV4_HDR.pack(0x45, 0, 20 + len(chunk), identification & 0xFFFF,
+                                          more_fragments | (start // 8), 64, ipv4.PROTOCOL_UDP, 0,
+                                          source_ip, destination_ip))
+        struct.pack_into('>H', header, 10, checksum.ipv4_header_checksum(header, 0, 20))
+        packets.append(bytes(header) + chunk)
+    return packets
+
+
+def _rtp_payloads(config, frame_index):
+    """
+    RTP payloads of one frame, a single NAL unit packet or FU-A fragments
+    """
+    if frame_index % config.gop_length == 0:
+        nal_header = (3 << 5) | nalu.NALUTYPE_SLICE_IDR
+    else:
+        nal_header = (2 << 5) | nalu.NALUTYPE_SLICE_NONIDR
+    body = bytes(bytearray((frame_index + offset) & 0xFF for offset in range(config.frame_size - 1)))
+
+    if config.frame_size <= config.rtp_payload_max:
+        return [struct.pack('>B', nal_header) + body]
+
+    fu_indicator = (nal_header & 0xE0) | nalu.NALUTYPE_FUA
+    step = config.rtp_payload_max - _FU_HDR.size
+    payloads = []
+    for start in range(0, len(body), step):
+        fu_header = nal_header & 0x1F
+        if start == 0:
+            fu_header |= 0x80
+        if start + step >= len(body):
+            fu_header |= 0x40
+        payloads.append(_FU_HDR.pack(fu_indicator, fu_header) + body[start:start + step])
+    return payloads
+
+
+def generate(config):
+    """
+    Yields (PcapRecordHeader, packet bytes) of the synthetic capture, the
+    flows send their frames in turn
+    """
+    links = [_link_header(config, flow_index) for flow_index in range(config.flows)]
+    sequence_numbers = [0] * config.flows
+    identification = 0
+    frame_index = 0
+    fraction_per_second = 1000000000 if config.timestamp_in_ns else 1000000
+    frame_interval = fraction_per_second // config.frame_rate
+    count = 0
+
+    while True:
+        frame_time = frame_index * frame_interval
+        rtp_timestamp = (frame_index * _VIDEO_CLOCK_RATE // config.frame_rate) & 0xFFFFFFFF
+        payloads = _rtp_payloads(config, frame_index)
+        for flow_index in range(config.flows):
+            for payload_index, payload in enumerate(payloads):
+                marker = 0x80 if payload_index == len(payloads) - 1 else 0
+                rtp_hdr = _RTP_HDR.pack(0x80, marker | _RTP_PAYLOAD_TYPE, sequence_numbers[flow_index],
+                                        rtp_timestamp, 0x10000 + flow_index)
+                sequence_numbers[flow_index] = (sequence_numbers[flow_index] + 1) & 0xFFFF
+                port = config.base_port + 2 * flow_index
+                datagram = bytearray(_UDP_HDR.pack(port, port, 8 + len(rtp_hdr) + len(payload), 0))
+                datagram += rtp_hdr + payload
+                struct.pack_into('>H', datagram, 6, checksum.udp_checksum(datagram, 0, len(datagram),
+                                                                          _SOURCE_IP + flow_index, _DESTINATION_IP))
+                datagram = bytes(datagram)
+
+                identification += 1
+                for ip_packet in _ip_packets(config, flow_index, identification, datagram):
+                    packet = links[flow_index] + ip_packet
+                    # spread the packets of a frame over its interval
+                    offset = frame_time + (flow_index * len(payloads) + payload_index)
+                    (ts_sec, ts_fraction) = divmod(offset, fraction_per_second)
+                    yield pcap.PcapRecordHeader(config.start_time + ts_sec, ts_fraction,
+                                                len(packet), len(packet)), packet
+                    count += 1
+                    if count >= config.packets:
+                        return
+        frame_index += 1
+
+
+def capture_header(config):
+    """
+    PcapHeader of the synthetic capture in the configured byte order
+    """
+    pcap_hdr = pcap.new_pcap_header(pcap.LINKTYPE_ETHERNET, 65535, config.timestamp_in_ns)
+    byte_swap = (config.byte_order == '<') != (sys.byteorder == 'little')
+    return pcap.PcapHeader(pcap_hdr.magic_number, pcap_hdr.version_major, pcap_hdr.version_minor,
+                           pcap_hdr.thiszone, pcap_hdr.sigfigs, pcap_hdr.snaplen, pcap_hdr.network,
+                           byte_swap, pcap_hdr.timestamp_in_ns)
+
+
+def write_capture(output_file, config):
+    """
+    Write the synthetic capture to stream, returns the number of records
+    """
+    with pcap.PcapWriter(output_file, capture_header(config)) as writer:
+        for record_hdr, packet in generate(config):
+            writer.write_record(record_hdr, packet)
+    return writer.records
+
+
+def add_arguments(parser):
+    parser.add_argument('--packets', type=int, default=100000)
+    parser.add_argument('--flows', type=int, default=4)
+    parser.add_argument('--frame-size', type=int, default=1000, help='bytes per NAL unit')
+    parser.add_argument('--gop-length', type=int, default=30)
+    parser.add_argument('--rtp-payload-max', type=int, default=1400, help='FU-A fragment above this size')
+    parser.add_argument('--ip-mtu', type=int, help='IPv4 fragment datagrams above this size')
+    parser.add_argument('--vlan-tags', type=int, default=0, choices=[0, 1, 2])
+    parser.add_argument('--big-endian', action='store_true', help='write the pcap framing big endian')
+    parser.add_argument('--ns', action='store_true', help='nanosecond timestamps')
+
+
+def config_from_arguments(args):
+    return SyntheticConfig(packets=args.packets, flows=args.flows, frame_size=args.frame_size,
+                           gop_length=args.gop_length, rtp_payload_max=args.rtp_payload_max,
+                           ip_mtu=args.ip_mtu, vlan_tags=args.vlan_tags,
+                           byte_order='>' if args.big_endian else '<', timestamp_in_ns=args.ns)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('output')
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    with open(args.output, 'wb') as output_file:
+        write_capture(output_file, config_from_arguments(args))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,311 @@
+"""
+On-disk cache of capture.columns decodes, kept as raw column files that are
+memory-mapped back, so repeated analyses of a capture skip decoding it
+
+Every capture gets a directory named after a hash of its first HEAD_BYTES
+bytes, holding one file per CaptureColumns array in native byte order and
+a meta.json with the number of packets, the dtypes and the end of the last
+decoded record. A cached decode is only used when a fingerprint of the
+capture up to that end still matches, the last TAIL_BYTES plus SAMPLES
+blocks spread over the rest, so a capture that was rewritten is decoded
+again while a capture that grew since, a capture still being written, only
+has its new records decoded and appended. The whole capture is not hashed
+to keep a lookup in milliseconds, an in place edit that misses every
+sampled block goes unnoticed.
+
+When the cache grows beyond max_bytes the least recently used captures
+are removed.
+
+cache = ColumnCache('/var/cache/columns', max_bytes=16 << 30)
+with open('test.pcap', 'rb') as fp:
+    columns = cache.load(fp)
+    rtp = columns.rtp[columns.has_rtp]
+
+python -m capture.cache /var/cache/columns test.pcap other.pcap
+"""
+
+import argparse
+import errno
+import hashlib
+import json
+import logging
+import mmap
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+
+from capture import columns as capture_columns
+from network import pcap
+
+__author__ = 'wmoorefi'
+
+# bumped whenever decode_columns changes what it stores, older entries are
+# rebuilt
+FORMAT_VERSION = 2
+
+# bytes hashed at the start of a capture for the cache key
+HEAD_BYTES = 64 * 1024
+
+# fingerprint of the decoded part of a capture, its last TAIL_BYTES and
+# SAMPLES blocks of SAMPLE_BYTES evenly spread before them
+TAIL_BYTES = 64 * 1024
+SAMPLES = 16
+SAMPLE_BYTES = 4096
+
+# (CaptureColumns attribute, dtype) of every column file
+COLUMNS = [
+    ('record', capture_columns.RECORD_DTYPE),
+    ('ethernet', capture_columns.ETHERNET_DTYPE),
+    ('ipv4', capture_columns.IPV4_DTYPE),
+    ('udp', capture_columns.UDP_DTYPE),
+    ('rtp', capture_columns.RTP_DTYPE),
+    ('nalu', capture_columns.NALU_DTYPE),
+    ('has_ethernet', np.dtype(bool)),
+    ('has_ipv4', np.dtype(bool)),
+    ('has_udp', np.dtype(bool)),
+    ('has_rtp', np.dtype(bool)),
+    ('has_nalu', np.dtype(bool)),
+]
+
+_META = 'meta.json'
+
+_module_logger = logging.getLogger(__name__)
+
+
+def _hash_range(input_file, start, end):
+    input_file.seek(start)
+    return hashlib.sha256(input_file.read(end - start)).hexdigest()
+
+
+def _fingerprint(input_file, end):
+    digest = hashlib.sha256()
+    tail = max(0, end - TAIL_BYTES)
+    if tail > SAMPLE_BYTES:
+        for position in np.linspace(0, tail - SAMPLE_BYTES, SAMPLES).astype(np.int64).tolist():
+            input_file.seek(position)
+            digest.update(input_file.read(SAMPLE_BYTES))
+    input_file.seek(tail)
+    digest.update(input_file.read(end - tail))
+    return digest.hexdigest()
+
+
+def _dtype_descriptions():
+    return dict((name, str(dtype.descr)) for (name, dtype) in COLUMNS)
+
+
+def _directory_size(path):
+    total = 0
+    for name in os.listdir(path):
+        total += os.path.getsize(os.path.join(path, name))
+    return total
+
+
+class ColumnCache(object):
+    """
+    Cache of decoded captures under directory, at most max_bytes of column
+    files are kept. chunk_records packets are decoded at a time.
+    """
+    __slots__ = ['directory', 'max_bytes', 'chunk_records']
+
+    def __init__(self, directory, max_bytes=4 << 30, chunk_records=1 << 20):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.chunk_records = chunk_records
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, input_file):
+        """
+        Cache key of the capture open in input_file
+        """
+        size = os.fstat(input_file.fileno()).st_size
+        return _hash_range(input_file, 0, min(size, HEAD_BYTES))
+
+    def _read_meta(self, path):
+        try:
+            with open(os.path.join(path, _META)) as meta_file:
+                meta = json.load(meta_file)
+        except (IOError, OSError, ValueError):
+            return
+        if (meta.get('format') != FORMAT_VERSION or meta.get('byteorder') != sys.byteorder or
+                meta.get('dtypes') != _dtype_descriptions()):
+            return
+        return meta
+
+    def _write_meta(self, path, meta):
+        temporary = os.path.join(path, _META + '.tmp')
+        with open(temporary, 'w') as meta_file:
+            json.dump(meta, meta_file, indent=2, sort_keys=True)
+        os.rename(temporary, os.path.join(path, _META))
+
+    def _append(self, path, input_file, meta):
+        """
+        Decode the records of input_file from meta['end'] on and append them
+        to the column files at path, updates meta in place
+        """
+        column_files = []
+        try:
+            for (name, dtype) in COLUMNS:
+                column_file = open(os.path.join(path, name), 'r+b' if meta['packets'] else 'wb')
+                # drop what an interrupted append left past the last packet
+                column_file.truncate(meta['packets'] * dtype.itemsize)
+                column_file.seek(0, os.SEEK_END)
+                column_files.append(column_file)
+
+            mapped = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                chunks = capture_columns.iter_columns(mapped, self.chunk_records, 0, meta['end'])
+                try:
+                    for columns in chunks:
+                        for (name, _), column_file in zip(COLUMNS, column_files):
+                            column_file.write(getattr(columns, name).tobytes())
+                        meta['packets'] += len(columns)
+                        meta['end'] = int(columns.record['offset'][-1]) + int(columns.record['incl_len'][-1])
+                finally:
+                    # releases its view of the map
+                    chunks.close()
+            finally:
+                mapped.close()
+        finally:
+            for column_file in column_files:
+                column_file.close()
+
+        meta['fingerprint'] = _fingerprint(input_file, meta['end'])
+
+    def _open(self, path, pcap_hdr, meta):
+        arrays = []
+        for (name, dtype) in COLUMNS:
+            if meta['packets']:
+                arrays.append(np.memmap(os.path.join(path, name), dtype=dtype, mode='r',
+                                        shape=(meta['packets'],)))
+            else:
+                arrays.append(np.zeros(0, dtype=dtype))
+        return capture_columns.CaptureColumns(pcap_hdr, *arrays)
+
+    def load(self, input_file):
+        """
+        CaptureColumns of the pcap capture open in input_file, arrays are
+        read-only memory maps of the cache. Decodes the capture or the
+        records it gained since it was cached when needed.
+        """
+        size = os.fstat(input_file.fileno()).st_size
+        key = self.key(input_file)
+        input_file.seek(0)
+        pcap_hdr = pcap.unpack_pcap_header(input_file.read(pcap.PCAP_HDR_LENGTH))
+        path = os.path.join(self.directory, key)
+
+        meta = self._read_meta(path)
+        if meta is not None:
+            end = meta['end']
+            if end > size or _fingerprint(input_file, end) != meta['fingerprint']:
+                _module_logger.info('%s: capture changed, decoding again', key)
+                meta = None
+            elif size - end >= pcap.PCAPREC_HDR_LENGTH:
+                _module_logger.info('%s: decoding %d new bytes', key, size - end)
+                self._append(path, input_file, meta)
+        elif os.path.isdir(path):
+            _module_logger.info('%s: unreadable cache entry, decoding again', key)
+
+        if meta is None:
+            meta = self._build(path, input_file)
+
+        meta['last_used'] = time.time()
+        self._write_meta(path, meta)
+        self.evict(keep=key)
+        return self._open(path, pcap_hdr, meta)
+
+    def _build(self, path, input_file):
+        """
+        Decode the whole capture into a new entry at path
+        """
+        meta = {
+            'format': FORMAT_VERSION,
+            'byteorder': sys.byteorder,
+            'dtypes': _dtype_descriptions(),
+            'packets': 0,
+            'end': pcap.PCAP_HDR_LENGTH,
+            'created': time.time(),
+        }
+        temporary = '%s.tmp-%d' % (path, os.getpid())
+        shutil.rmtree(temporary, ignore_errors=True)
+        os.makedirs(temporary)
+        try:
+            self._append(temporary, input_file, meta)
+            self._write_meta(temporary, meta)
+            shutil.rmtree(path, ignore_errors=True)
+            os.rename(temporary, path)
+        except Exception:
+            shutil.rmtree(temporary, ignore_errors=True)
+            raise
+        return meta
+
+    def entries(self):
+        """
+        (key, size in bytes, last used) of every cached capture, least
+        recently used first
+        """
+        entries = []
+        for key in os.listdir(self.directory):
+            path = os.path.join(self.directory, key)
+            if '.tmp-' in key or not os.path.isdir(path):
+                continue
+            meta = self._read_meta(path)
+            try:
+                entries.append((key, _directory_size(path), meta['last_used'] if meta else 0))
+            except OSError as error:
+                # removed by another process meanwhile
+                if error.errno != errno.ENOENT:
+                    raise
+        entries.sort(key=lambda entry: entry[2])
+        return entries
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used captures until the cache fits in
+        max_bytes, the capture keyed keep is never removed. Returns the keys
+        removed.
+        """
+        entries = self.entries()
+        total = sum([entry[1] for entry in entries])
+        removed = []
+        for (key, size, _) in entries:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+            total -= size
+            removed.append(key)
+            _module_logger.info('%s: evicted, %d bytes', key, size)
+        return removed
+
+    def clear(self):
+        for (key, _, _) in self.entries():
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('directory', help='cache directory')
+    parser.add_argument('captures', nargs='*', help='pcap captures to decode into the cache')
+    parser.add_argument('--max-bytes', type=int, default=4 << 30, help='disk budget of the cache')
+    parser.add_argument('--list', action='store_true', help='list the cached captures')
+    args = parser.parse_args(argv)
+
+    cache = ColumnCache(args.directory, args.max_bytes)
+    for path in args.captures:
+        start = time.time()
+        with open(path, 'rb') as input_file:
+            count = len(cache.load(input_file))
+        sys.stdout.write('%s: %d packets in %.3f s\n' % (path, count, time.time() - start))
+    if args.list:
+        for (key, size, last_used) in cache.entries():
+            sys.stdout.write('%s %12d %s\n' % (key, size, time.ctime(last_used)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
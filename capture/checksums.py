@@ -0,0 +1,331 @@
+"""
+Batch verification of IPv4 header and UDP checksums with NumPy
+
+The one's complement sum of every header or datagram is computed for all
+packets of a batch at once over the capture bytes viewed as uint32 lanes,
+see word_sums(). No packet is copied. Packets are located with the
+columns of capture.columns.
+
+with open('test.pcap', 'rb') as fp:
+    counters = verify_file(fp)
+print(counters.ipv4_errors, counters.udp_errors)
+for key, (ipv4_errors, udp_errors) in counters.flows.items():
+    ...
+
+Flow keys are (source_ip, destination_ip, protocol, source_port,
+destination_port) as in network.flow. UDP datagrams without a checksum,
+fragmented or cut short by the capture snaplen are counted in udp_skipped,
+see network.checksum to verify single packets.
+
+python -m capture.checksums test.pcap
+"""
+
+import json
+import mmap
+import sys
+
+import numpy as np
+
+from capture import columns as capture_columns
+from network import checksum
+from network import ipv4
+
+__author__ = 'wmoorefi'
+
+_ETHERNET_HDR_LENGTH = 14
+_VLAN_TAG_LENGTH = 4
+
+# uint32 lanes widened at a time to sum datagrams, small enough to stay in
+# cache
+BLOCK_LANES = 1 << 18
+
+
+def _range_sums(values, first, last):
+    """
+    Sum of values[first:last] for every pair of first and last
+    """
+    sums = np.zeros(len(first), dtype=values.dtype)
+    nonempty = last > first
+    first = first[nonempty]
+    last = last[nonempty]
+    if not len(first):
+        return sums
+
+    # reduceat sums between consecutive indices, every other result is a
+    # range. An index must be inside values so a range ending at the end of
+    # values stops one short and gets its last value added back.
+    at_end = last >= len(values)
+    indices = np.empty(2 * len(first), dtype=np.int64)
+    indices[0::2] = first
+    indices[1::2] = np.where(at_end, len(values) - 1, last)
+    result = np.add.reduceat(values, indices)[0::2]
+    # a single value range at the very end is already complete
+    result += np.where(at_end & (first < len(values) - 1), values[-1], 0).astype(sums.dtype)
+    sums[nonempty] = result
+    return sums
+
+
+def _lane_range_sums(lanes, first, last, block_lanes=BLOCK_LANES):
+    """
+    Sum of lanes[first:last] for every pair of first and last as uint64,
+    the ranges in increasing order and not overlapping. The lanes are
+    widened to uint64 a block at a time and summed in their own dtype, a
+    reduceat that casts every range on its own is several times slower.
+    """
+    sums = np.zeros(len(first), dtype=np.uint64)
+    group_start = 0
+    while group_start < len(first):
+        span_start = int(first[group_start])
+        # the ranges ending within the block, at least one
+        group_end = max(group_start + 1, int(np.searchsorted(last, span_start + block_lanes, 'right')))
+        span_end = int(last[group_end - 1])
+        block = lanes[span_start:span_end].astype(np.uint64)
+        sums[group_start:group_end] = _range_sums(block, first[group_start:group_end] - span_start,
+                                                  last[group_start:group_end] - span_start)
+        group_start = group_end
+    return sums
+
+
+def lane_view(buffer):
+    """
+    buffer viewed as little endian uint32 lanes for word_sums(), the up to 3
+    bytes past the last whole lane are left out
+    """
+    return np.frombuffer(buffer, dtype='<u4', count=len(buffer) // 4)
+
+
+def _partial_lanes(lanes, starts, ends):
+    """
+    Sum of the first and last lanes of every range, masked to the bytes
+    inside the range, and the lanes in between as (first, last)
+    """
+    head_lane = starts >> 2
+    tail_lane = ends >> 2
+    head_shift = ((starts & 3) * 8).astype(np.uint64)
+    head = (lanes[head_lane].astype(np.uint64) >> head_shift) << head_shift
+    tail_mask = (np.uint64(1) << ((ends & 3) * 8).astype(np.uint64)) - np.uint64(1)
+    single = head_lane == tail_lane
+    head = np.where(single, head & tail_mask, head)
+    has_tail = ~single & ((ends & 3) != 0)
+    tail = np.where(has_tail, lanes[np.where(has_tail, tail_lane, 0)] & tail_mask, np.uint64(0))
+    middle_first = head_lane + 1
+    return head + tail, middle_first, np.maximum(tail_lane, middle_first)
+
+
+def word_sums(lanes, starts, ends):
+    """
+    Unfolded sums of the bytes [start, end) of the buffer of lane_view()
+    for every pair of start and end, taken as little endian 16 bit words at
+    the even positions of the buffer. The ranges must end within the lanes,
+    be in increasing order and not overlap, as the datagrams of consecutive
+    records.
+
+    A 32 bit lane weighs the same as its two words modulo 0xFFFF, so the
+    lanes in the middle of a range are summed with a single reduceat over
+    all ranges and only the partial lanes at either end are masked.
+
+    One's complement sums do not depend on the byte order of their words
+    beyond a byte swap (RFC 1071), modulo 0xFFFF the sum of the big endian
+    words of a range is the returned sum times 256 for a range starting at
+    an even position and the returned sum as is for an odd one.
+    """
+    (sums, middle_first, middle_last) = _partial_lanes(lanes, starts, ends)
+    return sums + _lane_range_sums(lanes, middle_first, middle_last)
+
+
+def header_sums(lanes, starts, ends):
+    """
+    word_sums() of short ranges such as ip headers, the middle lanes are
+    gathered a lane of every range at a time instead of a reduceat over the
+    whole buffer
+    """
+    (sums, middle_first, middle_last) = _partial_lanes(lanes, starts, ends)
+    counts = middle_last - middle_first
+    shortest = int(counts.min())
+    for index in range(int(counts.max())):
+        position = middle_first + index
+        if index < shortest:
+            sums += lanes[position]
+        else:
+            inside = index < counts
+            sums += np.where(inside, lanes[np.where(inside, position, 0)], 0).astype(np.uint64)
+    return sums
+
+
+def _to_little_endian(starts, big_endian_sums):
+    """
+    Big endian word sums (such as a pseudo header) brought to the word_sums
+    of ranges at starts
+    """
+    return np.where(starts & 1, big_endian_sums, big_endian_sums * 256).astype(np.uint64)
+
+
+class ChecksumResults(object):
+    """
+    Per packet results of a batch, all boolean arrays indexed by packet
+    number. A packet only has ipv4_valid or udp_valid set when it was
+    checked, see ipv4_checked and udp_checked.
+    """
+    __slots__ = ['ipv4_checked', 'ipv4_valid', 'udp_checked', 'udp_valid']
+
+    def __init__(self, ipv4_checked, ipv4_valid, udp_checked, udp_valid):
+        self.ipv4_checked = ipv4_checked
+        self.ipv4_valid = ipv4_valid
+        self.udp_checked = udp_checked
+        self.udp_valid = udp_valid
+
+    @property
+    def ipv4_errors(self):
+        return self.ipv4_checked & ~self.ipv4_valid
+
+    @property
+    def udp_errors(self):
+        return self.udp_checked & ~self.udp_valid
+
+
+def verify_columns(buffer, columns):
+    """
+    Verify the IPv4 header and UDP checksums of every packet of a
+    CaptureColumns decoded from buffer, returns a ChecksumResults
+    """
+    lanes = lane_view(buffer)
+    ipv4_hdr = columns.ipv4
+    udp_hdr = columns.udp
+    record_end = columns.record['offset'] + columns.record['incl_len']
+
+    ip_start = (columns.record['offset'] + _ETHERNET_HDR_LENGTH +
+                columns.ethernet['vlan_count'].astype(np.int64) * _VLAN_TAG_LENGTH)
+    header_length = ipv4_hdr['internet_hdr_length'].astype(np.int64)
+    ipv4_checked = columns.has_ipv4 & (ip_start + header_length <= record_end)
+    # the last bytes of a buffer that is not a multiple of 4 long have no
+    # lane, a packet ending there is summed on its own
+    lanes_end = len(lanes) * 4
+    ipv4_valid = np.zeros(len(columns), dtype=bool)
+    selected = np.flatnonzero(ipv4_checked)
+    if len(selected):
+        start = ip_start[selected]
+        end = start + header_length[selected]
+        in_lanes = end <= lanes_end
+        # a correct checksum makes the sum 0xFFFF, a multiple of 0xFFFF
+        # unfolded
+        sums = header_sums(lanes, start[in_lanes], end[in_lanes])
+        ipv4_valid[selected[in_lanes]] = sums % np.uint64(0xFFFF) == 0
+        for index in np.flatnonzero(~in_lanes).tolist():
+            ipv4_valid[selected[index]] = checksum.verify_ipv4_header(buffer, int(start[index])) is True
+
+    udp_start = ip_start + header_length
+    udp_length = udp_hdr['length'].astype(np.int64)
+    udp_checked = (columns.has_udp & (udp_hdr['checksum'] != 0) & (udp_length >= 8) &
+                   (ipv4_hdr['fragment_offset'] == 0) & ((ipv4_hdr['flags'] & 0x1) == 0) &
+                   (udp_start + udp_length <= record_end) &
+                   (udp_length <= ipv4_hdr['total_length'].astype(np.int64) - header_length))
+    udp_valid = np.zeros(len(columns), dtype=bool)
+    selected = np.flatnonzero(udp_checked)
+    if len(selected):
+        source_ip = ipv4_hdr['source_ip'][selected].astype(np.int64)
+        destination_ip = ipv4_hdr['destination_ip'][selected].astype(np.int64)
+        start = udp_start[selected]
+        end = start + udp_length[selected]
+        pseudo_header = ((source_ip >> 16) + (source_ip & 0xFFFF) + (destination_ip >> 16) +
+                         (destination_ip & 0xFFFF) + ipv4.PROTOCOL_UDP + udp_length[selected])
+
+        in_lanes = end <= lanes_end
+        sums = word_sums(lanes, start[in_lanes], end[in_lanes])
+        sums += _to_little_endian(start[in_lanes], pseudo_header[in_lanes])
+        udp_valid[selected[in_lanes]] = sums % np.uint64(0xFFFF) == 0
+        for index in np.flatnonzero(~in_lanes).tolist():
+            total = checksum.ones_complement_sum(buffer, int(start[index]), int(end[index] - start[index]),
+                                                 int(pseudo_header[index]))
+            udp_valid[selected[index]] = total == 0xFFFF
+
+    return ChecksumResults(ipv4_checked, ipv4_valid, udp_checked, udp_valid)
+
+
+class ChecksumCounters(object):
+    """
+    Totals over every batch verified and, per flow key, the list
+    [ipv4 errors, udp errors] of the flows that had any
+    """
+    __slots__ = ['packets', 'ipv4_checked', 'ipv4_errors', 'udp_checked', 'udp_errors',
+                 'udp_skipped', 'flows']
+
+    def __init__(self):
+        self.packets = 0
+        self.ipv4_checked = 0
+        self.ipv4_errors = 0
+        self.udp_checked = 0
+        self.udp_errors = 0
+        self.udp_skipped = 0
+        self.flows = {}
+
+    def update(self, columns, results):
+        ipv4_errors = results.ipv4_errors
+        udp_errors = results.udp_errors
+        self.packets += len(columns)
+        self.ipv4_checked += int(results.ipv4_checked.sum())
+        self.ipv4_errors += int(ipv4_errors.sum())
+        self.udp_checked += int(results.udp_checked.sum())
+        self.udp_errors += int(udp_errors.sum())
+        self.udp_skipped += int((columns.has_udp & ~results.udp_checked).sum())
+
+        failed = np.flatnonzero(ipv4_errors | udp_errors)
+        if not len(failed):
+            return
+        keys = zip(columns.ipv4['source_ip'][failed].tolist(), columns.ipv4['destination_ip'][failed].tolist(),
+                   columns.ipv4['protocol'][failed].tolist(), columns.udp['source_port'][failed].tolist(),
+                   columns.udp['destination_port'][failed].tolist())
+        for key, ipv4_error, udp_error in zip(keys, ipv4_errors[failed].tolist(), udp_errors[failed].tolist()):
+            counts = self.flows.get(key)
+            if counts is None:
+                counts = self.flows[key] = [0, 0]
+            counts[0] += ipv4_error
+            counts[1] += udp_error
+
+    def to_dict(self):
+        return {
+            'packets': self.packets,
+            'ipv4_checked': self.ipv4_checked,
+            'ipv4_errors': self.ipv4_errors,
+            'udp_checked': self.udp_checked,
+            'udp_errors': self.udp_errors,
+            'udp_skipped': self.udp_skipped,
+            'flows': [{'flow': list(key), 'ipv4_errors': counts[0], 'udp_errors': counts[1]}
+                      for key, counts in sorted(self.flows.items())],
+        }
+
+
+def verify_file(input_file, counters=None, chunk_records=1 << 20):
+    """
+    Verify every packet of a pcap file chunk_records packets at a time,
+    returns the ChecksumCounters updated
+    """
+    if counters is None:
+        counters = ChecksumCounters()
+    mapped = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        chunks = capture_columns.iter_columns(mapped, chunk_records)
+        try:
+            for columns in chunks:
+                counters.update(columns, verify_columns(mapped, columns))
+        finally:
+            chunks.close()
+    finally:
+        mapped.close()
+    return counters
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        sys.stderr.write('usage: python -m capture.checksums CAPTURE\n')
+        return 2
+
+    with open(argv[0], 'rb') as input_file:
+        counters = verify_file(input_file)
+    json.dump(counters.to_dict(), sys.stdout, indent=2)
+    sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
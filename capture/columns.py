@@ -0,0 +1,295 @@
+"""
+Columnar batch decode of a pcap capture into NumPy arrays
+
+The record header chain is walked once to find where every packet starts,
+then each header field is pulled out for all packets at once with
+vectorized gathers over the capture bytes. No per-packet header objects
+are built.
+
+with open('test.pcap', 'rb') as fp:
+    columns = load_columns(fp)
+    rtp = columns.rtp[columns.has_rtp]
+    print(rtp['ssrc'], rtp['sequence_number'])
+
+Field names match the attributes of PcapRecordHeader, Ipv4Header,
+UdpHeader, RtpHeader and NaluHeader. IPv4 addresses are stored as a single
+uint32 in network order instead of a 4-tuple. Packets that lack a layer
+have its fields zeroed and their entry in the matching has_* mask False.
+IPv4 fragments after the first have no udp, rtp or nal unit fields.
+Frames with more than MAX_VLAN_TAGS vlan tags are decoded as ethernet only.
+
+iter_columns() decodes a capture in chunks of packets for captures whose
+columns do not fit in memory at once.
+"""
+
+import array
+import mmap
+import struct
+
+import numpy as np
+
+from network import ethernet
+from network import ipv4
+from network import pcap
+
+__author__ = 'wmoorefi'
+
+RECORD_DTYPE = np.dtype([('ts_sec', np.uint32), ('ts_usec', np.uint32),
+                         ('incl_len', np.uint32), ('orig_len', np.uint32),
+                         ('offset', np.int64)])
+
+ETHERNET_DTYPE = np.dtype([('ethertype', np.uint16), ('payload_ethertype', np.uint16),
+                           ('vlan_count', np.uint8)])
+
+# stacked vlan tags followed per packet, single tagged and QinQ frames
+MAX_VLAN_TAGS = 2
+
+IPV4_DTYPE = np.dtype([('version', np.uint8), ('internet_hdr_length', np.uint8),
+                       ('dscp', np.uint8), ('explicit_congestion_notification', np.uint8),
+                       ('total_length', np.uint16), ('identification', np.uint16),
+                       ('flags', np.uint8), ('fragment_offset', np.uint16),
+                       ('time_to_live', np.uint8), ('protocol', np.uint8),
+                       ('header_checksum', np.uint16),
+                       ('source_ip', np.uint32), ('destination_ip', np.uint32)])
+
+UDP_DTYPE = np.dtype([('source_port', np.uint16), ('destination_port', np.uint16),
+                      ('length', np.uint16), ('checksum', np.uint16)])
+
+RTP_DTYPE = np.dtype([('version', np.uint8), ('padding_flag', np.uint8),
+                      ('marker_bit', np.uint8), ('payload_type', np.uint8),
+                      ('sequence_number', np.uint16), ('timestamp', np.uint32),
+                      ('ssrc', np.uint32), ('csrc_count', np.uint8)])
+
+NALU_DTYPE = np.dtype([('forbidden_zero_bit', np.uint8), ('nal_ref_idc', np.uint8),
+                       ('nal_unit_type', np.uint8)])
+
+# only incl_len is needed to step from one record header to the next
+_INCL_LEN_STRUCTS = {
+    '<': struct.Struct('<8xI'),
+    '>': struct.Struct('>8xI'),
+}
+
+
+class CaptureColumns(object):
+    """
+    Decoded header fields of every packet in a capture, one structured array
+    per layer, all indexed by packet number
+    """
+    __slots__ = ['pcap_header', 'record', 'ethernet', 'ipv4', 'udp', 'rtp', 'nalu',
+                 'has_ethernet', 'has_ipv4', 'has_udp', 'has_rtp', 'has_nalu']
+
+    def __init__(self, pcap_header, record, ethernet, ipv4, udp, rtp, nalu,
+                 has_ethernet, has_ipv4, has_udp, has_rtp, has_nalu):
+        self.pcap_header = pcap_header
+        self.record = record
+        self.ethernet = ethernet
+        self.ipv4 = ipv4
+        self.udp = udp
+        self.rtp = rtp
+        self.nalu = nalu
+        self.has_ethernet = has_ethernet
+        self.has_ipv4 = has_ipv4
+        self.has_udp = has_udp
+        self.has_rtp = has_rtp
+        self.has_nalu = has_nalu
+
+    def __len__(self):
+        return len(self.record)
+
+
+def record_offsets(pcap_hdr, buffer, offset=pcap.PCAP_HDR_LENGTH, max_records=None):
+    """
+    Follow the PcapRecordHeader chain, returns an int64 array with the offset
+    of every complete record header in buffer, or of the first max_records
+    of them from offset on
+    """
+    unpack_incl_len = _INCL_LEN_STRUCTS[pcap_hdr.byte_order].unpack_from
+    end = len(buffer)
+    offsets = array.array('q')
+    append = offsets.append
+    remaining = -1 if max_records is None else max_records
+
+    while remaining and offset + pcap.PCAPREC_HDR_LENGTH <= end:
+        incl_len = unpack_incl_len(buffer, offset)[0]
+        next_offset = offset + pcap.PCAPREC_HDR_LENGTH + incl_len
+        if next_offset > end:
+            break  # truncated trailing record
+        append(offset)
+        offset = next_offset
+        remaining -= 1
+
+    return np.frombuffer(offsets, dtype=np.int64) if len(offsets) else np.zeros(0, dtype=np.int64)
+
+
+def _gather_u8(data, index):
+    return data[index]
+
+
+def _gather_u16(data, index):
+    return (data[index].astype(np.uint16) << 8) | data[index + 1]
+
+
+def _gather_u32(data, index):
+    return ((data[index].astype(np.uint32) << 24) | (data[index + 1].astype(np.uint32) << 16) |
+            (data[index + 2].astype(np.uint32) << 8) | data[index + 3])
+
+
+def _gather_u32_le(data, index):
+    return ((data[index + 3].astype(np.uint32) << 24) | (data[index + 2].astype(np.uint32) << 16) |
+            (data[index + 1].astype(np.uint32) << 8) | data[index])
+
+
+def decode_columns(buffer, offset=0):
+    """
+    Decode a whole capture held in buffer (bytes, bytearray, mmap or
+    memoryview) into a CaptureColumns
+    """
+    pcap_hdr = pcap.unpack_pcap_header(buffer, offset)
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    offsets = record_offsets(pcap_hdr, buffer, offset + pcap.PCAP_HDR_LENGTH)
+    return _decode_records(pcap_hdr, data, offsets)
+
+
+def iter_columns(buffer, chunk_records=1 << 20, offset=0, record_offset=None):
+    """
+    Decode a capture held in buffer chunk_records packets at a time, yields
+    a CaptureColumns per chunk so memory stays bounded whatever the size of
+    the capture. Packet numbers restart at 0 in every chunk. record_offset
+    resumes decoding at the record header found there, for instance where
+    an earlier decode of a growing capture stopped.
+    """
+    pcap_hdr = pcap.unpack_pcap_header(buffer, offset)
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    offset = offset + pcap.PCAP_HDR_LENGTH if record_offset is None else record_offset
+    while True:
+        offsets = record_offsets(pcap_hdr, buffer, offset, chunk_records)
+        if not len(offsets):
+            return
+        columns = _decode_records(pcap_hdr, data, offsets)
+        yield columns
+        offset = int(columns.record['offset'][-1]) + int(columns.record['incl_len'][-1])
+
+
+def _decode_records(pcap_hdr, data, offsets):
+    count = len(offsets)
+
+    # record headers
+    gather_u32 = _gather_u32_le if pcap_hdr.byte_order == '<' else _gather_u32
+    record = np.zeros(count, dtype=RECORD_DTYPE)
+    record['ts_sec'] = gather_u32(data, offsets)
+    record['ts_usec'] = gather_u32(data, offsets + 4)
+    record['incl_len'] = gather_u32(data, offsets + 8)
+    record['orig_len'] = gather_u32(data, offsets + 12)
+    record['offset'] = offsets + pcap.PCAPREC_HDR_LENGTH
+
+    start = record['offset']
+    end = start + record['incl_len']
+
+    # ethernet
+    has_ethernet = record['incl_len'] >= 14
+    ethernet_hdr = np.zeros(count, dtype=ETHERNET_DTYPE)
+    index = np.where(has_ethernet, start, 0)
+    ethernet_hdr['ethertype'] = np.where(has_ethernet, _gather_u16(data, index + 12), 0)
+    payload_ethertype = ethernet_hdr['ethertype'].copy()
+    ip_start = start + 14
+    for _ in range(MAX_VLAN_TAGS):
+        tagged = (((payload_ethertype == ethernet.ETHERTYPE_8021Q) |
+                   (payload_ethertype == ethernet.ETHERTYPE_8021AD)) & (ip_start + 4 <= end))
+        if not tagged.any():
+            break
+        index = np.where(tagged, ip_start, 0)
+        payload_ethertype = np.where(tagged, _gather_u16(data, index + 2), payload_ethertype)
+        ethernet_hdr['vlan_count'] += tagged
+        ip_start = ip_start + np.where(tagged, 4, 0)
+    ethernet_hdr['payload_ethertype'] = payload_ethertype
+
+    # ipv4
+    has_ipv4 = has_ethernet & (payload_ethertype == ethernet.ETHERTYPE_IPV4) & (ip_start + 20 <= end)
+    index = np.where(has_ipv4, ip_start, 0)
+    first = _gather_u8(data, index)
+    has_ipv4 &= ((first >> 4) == 4) & ((first & 0x0F) >= 5)
+    index = np.where(has_ipv4, ip_start, 0)
+    first = _gather_u8(data, index)
+    second = _gather_u8(data, index + 1)
+    flags_fragment = _gather_u16(data, index + 6)
+
+    ipv4_hdr = np.zeros(count, dtype=IPV4_DTYPE)
+    ipv4_hdr['version'] = first >> 4
+    ipv4_hdr['internet_hdr_length'] = (first & 0x0F) * 4
+    ipv4_hdr['dscp'] = second >> 2
+    ipv4_hdr['explicit_congestion_notification'] = second & 0x03
+    ipv4_hdr['total_length'] = _gather_u16(data, index + 2)
+    ipv4_hdr['identification'] = _gather_u16(data, index + 4)
+    ipv4_hdr['flags'] = flags_fragment >> 13
+    ipv4_hdr['fragment_offset'] = flags_fragment & 0x1FFF
+    ipv4_hdr['time_to_live'] = _gather_u8(data, index + 8)
+    ipv4_hdr['protocol'] = _gather_u8(data, index + 9)
+    ipv4_hdr['header_checksum'] = _gather_u16(data, index + 10)
+    ipv4_hdr['source_ip'] = _gather_u32(data, index + 12)
+    ipv4_hdr['destination_ip'] = _gather_u32(data, index + 16)
+    ipv4_hdr[~has_ipv4] = 0
+    # the datagram ends with its total length, before any ethernet trailer
+    end = np.where(has_ipv4, np.minimum(end, ip_start + ipv4_hdr['total_length']), end)
+
+    # udp, later fragments carry payload bytes where the header would be
+    udp_start = ip_start + ipv4_hdr['internet_hdr_length']
+    has_udp = (has_ipv4 & (ipv4_hdr['protocol'] == ipv4.PROTOCOL_UDP) & (ipv4_hdr['fragment_offset'] == 0) &
+               (udp_start + 8 <= end))
+    index = np.where(has_udp, udp_start, 0)
+    udp_hdr = np.zeros(count, dtype=UDP_DTYPE)
+    udp_hdr['source_port'] = _gather_u16(data, index)
+    udp_hdr['destination_port'] = _gather_u16(data, index + 2)
+    udp_hdr['length'] = _gather_u16(data, index + 4)
+    udp_hdr['checksum'] = _gather_u16(data, index + 6)
+    udp_hdr[~has_udp] = 0
+
+    # rtp, assumed as the UDP payload when the version field reads 2
+    rtp_start = udp_start + 8
+    has_rtp = has_udp & (rtp_start + 12 <= end)
+    index = np.where(has_rtp, rtp_start, 0)
+    first = _gather_u8(data, index)
+    has_rtp &= (first >> 6) == 2
+    has_rtp &= rtp_start + 12 + (first & 0x0F).astype(np.int64) * 4 <= end
+    index = np.where(has_rtp, rtp_start, 0)
+    first = _gather_u8(data, index)
+    second = _gather_u8(data, index + 1)
+
+    rtp_hdr = np.zeros(count, dtype=RTP_DTYPE)
+    rtp_hdr['version'] = first >> 6
+    rtp_hdr['padding_flag'] = (first >> 5) & 0x1
+    rtp_hdr['marker_bit'] = second >> 7
+    rtp_hdr['payload_type'] = second & 0x7F
+    rtp_hdr['sequence_number'] = _gather_u16(data, index + 2)
+    rtp_hdr['timestamp'] = _gather_u32(data, index + 4)
+    rtp_hdr['ssrc'] = _gather_u32(data, index + 8)
+    rtp_hdr['csrc_count'] = first & 0x0F
+    rtp_hdr[~has_rtp] = 0
+
+    # nal unit header, first byte after the csrc list and header extension
+    nalu_start = rtp_start + 12 + rtp_hdr['csrc_count'].astype(np.int64) * 4
+    has_extension = (first & 0x10) != 0
+    extended = has_rtp & has_extension & (nalu_start + 4 <= end)
+    extension_words = _gather_u16(data, np.where(extended, nalu_start + 2, 0)).astype(np.int64)
+    nalu_start += np.where(extended, 4 + extension_words * 4, 0)
+    has_nalu = has_rtp & (nalu_start < end) & (extended | ~has_extension)
+    nal_byte = _gather_u8(data, np.where(has_nalu, nalu_start, 0))
+    nalu_hdr = np.zeros(count, dtype=NALU_DTYPE)
+    nalu_hdr['forbidden_zero_bit'] = nal_byte >> 7
+    nalu_hdr['nal_ref_idc'] = (nal_byte >> 5) & 0x03
+    nalu_hdr['nal_unit_type'] = nal_byte & 0x1F
+    nalu_hdr[~has_nalu] = 0
+
+    return CaptureColumns(pcap_hdr, record, ethernet_hdr, ipv4_hdr, udp_hdr, rtp_hdr, nalu_hdr,
+                          has_ethernet, has_ipv4, has_udp, has_rtp, has_nalu)
+
+
+def load_columns(input_file):
+    """
+    Memory-maps a pcap file and decodes it into a CaptureColumns, the
+    returned arrays are copies so the map is released before returning
+    """
+    mapped = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return decode_columns(mapped)
+    finally:
+        mapped.close()
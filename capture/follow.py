@@ -0,0 +1,175 @@
+"""
+asyncio follow mode for growing pcap files and live pcap streams
+
+PcapFollower tails a pcap file that a recorder is still writing, complete
+records are yielded as they land and a partially written record is held
+back until the rest of it arrives. PcapStreamReader reads the same format
+from a UNIX socket or pipe.
+
+Both are pulled with async for, nothing is read ahead of the consumer
+beyond one chunk, so a slow consumer slows the reader down instead of
+records piling up in memory. For sockets and pipes the transport is paused
+by asyncio once its buffer fills, which pushes back on the writer.
+
+async def monitor():
+    follower = PcapFollower('live.pcap', idle_timeout=30)
+    async for record_hdr, packet in follower:
+        ...
+
+Records are yielded as (PcapRecordHeader, bytes). Only classic pcap is
+supported.
+"""
+
+import asyncio
+import logging
+
+from network import pcap
+
+__author__ = 'wmoorefi'
+
+# records claiming more than this are treated as corrupt rather than as
+# a record still being written
+MAX_RECORD_LENGTH = 262144
+
+_module_logger = logging.getLogger(__name__)
+
+
+def _max_record_length(pcap_hdr):
+    return max(pcap_hdr.snaplen, MAX_RECORD_LENGTH)
+
+
+class PcapFollower(object):
+    """
+    Tail a growing pcap file, polls every poll_interval seconds once the
+    end is reached and stops after idle_timeout seconds without new data
+    (None follows forever) or when stop() is called. header is set once the
+    pcap header has been read.
+    """
+    __slots__ = ['path', 'header', 'poll_interval', 'chunk_size', 'idle_timeout',
+                 'records_read', '_stopped']
+
+    def __init__(self, path, poll_interval=0.25, chunk_size=1 << 20, idle_timeout=None):
+        self.path = path
+        self.header = None
+        self.poll_interval = poll_interval
+        self.chunk_size = chunk_size
+        self.idle_timeout = idle_timeout
+        self.records_read = 0
+        self._stopped = False
+
+    def __aiter__(self):
+        return self._follow()
+
+    def stop(self):
+        self._stopped = True
+
+    async def _follow(self):
+        loop = asyncio.get_running_loop()
+        with open(self.path, 'rb') as input_file:
+            buffer = bytearray()
+            position = 0
+            idle = 0.0
+
+            while not self._stopped:
+                # file reads may block, keep them off the event loop
+                chunk = await loop.run_in_executor(None, input_file.read, self.chunk_size)
+                if not chunk:
+                    if self.idle_timeout is not None and idle >= self.idle_timeout:
+                        break
+                    await asyncio.sleep(self.poll_interval)
+                    idle += self.poll_interval
+                    continue
+                idle = 0.0
+
+                del buffer[:position]
+                position = 0
+                buffer += chunk
+
+                if self.header is None:
+                    if len(buffer) < pcap.PCAP_HDR_LENGTH:
+                        continue
+                    self.header = pcap.unpack_pcap_header(buffer)
+                    position = pcap.PCAP_HDR_LENGTH
+
+                while not self._stopped:
+                    record_hdr = pcap.unpack_pcap_record(self.header, buffer, position)
+                    if record_hdr is None:
+                        break
+                    if record_hdr.incl_len > _max_record_length(self.header):
+                        raise Exception('Invalid pcap stream, record of %d bytes at %d' %
+                                        (record_hdr.incl_len, input_file.tell() - len(buffer) + position))
+
+                    end = position + pcap.PCAPREC_HDR_LENGTH + record_hdr.incl_len
+                    if end > len(buffer):
+                        break  # record still being written
+
+                    packet = bytes(buffer[position + pcap.PCAPREC_HDR_LENGTH:end])
+                    position = end
+                    self.records_read += 1
+                    yield record_hdr, packet
+
+            if position < len(buffer):
+                _module_logger.info('%s: %d bytes of an incomplete record left', self.path, len(buffer) - position)
+
+
+class PcapStreamReader(object):
+    """
+    pcap records from an asyncio.StreamReader, see open_unix_stream and
+    open_pipe. Iteration ends when the writer closes the stream.
+    """
+    __slots__ = ['reader', 'header', 'records_read', '_writer']
+
+    def __init__(self, reader, writer=None):
+        self.reader = reader
+        self.header = None
+        self.records_read = 0
+        self._writer = writer
+
+    def __aiter__(self):
+        return self._records()
+
+    async def read_header(self):
+        raw_header = await self.reader.readexactly(pcap.PCAP_HDR_LENGTH)
+        self.header = pcap.unpack_pcap_header(raw_header)
+        return self.header
+
+    async def _records(self):
+        if self.header is None:
+            await self.read_header()
+        max_record_length = _max_record_length(self.header)
+
+        while True:
+            try:
+                raw_header = await self.reader.readexactly(pcap.PCAPREC_HDR_LENGTH)
+                record_hdr = pcap.unpack_pcap_record(self.header, raw_header)
+                if record_hdr.incl_len > max_record_length:
+                    raise Exception('Invalid pcap stream, record of %d bytes' % record_hdr.incl_len)
+                packet = await self.reader.readexactly(record_hdr.incl_len)
+            except asyncio.IncompleteReadError as error:
+                if error.partial:
+                    _module_logger.warning('stream closed inside a record, %d bytes dropped', len(error.partial))
+                break
+            self.records_read += 1
+            yield record_hdr, packet
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+async def open_unix_stream(path):
+    """
+    Connect to a UNIX socket that serves a pcap stream
+    """
+    reader, writer = await asyncio.open_unix_connection(path)
+    return PcapStreamReader(reader, writer)
+
+
+async def open_pipe(pipe):
+    """
+    Read a pcap stream from a pipe file object, e.g. the stdout of tcpdump -w -
+    """
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    return PcapStreamReader(reader)
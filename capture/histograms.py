@@ -0,0 +1,432 @@
+"""
+Windowed per-stream RTP histograms for capacity planning, computed with
+NumPy over whole batches of packets
+
+Per SSRC are kept the bitrate and packet rate over fixed time windows,
+packet size and inter-arrival histograms, payload_type and marker_bit
+counts and the nal_unit_type / nal_ref_idc mix of the NAL unit headers.
+Every histogram has fixed bins and the time windows are a ring of the last
+history windows, so the memory of a stream does not grow with the length
+of the capture.
+
+histograms = RtpHistograms(window=1.0)
+with open('test.pcap', 'rb') as fp:
+    histograms.update_file(fp)
+for ssrc, stream in histograms.streams.items():
+    print(hex(ssrc), stream.packets, stream.bitrate())
+
+Batches come from capture.columns (update_columns), from (record header,
+packet) pairs (update_records) or from plain arrays (update). Packet sizes
+are the orig_len of the records, the length of the frame on the wire.
+Packets are matched to windows by capture time, a packet older than the
+oldest window kept is counted in late and left out of the windows.
+
+python -m capture.histograms test.pcap --window 1 --history 600
+"""
+
+import argparse
+import array
+import json
+import mmap
+import struct
+import sys
+
+import numpy as np
+
+from capture import columns as capture_columns
+from network import ethernet
+from network import flow
+from network import ipv4
+from network import pcap
+from network import pcapng
+
+__author__ = 'wmoorefi'
+
+SIZE_BIN_WIDTH = 64
+# the last bin holds every packet from (SIZE_BINS - 1) * SIZE_BIN_WIDTH up
+SIZE_BINS = 48
+
+# inter-arrival bin edges in seconds, 8 bins per decade from 1us to 10s,
+# bin 0 holds everything below 1us and the last bin everything from 10s up
+INTERARRIVAL_EDGES = 10.0 ** (np.arange(-48, 9) / 8.0)
+INTERARRIVAL_BINS = len(INTERARRIVAL_EDGES) + 1
+
+PAYLOAD_TYPES = 128
+NAL_UNIT_TYPES = 32
+NAL_REF_IDCS = 4
+
+# version/flags, marker/payload type, sequence number, timestamp, ssrc
+_RTP_HDR = struct.Struct('>BBHII')
+_RTP_EXTENSION_LENGTH = struct.Struct('>2xH')
+
+
+class StreamHistograms(object):
+    """
+    Histograms of one SSRC. sizes and interarrivals are counts per bin,
+    payload_types, marker_bits, nal_unit_types and nal_ref_idcs counts per
+    value. Arrival times are capture times in seconds.
+    """
+    __slots__ = ['ssrc', 'window', 'history', 'packets', 'bytes', 'late', 'first_arrival',
+                 'last_arrival', 'sizes', 'interarrivals', 'payload_types', 'marker_bits',
+                 'nal_unit_types', 'nal_ref_idcs', '_window_bytes', '_window_packets',
+                 '_first_window', '_last_window']
+
+    def __init__(self, ssrc, window, history, size_bins=SIZE_BINS):
+        self.ssrc = ssrc
+        self.window = window
+        self.history = history
+        self.packets = 0
+        self.bytes = 0
+        self.late = 0
+        self.first_arrival = None
+        self.last_arrival = None
+        self.sizes = np.zeros(size_bins, dtype=np.int64)
+        self.interarrivals = np.zeros(INTERARRIVAL_BINS, dtype=np.int64)
+        self.payload_types = np.zeros(PAYLOAD_TYPES, dtype=np.int64)
+        self.marker_bits = np.zeros(2, dtype=np.int64)
+        self.nal_unit_types = np.zeros(NAL_UNIT_TYPES, dtype=np.int64)
+        self.nal_ref_idcs = np.zeros(NAL_REF_IDCS, dtype=np.int64)
+        self._window_bytes = np.zeros(history, dtype=np.int64)
+        self._window_packets = np.zeros(history, dtype=np.int64)
+        self._first_window = None
+        self._last_window = None
+
+    def _advance(self, first_window, last_window):
+        """
+        Move the ring forward to end at window number last_window, clearing
+        the slots that are reused, first_window is the oldest window of the
+        packets being added
+        """
+        if self._last_window is None:
+            self._first_window = first_window
+            self._last_window = last_window
+            return
+        self._first_window = min(self._first_window, first_window)
+        steps = last_window - self._last_window
+        if steps <= 0:
+            return
+        if steps >= self.history:
+            self._window_bytes[:] = 0
+            self._window_packets[:] = 0
+        else:
+            slots = np.arange(self._last_window + 1, last_window + 1) % self.history
+            self._window_bytes[slots] = 0
+            self._window_packets[slots] = 0
+        self._last_window = last_window
+
+    def timeline(self):
+        """
+        (window start times, bytes, packets) of the windows kept, oldest
+        first. Windows without packets are included.
+        """
+        if self._last_window is None:
+            empty = np.zeros(0, dtype=np.int64)
+            return np.zeros(0), empty, empty
+        count = min(self.history, self._last_window - self._first_window + 1)
+        windows = np.arange(self._last_window - count + 1, self._last_window + 1)
+        slots = windows % self.history
+        return windows * self.window, self._window_bytes[slots], self._window_packets[slots]
+
+    def bitrate(self):
+        """
+        (window start times, bits per second) of the windows kept
+        """
+        (start_times, window_bytes, _) = self.timeline()
+        return start_times, window_bytes * 8.0 / self.window
+
+    def to_dict(self):
+        (start_times, window_bytes, window_packets) = self.timeline()
+        return {
+            'ssrc': self.ssrc,
+            'packets': self.packets,
+            'bytes': self.bytes,
+            'late': self.late,
+            'first_arrival': self.first_arrival,
+            'last_arrival': self.last_arrival,
+            'window': self.window,
+            'window_start': start_times.tolist(),
+            'window_bytes': window_bytes.tolist(),
+            'window_packets': window_packets.tolist(),
+            'sizes': self.sizes.tolist(),
+            'interarrivals': self.interarrivals.tolist(),
+            'payload_types': _nonzero(self.payload_types),
+            'marker_bits': self.marker_bits.tolist(),
+            'nal_unit_types': _nonzero(self.nal_unit_types),
+            'nal_ref_idcs': self.nal_ref_idcs.tolist(),
+        }
+
+
+def _nonzero(counts):
+    return dict((int(value), int(counts[value])) for value in np.flatnonzero(counts))
+
+
+def _per_stream(stream_index, values, stream_count, bins, weights=None):
+    """
+    bincount of values for every stream at once, shape (stream_count, bins)
+    """
+    return np.bincount(stream_index * bins + values, weights=weights,
+                       minlength=stream_count * bins).reshape(stream_count, bins)
+
+
+class RtpHistograms(object):
+    """
+    StreamHistograms of every SSRC seen, keyed by SSRC. window is the width
+    of a time window in seconds, history the number of windows kept per
+    stream.
+    """
+    __slots__ = ['window', 'history', 'size_bin_width', 'size_bins', 'streams']
+
+    def __init__(self, window=1.0, history=3600, size_bin_width=SIZE_BIN_WIDTH, size_bins=SIZE_BINS):
+        self.window = window
+        self.history = history
+        self.size_bin_width = size_bin_width
+        self.size_bins = size_bins
+        self.streams = {}
+
+    def update(self, ssrcs, arrival_times, sizes, payload_types, marker_bits,
+               nal_unit_types=None, nal_ref_idcs=None, has_nalu=None):
+        """
+        Add a batch of rtp packets in arrival order, one array entry per
+        packet. The nal arrays are optional, has_nalu masks the packets
+        that carry a NAL unit header and defaults to all of them.
+        """
+        ssrcs = np.asarray(ssrcs, dtype=np.uint32)
+        if not len(ssrcs):
+            return
+        arrival_times = np.asarray(arrival_times, dtype=np.float64)
+        sizes = np.asarray(sizes, dtype=np.int64)
+
+        (unique_ssrcs, stream_index) = np.unique(ssrcs, return_inverse=True)
+        stream_index = stream_index.reshape(-1)
+        stream_count = len(unique_ssrcs)
+        streams = []
+        for ssrc in unique_ssrcs.tolist():
+            stream = self.streams.get(ssrc)
+            if stream is None:
+                stream = self.streams[ssrc] = StreamHistograms(ssrc, self.window, self.history, self.size_bins)
+            streams.append(stream)
+
+        size_bins = np.minimum(sizes // self.size_bin_width, self.size_bins - 1)
+        sizes_counts = _per_stream(stream_index, size_bins, stream_count, self.size_bins)
+        payload_types = np.asarray(payload_types, dtype=np.int64) & 0x7F
+        payload_type_counts = _per_stream(stream_index, payload_types, stream_count, PAYLOAD_TYPES)
+        marker_bits = np.asarray(marker_bits, dtype=np.int64) & 0x1
+        marker_counts = _per_stream(stream_index, marker_bits, stream_count, 2)
+
+        nal_type_counts = nal_ref_idc_counts = None
+        if nal_unit_types is not None:
+            nal_index = stream_index
+            nal_unit_types = np.asarray(nal_unit_types, dtype=np.int64) & 0x1F
+            nal_ref_idcs = np.asarray(nal_ref_idcs, dtype=np.int64) & 0x03
+            if has_nalu is not None:
+                has_nalu = np.asarray(has_nalu, dtype=bool)
+                nal_index = stream_index[has_nalu]
+                nal_unit_types = nal_unit_types[has_nalu]
+                nal_ref_idcs = nal_ref_idcs[has_nalu]
+            nal_type_counts = _per_stream(nal_index, nal_unit_types, stream_count, NAL_UNIT_TYPES)
+            nal_ref_idc_counts = _per_stream(nal_index, nal_ref_idcs, stream_count, NAL_REF_IDCS)
+
+        # group the packets by stream keeping their arrival order
+        order = np.argsort(stream_index, kind='stable')
+        sorted_index = stream_index[order]
+        sorted_arrivals = arrival_times[order]
+        sorted_sizes = sizes[order]
+        packet_counts = np.bincount(stream_index, minlength=stream_count)
+        starts = np.concatenate(([0], np.cumsum(packet_counts)[:-1]))
+        ends = starts + packet_counts - 1
+
+        # inter-arrival, the first packet of a stream in the batch against
+        # the last one of the previous batch
+        deltas = np.empty(len(sorted_arrivals))
+        deltas[1:] = np.diff(sorted_arrivals)
+        previous_arrivals = np.array([np.nan if stream.last_arrival is None else stream.last_arrival
+                                      for stream in streams])
+        deltas[starts] = sorted_arrivals[starts] - previous_arrivals
+        timed = ~np.isnan(deltas)
+        interarrival_bins = np.searchsorted(INTERARRIVAL_EDGES, deltas[timed], side='right')
+        interarrival_counts = _per_stream(sorted_index[timed], interarrival_bins, stream_count,
+                                          INTERARRIVAL_BINS)
+
+        # time windows, moved forward to the newest window of each stream
+        windows = np.floor(sorted_arrivals / self.window).astype(np.int64)
+        first_windows = np.minimum.reduceat(windows, starts).tolist()
+        last_windows = np.maximum.reduceat(windows, starts).tolist()
+        for index, stream in enumerate(streams):
+            stream._advance(first_windows[index], last_windows[index])
+        ring_ends = np.array([stream._last_window for stream in streams], dtype=np.int64)
+        kept = windows > ring_ends[sorted_index] - self.history
+        slots = windows[kept] % self.history
+        window_bytes = _per_stream(sorted_index[kept], slots, stream_count, self.history,
+                                   sorted_sizes[kept]).astype(np.int64)
+        window_packets = _per_stream(sorted_index[kept], slots, stream_count, self.history)
+        late_counts = np.bincount(sorted_index[~kept], minlength=stream_count)
+        byte_counts = np.bincount(stream_index, weights=sizes, minlength=stream_count).astype(np.int64)
+
+        for index, stream in enumerate(streams):
+            if stream.first_arrival is None:
+                stream.first_arrival = float(sorted_arrivals[starts[index]])
+            stream.last_arrival = float(sorted_arrivals[ends[index]])
+            stream.packets += int(packet_counts[index])
+            stream.bytes += int(byte_counts[index])
+            stream.late += int(late_counts[index])
+            stream.sizes += sizes_counts[index]
+            stream.interarrivals += interarrival_counts[index]
+            stream.payload_types += payload_type_counts[index]
+            stream.marker_bits += marker_counts[index]
+            stream._window_bytes += window_bytes[index]
+            stream._window_packets += window_packets[index]
+            if nal_type_counts is not None:
+                stream.nal_unit_types += nal_type_counts[index]
+                stream.nal_ref_idcs += nal_ref_idc_counts[index]
+
+    def update_columns(self, columns):
+        """
+        Add the rtp packets of a capture.columns CaptureColumns
+        """
+        selected = columns.has_rtp
+        record = columns.record[selected]
+        rtp_hdr = columns.rtp[selected]
+        nalu_hdr = columns.nalu[selected]
+        fraction = 1e-9 if columns.pcap_header.timestamp_in_ns else 1e-6
+        arrival_times = record['ts_sec'] + record['ts_usec'] * fraction
+        self.update(rtp_hdr['ssrc'], arrival_times, record['orig_len'], rtp_hdr['payload_type'],
+                    rtp_hdr['marker_bit'], nalu_hdr['nal_unit_type'], nalu_hdr['nal_ref_idc'],
+                    columns.has_nalu[selected])
+
+    def update_records(self, pcap_hdr, records, batch_size=1 << 16):
+        """
+        Add the rtp packets among (record header, packet) pairs, fields are
+        collected batch_size packets at a time and added with update()
+        """
+        batch = _RecordBatch()
+        for record_hdr, packet in records:
+            batch.add(pcap_hdr, record_hdr, packet)
+            if len(batch.ssrcs) >= batch_size:
+                batch.flush(self)
+        batch.flush(self)
+
+    def update_file(self, input_file, chunk_records=1 << 20):
+        """
+        Add every rtp packet of a pcap or pcapng file, pcap is decoded
+        chunk_records packets at a time with capture.columns
+        """
+        start = input_file.tell()
+        raw_magic = input_file.read(4)
+        input_file.seek(start)
+
+        if pcapng.is_pcapng(raw_magic):
+            with pcapng.MappedPcapngFile(input_file) as capture:
+                self.update_records(capture.header, capture.records())
+            return
+
+        mapped = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for columns in capture_columns.iter_columns(mapped, chunk_records):
+                self.update_columns(columns)
+        finally:
+            mapped.close()
+
+    def to_dict(self):
+        return {
+            'window': self.window,
+            'history': self.history,
+            'size_bin_width': self.size_bin_width,
+            'interarrival_edges': INTERARRIVAL_EDGES.tolist(),
+            'streams': [self.streams[ssrc].to_dict() for ssrc in sorted(self.streams)],
+        }
+
+
+class _RecordBatch(object):
+    """
+    Rtp fields of packets pulled from the bytes one packet at a time,
+    pending a vectorized update()
+    """
+    __slots__ = ['ssrcs', 'arrival_times', 'sizes', 'payload_types', 'marker_bits',
+                 'nal_unit_types', 'nal_ref_idcs', 'has_nalu']
+
+    def __init__(self):
+        self._clear()
+
+    def _clear(self):
+        self.ssrcs = array.array('I')
+        self.arrival_times = array.array('d')
+        self.sizes = array.array('I')
+        self.payload_types = array.array('B')
+        self.marker_bits = array.array('B')
+        self.nal_unit_types = array.array('B')
+        self.nal_ref_idcs = array.array('B')
+        self.has_nalu = array.array('B')
+
+    def add(self, pcap_hdr, record_hdr, packet):
+        link = ethernet.ethernet_payload_offset(packet)
+        if link is None or link[0] != ethernet.ETHERTYPE_IPV4:
+            return
+        found = flow.flow_key(packet, link[1])
+        if found is None:
+            return
+        (key, offset, end) = found
+        # later fragments have their ports zeroed
+        if key[2] != ipv4.PROTOCOL_UDP or not (key[3] or key[4]) or end - offset < 12:
+            return
+        (first_byte, second_byte, _, _, ssrc) = _RTP_HDR.unpack_from(packet, offset)
+        if first_byte >> 6 != 2:
+            return
+        nal_offset = offset + 12 + (first_byte & 0x0F) * 4
+        if nal_offset > end:
+            return
+        if first_byte & 0x10:
+            if nal_offset + 4 <= end:
+                nal_offset += 4 + _RTP_EXTENSION_LENGTH.unpack_from(packet, nal_offset)[0] * 4
+            else:
+                nal_offset = end
+
+        self.ssrcs.append(ssrc)
+        self.arrival_times.append(pcap.record_timestamp(pcap_hdr, record_hdr))
+        self.sizes.append(record_hdr.orig_len)
+        self.payload_types.append(second_byte & 0x7F)
+        self.marker_bits.append(second_byte >> 7)
+        if nal_offset < end:
+            nal_byte = packet[nal_offset]
+            if not isinstance(nal_byte, int):
+                nal_byte = ord(nal_byte)
+            self.nal_unit_types.append(nal_byte & 0x1F)
+            self.nal_ref_idcs.append((nal_byte >> 5) & 0x03)
+            self.has_nalu.append(1)
+        else:
+            self.nal_unit_types.append(0)
+            self.nal_ref_idcs.append(0)
+            self.has_nalu.append(0)
+
+    def flush(self, histograms):
+        if not len(self.ssrcs):
+            return
+        histograms.update(np.frombuffer(self.ssrcs, np.uint32), np.frombuffer(self.arrival_times),
+                          np.frombuffer(self.sizes, np.uint32), np.frombuffer(self.payload_types, np.uint8),
+                          np.frombuffer(self.marker_bits, np.uint8), np.frombuffer(self.nal_unit_types, np.uint8),
+                          np.frombuffer(self.nal_ref_idcs, np.uint8), np.frombuffer(self.has_nalu, np.uint8))
+        self._clear()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('input')
+    parser.add_argument('--window', type=float, default=1.0, help='seconds per time window')
+    parser.add_argument('--history', type=int, default=3600, help='time windows kept per stream')
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    args = parser.parse_args(argv)
+
+    histograms = RtpHistograms(args.window, args.history)
+    with open(args.input, 'rb') as input_file:
+        histograms.update_file(input_file)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(histograms.to_dict(), output_file, indent=2)
+    else:
+        json.dump(histograms.to_dict(), sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
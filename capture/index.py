@@ -0,0 +1,262 @@
+"""
+Persistent packet offset index for random access into large captures
+
+The index is a sidecar file next to the capture holding one fixed-size
+entry per record: byte offset of the record header, ts_sec, ts_usec,
+incl_len, the IPv4/UDP 5-tuple and the RTP SSRC. Packet N is found with
+one unpack at a computed offset, a timestamp with a binary search over the
+entries.
+
+The sidecar remembers the size and mtime of the capture it was built from,
+a stale index is rebuilt transparently by open_index().
+
+with open_index('big.pcap') as index, open('big.pcap', 'rb') as fp:
+    first = index.find_time(1434000000, 0)
+    for record_hdr, packet in index.records(fp, first):
+        ...
+"""
+
+import logging
+import mmap
+import os
+import struct
+
+from network import ethernet
+from network import flow
+from network import ipv4
+from network import pcap
+
+__author__ = 'wmoorefi'
+
+INDEX_SUFFIX = '.pidx'
+
+_INDEX_MAGIC = b'PIDX'
+# bumped when what an entry holds changes, older indexes are rebuilt
+_INDEX_VERSION = 2
+
+# magic, version, capture size, capture mtime, entry count
+_INDEX_HDR = struct.Struct('<4sIQdQ')
+# offset, ts_sec, ts_usec, incl_len, source_ip, destination_ip,
+# source_port, destination_port, protocol, ssrc
+_INDEX_ENTRY = struct.Struct('<QIIIIIHHB3xI')
+_INDEX_TS = struct.Struct('<8xII')
+# first byte and ssrc of the rtp header
+_RTP_HDR = struct.Struct('>B7xI')
+
+_module_logger = logging.getLogger(__name__)
+
+
+class IndexEntry(object):
+    """
+    One record of the index, offset is the position of the record header
+    in the capture, addresses are uint32 in network order
+    """
+    __slots__ = ['offset', 'ts_sec', 'ts_usec', 'incl_len', 'source_ip',
+                 'destination_ip', 'source_port', 'destination_port', 'protocol',
+                 'ssrc']
+
+    def __init__(self, offset, ts_sec, ts_usec, incl_len, source_ip,
+                 destination_ip, source_port, destination_port, protocol,
+                 ssrc):
+        self.offset = offset
+        self.ts_sec = ts_sec
+        self.ts_usec = ts_usec
+        self.incl_len = incl_len
+        self.source_ip = source_ip
+        self.destination_ip = destination_ip
+        self.source_port = source_port
+        self.destination_port = destination_port
+        self.protocol = protocol
+        self.ssrc = ssrc
+
+
+class PacketIndex(object):
+    """
+    Read-only view of an index sidecar file
+    """
+    __slots__ = ['path', '_file', '_mapped', '_count']
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mapped = None
+        try:
+            self._mapped = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            (magic, version, size, mtime, count) = _INDEX_HDR.unpack_from(self._mapped, 0)
+            if magic != _INDEX_MAGIC or version != _INDEX_VERSION:
+                raise Exception('Invalid packet index %s' % path)
+            if len(self._mapped) < _INDEX_HDR.size + count * _INDEX_ENTRY.size:
+                raise Exception('Truncated packet index %s' % path)
+        except Exception:
+            if self._mapped is not None:
+                self._mapped.close()
+            self._file.close()
+            raise
+        self._count = count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        self._mapped.close()
+        self._file.close()
+
+    def entry(self, packet_number):
+        """
+        Index entry of packet_number, O(1)
+        """
+        if not 0 <= packet_number < self._count:
+            raise IndexError('packet %d out of range' % packet_number)
+        return IndexEntry(*_INDEX_ENTRY.unpack_from(self._mapped,
+                                                    _INDEX_HDR.size + packet_number * _INDEX_ENTRY.size))
+
+    def offset(self, packet_number):
+        """
+        Byte offset of the record header of packet_number in the capture
+        """
+        return self.entry(packet_number).offset
+
+    def find_time(self, ts_sec, ts_usec=0):
+        """
+        Number of the first packet at or after the timestamp, len(self) when
+        every packet is older. Timestamps are compared in the units of the
+        capture (ts_usec holds nanoseconds for nanosecond captures) and are
+        expected to be non-decreasing in capture order. O(log n)
+        """
+        target = (ts_sec, ts_usec)
+        low = 0
+        high = self._count
+        while low < high:
+            middle = (low + high) // 2
+            if _INDEX_TS.unpack_from(self._mapped, _INDEX_HDR.size + middle * _INDEX_ENTRY.size) < target:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def records(self, input_file, start=0, stop=None):
+        """
+        Seek input_file to packet start and read records up to stop with the
+        stream reader, yields (record header, packet data). The capture
+        header is read from the start of input_file, wherever it was left.
+        """
+        if stop is None:
+            stop = self._count
+        if start >= stop:
+            return
+
+        input_file.seek(0)
+        pcap_hdr = pcap.read_pcap_header(input_file)
+        input_file.seek(self.offset(start))
+        for packet_number in range(start, stop):
+            pcap_record = pcap.read_pcap_record(pcap_hdr, input_file)
+            if pcap_record is None:
+                break
+            yield pcap_record, input_file.read(pcap_record.incl_len)
+
+
+def index_path_for(capture_path):
+    return capture_path + INDEX_SUFFIX
+
+
+def _capture_stamp(capture_path):
+    stat = os.stat(capture_path)
+    return stat.st_size, stat.st_mtime
+
+
+def _flow_fields(packet):
+    """
+    source ip, destination ip, source port, destination port, protocol and
+    ssrc of a packet, zero for the layers it does not have. Ports and ssrc
+    are zero for udp fragments after the first.
+    """
+    link = ethernet.ethernet_payload_offset(packet)
+    if link is None or link[0] != ethernet.ETHERTYPE_IPV4:
+        return 0, 0, 0, 0, 0, 0
+    found = flow.flow_key(packet, link[1])
+    if found is None:
+        return 0, 0, 0, 0, 0, 0
+
+    ((source_ip, destination_ip, protocol, source_port, destination_port), payload_offset, end) = found
+    if protocol != ipv4.PROTOCOL_UDP:
+        return source_ip, destination_ip, 0, 0, protocol, 0
+
+    ssrc = 0
+    if (source_port or destination_port) and end - payload_offset >= _RTP_HDR.size:
+        (first_byte, rtp_ssrc) = _RTP_HDR.unpack_from(packet, payload_offset)
+        if first_byte >> 6 == 2:
+            ssrc = rtp_ssrc
+    return source_ip, destination_ip, source_port, destination_port, protocol, ssrc
+
+
+def build_index(capture_path, index_path=None):
+    """
+    Scan the capture once and write its index sidecar, returns the path of
+    the index
+    """
+    if index_path is None:
+        index_path = index_path_for(capture_path)
+    size, mtime = _capture_stamp(capture_path)
+
+    temp_path = index_path + '.tmp'
+    count = 0
+    try:
+        with open(capture_path, 'rb') as input_file, open(temp_path, 'wb') as output_file:
+            output_file.write(_INDEX_HDR.pack(_INDEX_MAGIC, _INDEX_VERSION, size, mtime, 0))
+            with pcap.MappedPcapFile(input_file) as capture:
+                offset = pcap.PCAP_HDR_LENGTH
+                for record_hdr, packet in capture.records():
+                    output_file.write(_INDEX_ENTRY.pack(offset, record_hdr.ts_sec, record_hdr.ts_usec,
+                                                        record_hdr.incl_len, *_flow_fields(packet)))
+                    offset += pcap.PCAPREC_HDR_LENGTH + record_hdr.incl_len
+                    count += 1
+            output_file.seek(0)
+            output_file.write(_INDEX_HDR.pack(_INDEX_MAGIC, _INDEX_VERSION, size, mtime, count))
+        os.rename(temp_path, index_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    _module_logger.info('indexed %d records of %s', count, capture_path)
+
+    return index_path
+
+
+def load_index(capture_path, index_path=None):
+    """
+    Open the index sidecar of a capture, returns None when it is missing or
+    was built for a different size or mtime of the capture
+    """
+    if index_path is None:
+        index_path = index_path_for(capture_path)
+    if not os.path.exists(index_path):
+        return
+
+    with open(index_path, 'rb') as index_file:
+        raw_header = index_file.read(_INDEX_HDR.size)
+    if len(raw_header) < _INDEX_HDR.size:
+        return
+    (magic, version, size, mtime, count) = _INDEX_HDR.unpack(raw_header)
+    if magic != _INDEX_MAGIC or version != _INDEX_VERSION:
+        return
+    if (size, mtime) != _capture_stamp(capture_path):
+        _module_logger.info('index %s is stale', index_path)
+        return
+
+    return PacketIndex(index_path)
+
+
+def open_index(capture_path, index_path=None):
+    """
+    Open the index of a capture, building or rebuilding it first when needed
+    """
+    packet_index = load_index(capture_path, index_path)
+    if packet_index is None:
+        packet_index = PacketIndex(build_index(capture_path, index_path))
+    return packet_index
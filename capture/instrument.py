@@ -0,0 +1,248 @@
+"""
+Per layer decode counters and timing
+
+enable() swaps the module level decoders of every layer (pcap/pcapng record
+framing, ethernet, ipv4, udp, rtp, nalu) for counting wrappers, disable()
+puts the originals back. Nothing is wrapped until enable() is called so a
+disabled run costs nothing. Callers have to reach the decoders through
+their module, ipv4.unpack_ipv4_header rather than a name imported from it,
+which is how the rest of this project calls them.
+
+The unpack_* functions are wrapped, the read_* stream functions delegate to
+them so both paths are counted. Per layer are kept the calls, bytes of
+header decoded, cumulative seconds spent, short reads (the decoder
+returned None) and malformed headers (the decoder raised or the header
+fails a sanity check, e.g. an rtp version other than 2).
+
+stats = instrument.enable(interval=10)  # log a snapshot every 10 seconds
+...
+print(instrument.disable().snapshot())
+"""
+
+import collections
+import json
+import logging
+import threading
+import time
+
+from h264 import nalu
+from network import ethernet
+from network import ipv4
+from network import pcap
+from network import pcapng
+from network import rtp
+from network import udp
+
+__author__ = 'wmoorefi'
+
+LAYERS = ['pcap', 'ethernet', 'ipv4', 'udp', 'rtp', 'nalu']
+
+_module_logger = logging.getLogger(__name__)
+
+
+def _valid_ipv4(ipv4_hdr):
+    return ipv4_hdr.version == 4 and ipv4_hdr.internet_hdr_length >= 20
+
+
+def _valid_udp(udp_hdr):
+    return udp_hdr.length >= 8
+
+
+def _valid_rtp(rtp_hdr):
+    return rtp_hdr.version == 2
+
+
+def _valid_nalu(nalu_hdr):
+    return not nalu_hdr.forbidden_zero_bit
+
+
+def _record_header_length(record_hdr):
+    return pcap.PCAPREC_HDR_LENGTH
+
+
+# (module, function, layer, header length, validator), unpack functions
+# return a header
+_UNPACK_FUNCTIONS = [
+    (pcap, 'unpack_pcap_record', 'pcap', _record_header_length, None),
+    (ethernet, 'unpack_ethernet_header', 'ethernet', len, None),
+    (ipv4, 'unpack_ipv4_header', 'ipv4', len, _valid_ipv4),
+    (udp, 'unpack_udp_header', 'udp', len, _valid_udp),
+    (rtp, 'unpack_rtp_header', 'rtp', len, _valid_rtp),
+    (nalu, 'unpack_nalu_header', 'nalu', len, _valid_nalu),
+]
+
+# (module, function, layer), record generators yield a record header or
+# (record header, packet)
+_RECORD_GENERATORS = [
+    (pcap, 'iter_pcap_records', 'pcap'),
+    (pcapng, 'iter_pcapng_records', 'pcap'),
+    (pcapng, 'read_pcapng_records', 'pcap'),
+]
+
+
+class LayerStats(object):
+    __slots__ = ['calls', 'bytes', 'seconds', 'short', 'malformed']
+
+    def __init__(self):
+        self.calls = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.short = 0
+        self.malformed = 0
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class DecodeStats(object):
+    """
+    LayerStats of every layer, started is the wall clock time of enable()
+    """
+    __slots__ = ['layers', 'started']
+
+    def __init__(self):
+        self.layers = collections.OrderedDict((layer, LayerStats()) for layer in LAYERS)
+        self.started = time.time()
+
+    def snapshot(self):
+        """
+        Point in time copy of the counters as a dict, ready for json
+        """
+        now = time.time()
+        return {
+            'time': now,
+            'elapsed': now - self.started,
+            'layers': collections.OrderedDict((layer, stats.to_dict()) for layer, stats in self.layers.items()),
+        }
+
+
+def _instrument_unpack(function, stats, header_length, validator):
+    perf_counter = time.perf_counter
+
+    def instrumented(*args):
+        start = perf_counter()
+        try:
+            header = function(*args)
+        except Exception:
+            stats.seconds += perf_counter() - start
+            stats.calls += 1
+            stats.malformed += 1
+            raise
+        stats.seconds += perf_counter() - start
+        stats.calls += 1
+        if header is None:
+            stats.short += 1
+        else:
+            stats.bytes += header_length(header)
+            if validator is not None and not validator(header):
+                stats.malformed += 1
+        return header
+
+    instrumented.__wrapped__ = function
+    return instrumented
+
+
+def _instrument_records(function, stats):
+    perf_counter = time.perf_counter
+
+    def instrumented(*args, **kwargs):
+        records = function(*args, **kwargs)
+        while True:
+            start = perf_counter()
+            try:
+                item = next(records)
+            except StopIteration:
+                stats.seconds += perf_counter() - start
+                return
+            stats.seconds += perf_counter() - start
+            record_hdr = item[0] if isinstance(item, tuple) else item
+            stats.calls += 1
+            stats.bytes += record_hdr.incl_len
+            if record_hdr.incl_len > record_hdr.orig_len:
+                stats.malformed += 1
+            yield item
+
+    instrumented.__wrapped__ = function
+    return instrumented
+
+
+class _Reporter(threading.Thread):
+    """
+    Calls sink with a snapshot every interval seconds until stopped
+    """
+
+    def __init__(self, stats, interval, sink):
+        threading.Thread.__init__(self, name='decode-stats')
+        self.daemon = True
+        self.stats = stats
+        self.interval = interval
+        self.sink = sink
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.sink(self.stats.snapshot())
+
+
+def log_snapshot(snapshot):
+    """
+    Default snapshot sink, one INFO line of json
+    """
+    _module_logger.info('decode stats %s', json.dumps(snapshot))
+
+
+_state = {'stats': None, 'originals': [], 'reporter': None}
+
+
+def enabled():
+    return _state['stats'] is not None
+
+
+def enable(interval=None, sink=log_snapshot):
+    """
+    Start counting, returns the DecodeStats being updated. With an interval
+    in seconds sink is called with a snapshot from a background thread that
+    often, by default logged at INFO.
+    """
+    if enabled():
+        return _state['stats']
+
+    stats = DecodeStats()
+    originals = []
+    for (module, name, layer, header_length, validator) in _UNPACK_FUNCTIONS:
+        function = getattr(module, name)
+        originals.append((module, name, function))
+        setattr(module, name, _instrument_unpack(function, stats.layers[layer], header_length, validator))
+    for (module, name, layer) in _RECORD_GENERATORS:
+        function = getattr(module, name)
+        originals.append((module, name, function))
+        setattr(module, name, _instrument_records(function, stats.layers[layer]))
+
+    _state['stats'] = stats
+    _state['originals'] = originals
+    if interval:
+        _state['reporter'] = _Reporter(stats, interval, sink)
+        _state['reporter'].start()
+    return stats
+
+
+def disable():
+    """
+    Stop counting and restore the decoders, returns the final DecodeStats
+    or None when counting was not enabled
+    """
+    stats = _state['stats']
+    if stats is None:
+        return
+
+    reporter = _state['reporter']
+    if reporter is not None:
+        reporter.stopped.set()
+        reporter.join()
+    for (module, name, function) in _state['originals']:
+        setattr(module, name, function)
+
+    _state['stats'] = None
+    _state['originals'] = []
+    _state['reporter'] = None
+    return stats
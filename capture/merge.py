@@ -0,0 +1,183 @@
+"""
+Time ordered merge of several captures of the same session, taps or the
+files of a ring buffer, without loading them
+
+Every input is read as a stream and contributes a single pending record to
+a heap keyed on its UTC capture time in nanoseconds, so memory does not
+grow with the length of the captures.
+
+with CaptureMerger(['tap1.pcap', 'tap2.pcap']) as merger:
+    for timestamp_ns, source, record_hdr, packet in merger.records():
+        ...
+    # or
+    with open('merged.pcap', 'wb') as fp:
+        merger.write(fp)
+
+python -m capture.merge merged.pcap tap1.pcap tap2.pcap
+"""
+
+import heapq
+import logging
+import sys
+
+from network import pcap
+from network import pcapng
+
+__author__ = 'wmoorefi'
+
+_module_logger = logging.getLogger(__name__)
+
+
+def _read_header(input_file):
+    start = input_file.tell()
+    raw_magic = input_file.read(4)
+    input_file.seek(start)
+
+    if pcapng.is_pcapng(raw_magic):
+        pcap_hdr = pcapng.read_pcapng_header(input_file)
+        # link type and snaplen come from the first interface description
+        if not pcap_hdr.network and not pcap_hdr.snaplen:
+            raise Exception('Unable to merge pcapng capture without an interface description block')
+        return pcap_hdr
+    return pcap.read_pcap_header(input_file)
+
+
+def _stream_records(pcap_hdr, input_file):
+    """
+    (record header, packet bytes) of every record of a stream positioned
+    after the pcap header
+    """
+    if pcap_hdr.magic_number == pcapng.BLOCKTYPE_SECTION_HEADER:
+        for record_hdr in pcapng.read_pcapng_records(pcap_hdr, input_file):
+            packet = input_file.read(record_hdr.incl_len)
+            if len(packet) < record_hdr.incl_len:
+                return
+            yield record_hdr, packet
+        return
+
+    while True:
+        record_hdr = pcap.read_pcap_record(pcap_hdr, input_file)
+        if record_hdr is None:
+            return
+        packet = input_file.read(record_hdr.incl_len)
+        if len(packet) < record_hdr.incl_len:
+            _module_logger.warning('truncated record, %d of %d bytes present', len(packet), record_hdr.incl_len)
+            return
+        yield record_hdr, packet
+
+
+def utc_timestamp_ns(pcap_hdr, record_hdr):
+    """
+    Capture time of a record in integer nanoseconds since the epoch, UTC,
+    honoring nanosecond captures and the thiszone correction
+    """
+    fraction = record_hdr.ts_usec if pcap_hdr.timestamp_in_ns else record_hdr.ts_usec * 1000
+    return (record_hdr.ts_sec + pcap_hdr.thiszone) * 1000000000 + fraction
+
+
+class CaptureMerger(object):
+    """
+    Merge of the captures at paths, the files stay open until close().
+    Records with equal timestamps come out in the order of paths.
+    """
+    __slots__ = ['paths', 'headers', '_files']
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.headers = []
+        self._files = []
+        try:
+            for path in self.paths:
+                input_file = open(path, 'rb')
+                self._files.append(input_file)
+                self.headers.append(_read_header(input_file))
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def records(self):
+        """
+        Yields (timestamp_ns, source, record header, packet bytes) in
+        timestamp order, source is the index of the input in paths and the
+        record header is as read from it
+        """
+        heap = []
+        readers = []
+        for source, (pcap_hdr, input_file) in enumerate(zip(self.headers, self._files)):
+            reader = _stream_records(pcap_hdr, input_file)
+            readers.append(reader)
+            for record_hdr, packet in reader:
+                heap.append((utc_timestamp_ns(pcap_hdr, record_hdr), source, record_hdr, packet))
+                break
+        heapq.heapify(heap)
+
+        while heap:
+            entry = heap[0]
+            source = entry[1]
+            yield entry
+
+            for record_hdr, packet in readers[source]:
+                heapq.heapreplace(heap, (utc_timestamp_ns(self.headers[source], record_hdr),
+                                         source, record_hdr, packet))
+                break
+            else:
+                heapq.heappop(heap)
+
+    def merged_header(self, timestamp_in_ns=None):
+        """
+        PcapHeader for the merged capture, UTC timestamps in nanoseconds if
+        any input has them unless timestamp_in_ns says otherwise. Raises
+        when the inputs have different link types. The snaplen is the
+        largest of the inputs, a pcapng interface without a limit counts as
+        pcap.MAX_SNAPLEN.
+        """
+        networks = set([pcap_hdr.network for pcap_hdr in self.headers])
+        if len(networks) > 1:
+            raise Exception('Unable to merge captures of link types %s' % sorted(networks))
+        if timestamp_in_ns is None:
+            timestamp_in_ns = any([pcap_hdr.timestamp_in_ns for pcap_hdr in self.headers])
+        snaplen = max([pcap_hdr.snaplen or pcap.MAX_SNAPLEN for pcap_hdr in self.headers] or [65535])
+        return pcap.new_pcap_header(networks.pop() if networks else 1, snaplen, timestamp_in_ns)
+
+    def write(self, output_file, timestamp_in_ns=None):
+        """
+        Write the merged capture to stream as pcap, returns the number of
+        records written
+        """
+        out_hdr = self.merged_header(timestamp_in_ns)
+        fraction_ns = 1 if out_hdr.timestamp_in_ns else 1000
+
+        with pcap.PcapWriter(output_file, out_hdr) as writer:
+            for timestamp_ns, source, record_hdr, packet in self.records():
+                (ts_sec, fraction) = divmod(timestamp_ns, 1000000000)
+                writer.write_record(pcap.PcapRecordHeader(ts_sec, fraction // fraction_ns,
+                                                          record_hdr.incl_len, record_hdr.orig_len),
+                                    packet)
+        return writer.records
+
+    def close(self):
+        for input_file in self._files:
+            input_file.close()
+        self._files = []
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) < 2:
+        sys.stderr.write('usage: python -m capture.merge OUTPUT INPUT...\n')
+        return 2
+
+    with CaptureMerger(argv[1:]) as merger, open(argv[0], 'wb') as output_file:
+        count = merger.write(output_file)
+    _module_logger.info('merged %d records into %s', count, argv[0])
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,226 @@
+"""
+Parallel multi-process decoding of a pcap capture
+
+The capture is cut into byte ranges of about chunk_bytes by size alone,
+each range is decoded in a multiprocessing worker with the network/h264
+parsers and the per-range results are merged back in capture order. The
+parent never reads the capture, a worker finds the first record header of
+its range itself by resyncing: from the start of the range it looks for an
+offset where RESYNC_RECORDS plausible record headers chain one after the
+other. A worker decodes the records starting inside its range, the last
+one may run past its end, and reports where it stopped so the merge can
+check that neighbouring ranges met on the same record. A range that was
+resynced to anything else, record headers can chain through packet data
+by chance, is decoded again from where its predecessor stopped.
+
+for record_hdr, layers in parallel_decode('test.pcap', workers=8):
+    ...
+
+Decoders run in the worker processes so they must be module-level
+functions and return picklable values. Returning None drops the packet,
+filtering or reducing inside the decoder keeps the result traffic between
+processes small, which is what lets the decode scale with the worker count.
+At most two ranges per worker are in flight, so the results held in memory
+stay bounded by chunk_bytes however large the capture.
+"""
+
+import collections
+import itertools
+import logging
+import multiprocessing
+import os
+
+from network import ethernet
+from network import ipv4
+from network import pcap
+from network import rtp
+from network import udp
+from h264 import nalu
+
+__author__ = 'wmoorefi'
+
+# record headers that have to chain for a resync to accept an offset, and
+# how far apart in seconds their timestamps may be
+RESYNC_RECORDS = 8
+RESYNC_SECONDS = 3600
+
+_module_logger = logging.getLogger(__name__)
+
+
+def decode_packet(pcap_hdr, record_hdr, packet):
+    """
+    Default decoder, the same layer chain as pcapfile.py: ethernet, ipv4,
+    udp, then rtp and the NAL unit header assumed as the udp payload.
+    Returns (record header, [headers]) with the headers that were present,
+    IPv4 fragments after the first stop at ipv4
+    """
+    layers = []
+    eth_hdr = ethernet.unpack_ethernet_header(packet, 0, pcap_hdr.byte_swap)
+    if eth_hdr is None:
+        return record_hdr, layers
+    layers.append(eth_hdr)
+    offset = len(eth_hdr)
+
+    if eth_hdr.payload_ethertype != ethernet.ETHERTYPE_IPV4:
+        return record_hdr, layers
+    ipv4_hdr = ipv4.unpack_ipv4_header(packet, offset, pcap_hdr.byte_swap)
+    if ipv4_hdr is None:
+        return record_hdr, layers
+    layers.append(ipv4_hdr)
+    if ipv4_hdr.protocol != ipv4.PROTOCOL_UDP or ipv4_hdr.fragment_offset:
+        return record_hdr, layers
+    # leave any ethernet trailer out of the upper layers
+    if offset + ipv4_hdr.total_length < len(packet):
+        packet = packet[:offset + ipv4_hdr.total_length]
+    offset += len(ipv4_hdr)
+
+    udp_hdr = udp.unpack_udp_header(packet, offset, pcap_hdr.byte_swap)
+    if udp_hdr is None:
+        return record_hdr, layers
+    layers.append(udp_hdr)
+    offset += len(udp_hdr)
+
+    rtp_hdr = rtp.unpack_rtp_header(packet, offset, pcap_hdr.byte_swap)
+    if rtp_hdr is None:
+        return record_hdr, layers
+    layers.append(rtp_hdr)
+    offset += len(rtp_hdr)
+
+    nalu_hdr = nalu.unpack_nalu_header(packet, offset, pcap_hdr.byte_swap)
+    if nalu_hdr is not None:
+        layers.append(nalu_hdr)
+
+    return record_hdr, layers
+
+
+def split_ranges(capture_size, chunk_bytes):
+    """
+    Cut a capture of capture_size bytes into (start, end) byte ranges of
+    about chunk_bytes, only the first start is a record boundary, workers
+    resync to the others
+    """
+    chunk_bytes = max(1, chunk_bytes)
+    starts = list(range(pcap.PCAP_HDR_LENGTH, capture_size, chunk_bytes)) or [pcap.PCAP_HDR_LENGTH]
+    return list(zip(starts, starts[1:] + [max(capture_size, pcap.PCAP_HDR_LENGTH)]))
+
+
+def resync(pcap_hdr, buffer, offset):
+    """
+    Offset of the first record header at or after offset. An offset is
+    accepted when RESYNC_RECORDS headers chain from it, or the chain reaches
+    the end of buffer, at least two headers when it ends in a truncated
+    record, every one with a valid timestamp fraction, a ts_sec
+    within RESYNC_SECONDS of the first and 0 < incl_len <= orig_len, incl_len
+    within the snaplen. Returns len(buffer) when no offset is accepted.
+    """
+    end = len(buffer)
+    unpack_record = pcap.record_header_struct(pcap_hdr).unpack_from
+    max_fraction = 1000000000 if pcap_hdr.timestamp_in_ns else 1000000
+    max_length = max(pcap_hdr.snaplen, pcap.MAX_SNAPLEN)
+
+    while end - offset >= pcap.PCAPREC_HDR_LENGTH:
+        first_sec = unpack_record(buffer, offset)[0]
+        candidate = offset
+        for chained in range(RESYNC_RECORDS):
+            if end - candidate < pcap.PCAPREC_HDR_LENGTH:
+                if candidate == end or chained > 1:
+                    return offset  # chained to the end of the capture or into a truncated record
+                break
+            (ts_sec, ts_fraction, incl_len, orig_len) = unpack_record(buffer, candidate)
+            if (ts_fraction >= max_fraction or not 0 < incl_len <= orig_len or incl_len > max_length or
+                    abs(ts_sec - first_sec) > RESYNC_SECONDS):
+                break
+            candidate += pcap.PCAPREC_HDR_LENGTH + incl_len
+        else:
+            return offset
+        offset += 1
+    return end
+
+
+def _decode_range(task, resync_start=True):
+    """
+    (first record offset, stop offset, results) of the records starting in
+    [start, end), the stop offset is that of the first record at or after
+    end, None when the records ran out before it. start is taken as a
+    record boundary when resync_start is false.
+    """
+    (capture_path, start, end, decoder) = task
+    results = []
+    with open(capture_path, 'rb') as input_file:
+        with pcap.MappedPcapFile(input_file) as capture:
+            pcap_hdr = capture.header
+            buffer = capture.buffer
+            if resync_start and start > pcap.PCAP_HDR_LENGTH:
+                start = resync(pcap_hdr, buffer, start)
+            offset = start
+            for record_hdr, packet in pcap.iter_pcap_records(pcap_hdr, buffer, start):
+                if offset >= end:
+                    break
+                offset += pcap.PCAPREC_HDR_LENGTH + record_hdr.incl_len
+                result = decoder(pcap_hdr, record_hdr, packet)
+                if result is not None:
+                    results.append(result)
+            else:
+                offset = None
+            packet = None
+    return start, offset, results
+
+
+def _merge(batches):
+    """
+    Yield the results of (task, (start, stop, results)) batches in capture
+    order until the records run out. Each range has to start on the record
+    its predecessor stopped at, the walk from the first record never loses
+    sync, so a range whose resync landed elsewhere is decoded again from
+    there.
+    """
+    stop = pcap.PCAP_HDR_LENGTH
+    for (task, (start, next_stop, results)) in batches:
+        if start != stop:
+            _module_logger.info('range at %d resynced to %d instead of %d, decoding it again',
+                                task[1], start, stop)
+            (capture_path, _, end, decoder) = task
+            (start, next_stop, results) = _decode_range((capture_path, stop, end, decoder), False)
+        for result in results:
+            yield result
+        if next_stop is None:
+            break  # end of the capture or a truncated record, later ranges hold no records
+        stop = next_stop
+
+
+def _pool_batches(pool, tasks, in_flight):
+    tasks = iter(tasks)
+    pending = collections.deque((task, pool.apply_async(_decode_range, (task,)))
+                                for task in itertools.islice(tasks, in_flight))
+    while pending:
+        (task, result) = pending.popleft()
+        batch = result.get()
+        for next_task in itertools.islice(tasks, 1):
+            pending.append((next_task, pool.apply_async(_decode_range, (next_task,))))
+        yield task, batch
+
+
+def parallel_decode(capture_path, decoder=decode_packet, workers=None, chunk_bytes=16 << 20):
+    """
+    Decode a capture in a pool of worker processes, yields the decoder
+    results in capture order. workers defaults to the number of CPUs.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    capture_path = os.path.abspath(capture_path)
+    ranges = split_ranges(os.path.getsize(capture_path), chunk_bytes)
+    tasks = [(capture_path, start, end, decoder) for (start, end) in ranges]
+
+    if workers == 1:
+        for result in _merge((task, _decode_range(task)) for task in tasks):
+            yield result
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in _merge(_pool_batches(pool, tasks, 2 * workers)):
+            yield result
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
@@ -0,0 +1,226 @@
+"""
+Cut a capture by time range, capture filter or SSRC and optionally strip
+the packet payloads, keeping only the protocol headers
+
+The input is memory-mapped. Records that are kept unchanged are copied from
+the map to the output as they are, record header included, and runs of
+consecutive kept records go out in a single write, so a slice that keeps
+most of a capture costs about as much as copying the file. Only records that
+are truncated get a new record header.
+
+python -m capture.slicer in.pcap out.pcap --start 1440000000 --end 1440000060
+python -m capture.slicer in.pcap out.pcap --ssrc 0x1234 --strip-payload
+python -m capture.slicer in.pcap out.pcap --filter "udp.destination_port == 20010"
+"""
+
+import argparse
+import logging
+import struct
+import sys
+
+from network import ethernet
+from network import filter as capture_filter
+from network import flow
+from network import ipv4
+from network import pcap
+from network import pcapng
+
+__author__ = 'wmoorefi'
+
+_RTP_FIRST_BYTE = struct.Struct('>B')
+_RTP_EXTENSION_LENGTH = struct.Struct('>2xH')
+
+_module_logger = logging.getLogger(__name__)
+
+
+def header_length(packet):
+    """
+    Bytes of packet taken by protocol headers: ethernet with its vlan tags,
+    ipv4 with options, udp and, when the udp payload looks like rtp, the rtp
+    header with its csrc list and extension
+    """
+    link = ethernet.ethernet_payload_offset(packet)
+    if link is None:
+        return len(packet)
+    (ethertype, offset) = link
+    if ethertype != ethernet.ETHERTYPE_IPV4:
+        return offset
+
+    found = flow.flow_key(packet, offset)
+    if found is None:
+        return offset
+    (key, payload_offset, end) = found
+    if key[2] != ipv4.PROTOCOL_UDP or end - payload_offset < 12:
+        return payload_offset
+
+    first_byte = _RTP_FIRST_BYTE.unpack_from(packet, payload_offset)[0]
+    if first_byte >> 6 != 2:
+        return payload_offset
+    length = 12 + (first_byte & 0x0F) * 4
+    if first_byte & 0x10 and end - payload_offset >= length + 4:
+        length += 4 + _RTP_EXTENSION_LENGTH.unpack_from(packet, payload_offset + length)[0] * 4
+    return min(payload_offset + length, end)
+
+
+def _time_key(pcap_hdr, ts_sec, ts_usec):
+    return ts_sec * 1000000000 + (ts_usec if pcap_hdr.timestamp_in_ns else ts_usec * 1000)
+
+
+class Slicer(object):
+    """
+    Record selection and rewriting, start and end are capture times in
+    seconds, end excluded, predicate is a CaptureFilter or any callable
+    taking the packet data
+    """
+    __slots__ = ['start', 'end', 'predicate', 'strip_payload', 'snaplen']
+
+    def __init__(self, start=None, end=None, predicate=None, strip_payload=False, snaplen=None):
+        self.start = start
+        self.end = end
+        self.predicate = predicate
+        self.strip_payload = strip_payload
+        self.snaplen = snaplen
+
+    def _time_bounds(self):
+        start = None if self.start is None else int(round(self.start * 1e9))
+        end = None if self.end is None else int(round(self.end * 1e9))
+        return start, end
+
+    def slice_pcap(self, pcap_hdr, buffer, writer, offset=pcap.PCAP_HDR_LENGTH):
+        """
+        Copy the selected records of a pcap capture held in buffer to writer,
+        returns the number of records written
+        """
+        view = memoryview(buffer)
+        end = len(view)
+        unpack_record = pcap.record_header_struct(pcap_hdr).unpack_from
+        (start_ns, end_ns) = self._time_bounds()
+        predicate = self.predicate
+        strip_payload = self.strip_payload
+        snaplen = writer.header.snaplen
+
+        run_start = run_end = offset
+        run_records = 0
+        written = 0
+        while offset + pcap.PCAPREC_HDR_LENGTH <= end:
+            (ts_sec, ts_usec, incl_len, orig_len) = unpack_record(view, offset)
+            data_offset = offset + pcap.PCAPREC_HDR_LENGTH
+            next_offset = data_offset + incl_len
+            if next_offset > end:
+                _module_logger.warning('[%d] truncated record, %d of %d bytes present',
+                                       data_offset, end - data_offset, incl_len)
+                break
+
+            keep = True
+            if start_ns is not None or end_ns is not None:
+                timestamp = _time_key(pcap_hdr, ts_sec, ts_usec)
+                keep = ((start_ns is None or timestamp >= start_ns) and
+                        (end_ns is None or timestamp < end_ns))
+            if keep and predicate is not None:
+                keep = predicate(view[data_offset:next_offset])
+
+            if keep:
+                length = incl_len
+                if strip_payload:
+                    length = header_length(view[data_offset:next_offset])
+                length = min(length, snaplen)
+
+                if length == incl_len and offset == run_end:
+                    # unchanged and adjacent to the pending run
+                    run_end = next_offset
+                    run_records += 1
+                else:
+                    if run_records:
+                        writer.write_raw(view[run_start:run_end], run_records)
+                        written += run_records
+                    if length == incl_len:
+                        run_start = offset
+                        run_end = next_offset
+                        run_records = 1
+                    else:
+                        run_records = 0
+                        writer.write_record(pcap.PcapRecordHeader(ts_sec, ts_usec, length, orig_len),
+                                            view[data_offset:data_offset + length])
+                        written += 1
+            offset = next_offset
+
+        if run_records:
+            writer.write_raw(view[run_start:run_end], run_records)
+            written += run_records
+        return written
+
+    def slice_records(self, pcap_hdr, records, writer):
+        """
+        Write the selected (record header, packet) pairs through writer with
+        fresh record headers, for inputs that are not in pcap framing
+        """
+        (start_ns, end_ns) = self._time_bounds()
+        written = 0
+        for record_hdr, packet in records:
+            if start_ns is not None or end_ns is not None:
+                timestamp = _time_key(pcap_hdr, record_hdr.ts_sec, record_hdr.ts_usec)
+                if (start_ns is not None and timestamp < start_ns) or (end_ns is not None and timestamp >= end_ns):
+                    continue
+            if self.predicate is not None and not self.predicate(packet):
+                continue
+            length = header_length(packet) if self.strip_payload else record_hdr.incl_len
+            writer.write_record(pcap.PcapRecordHeader(record_hdr.ts_sec, record_hdr.ts_usec,
+                                                      length, record_hdr.orig_len), packet)
+            written += 1
+        return written
+
+    def slice_file(self, input_file, output_file):
+        """
+        Slice a pcap or pcapng capture to output_file as pcap, returns the
+        number of records written
+        """
+        start = input_file.tell()
+        raw_magic = input_file.read(4)
+        input_file.seek(start)
+
+        if pcapng.is_pcapng(raw_magic):
+            with pcapng.MappedPcapngFile(input_file) as capture:
+                out_hdr = pcap.new_pcap_header(capture.header.network,
+                                               capture.header.snaplen or pcap.MAX_SNAPLEN,
+                                               capture.header.timestamp_in_ns)
+                with pcap.PcapWriter(output_file, out_hdr, self.snaplen) as writer:
+                    return self.slice_records(capture.header, capture.records(), writer)
+
+        with pcap.MappedPcapFile(input_file) as capture:
+            with pcap.PcapWriter(output_file, capture.header, self.snaplen) as writer:
+                return self.slice_pcap(capture.header, capture.buffer, writer)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('input')
+    parser.add_argument('output')
+    parser.add_argument('--start', type=float, help='first capture time kept, seconds since the epoch')
+    parser.add_argument('--end', type=float, help='capture time the slice ends before')
+    parser.add_argument('--filter', dest='expression', help='capture filter expression, see network.filter')
+    parser.add_argument('--ssrc', type=lambda value: int(value, 0), help='keep a single rtp stream')
+    parser.add_argument('--strip-payload', action='store_true', help='keep only the protocol headers')
+    parser.add_argument('--snaplen', type=int, help='truncate packets to this many bytes')
+    args = parser.parse_args(argv)
+
+    expressions = []
+    if args.expression:
+        expressions.append('(%s)' % args.expression)
+    if args.ssrc is not None:
+        expressions.append('rtp.ssrc == %d' % args.ssrc)
+    predicate = None
+    if expressions:
+        try:
+            predicate = capture_filter.compile_filter(' and '.join(expressions))
+        except capture_filter.FilterError as error:
+            parser.error(str(error))
+
+    slicer = Slicer(args.start, args.end, predicate, args.strip_payload, args.snaplen)
+    with open(args.input, 'rb') as input_file, open(args.output, 'wb') as output_file:
+        count = slicer.slice_file(input_file, output_file)
+    _module_logger.info('wrote %d records to %s', count, args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,261 @@
+"""
+Compact in-memory store of decoded packet headers, one fixed width packed
+row per packet in a single bytearray
+
+A row holds the PcapRecordHeader, UdpHeader and RtpHeader fields of a
+packet in PACKET_DTYPE, 49 bytes where the header objects of the same
+packet cost several hundred. Rows are read through PacketRow views whose
+attributes are named after the header fields, or all at once as a NumPy
+structured array over the same bytes with rows(), without building any
+Python objects.
+
+store = PacketStore()
+with open('test.pcap', 'rb') as fp:
+    with pcap.MappedPcapFile(fp) as capture:
+        for record_hdr, packet in capture.records():
+            store.append_packet(record_hdr, packet)
+store.sort_by_timestamp()
+for row in store[:10]:
+    print(row.ts_sec, row.ssrc, row.sequence_number)
+
+Fields of a layer a packet lacks are zero and its has_udp / has_rtp is 0.
+csrc_count stands in for the csrc list, CSRC identifiers and header
+extensions are not kept.
+"""
+
+import struct
+
+import numpy as np
+
+from capture import columns as capture_columns
+from network import ethernet
+from network import flow
+from network import ipv4
+from network import lazy
+from network import pcap
+
+__author__ = 'wmoorefi'
+
+# record fields, offset of the record in the capture or -1, then the udp
+# and rtp fields, packed without padding
+PACKET_DTYPE = np.dtype(capture_columns.RECORD_DTYPE.descr + capture_columns.UDP_DTYPE.descr +
+                        capture_columns.RTP_DTYPE.descr + [('has_udp', np.uint8), ('has_rtp', np.uint8)])
+
+_STRUCT_CODES = {'u1': 'B', 'u2': 'H', 'u4': 'I', 'i8': 'q'}
+
+
+def _struct_code(dtype):
+    return _STRUCT_CODES['%s%d' % (dtype.kind, dtype.itemsize)]
+
+
+# native byte order, standard sizes and no alignment, the layout of
+# PACKET_DTYPE
+_ROW = struct.Struct('=' + ''.join(_struct_code(PACKET_DTYPE.fields[name][0]) for name in PACKET_DTYPE.names))
+
+_UDP_HDR = struct.Struct('>HHHH')
+_RTP_HDR = struct.Struct('>BBHII')
+
+# version and header length, flags and fragment offset
+_IPV4_FRAGMENT = struct.Struct('>B5xH')
+
+_UDP_HDR_LENGTH = 8
+
+# ethernet header and the vlan tags capture.columns decodes
+_MAX_LINK_LENGTH = 14 + 4 * capture_columns.MAX_VLAN_TAGS
+
+_EMPTY_UDP = (0, 0, 0, 0)
+_EMPTY_RTP = (0, 0, 0, 0, 0, 0, 0, 0)
+
+
+def _row_field(name):
+    """
+    lazy.field reading the PACKET_DTYPE field name of a row
+    """
+    (dtype, field_offset) = PACKET_DTYPE.fields[name][:2]
+    return lazy.field(struct.Struct('=' + _struct_code(dtype)), field_offset)
+
+
+class PacketRow(object):
+    """
+    Read-only view of one row of a PacketStore. A row view reads the bytes
+    it was made over, it does not follow the store when the store is
+    sorted or grows.
+    """
+    __slots__ = ['_buffer', '_offset']
+
+    ts_sec = _row_field('ts_sec')
+    ts_usec = _row_field('ts_usec')
+    incl_len = _row_field('incl_len')
+    orig_len = _row_field('orig_len')
+    offset = _row_field('offset')
+    source_port = _row_field('source_port')
+    destination_port = _row_field('destination_port')
+    length = _row_field('length')
+    checksum = _row_field('checksum')
+    version = _row_field('version')
+    padding_flag = _row_field('padding_flag')
+    marker_bit = _row_field('marker_bit')
+    payload_type = _row_field('payload_type')
+    sequence_number = _row_field('sequence_number')
+    timestamp = _row_field('timestamp')
+    ssrc = _row_field('ssrc')
+    csrc_count = _row_field('csrc_count')
+    has_udp = _row_field('has_udp')
+    has_rtp = _row_field('has_rtp')
+
+    def __init__(self, buffer, offset):
+        self._buffer = buffer
+        self._offset = offset
+
+    def __len__(self):
+        return _ROW.size
+
+
+class PacketStore(object):
+    """
+    Growable array of packet rows, capacity is the number of rows
+    allocated up front. The storage doubles when it is full, arrays
+    returned by rows() before keep the rows they had.
+    """
+    __slots__ = ['_data', '_length']
+
+    def __init__(self, capacity=1024):
+        self._data = bytearray(max(1, capacity) * _ROW.size)
+        self._length = 0
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Store holding a copy of the PACKET_DTYPE array rows
+        """
+        store = cls(len(rows))
+        store._data[:len(rows) * _ROW.size] = np.ascontiguousarray(rows, dtype=PACKET_DTYPE).tobytes()
+        store._length = len(rows)
+        return store
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def nbytes(self):
+        return self._length * _ROW.size
+
+    def _reserve(self, count):
+        needed = (self._length + count) * _ROW.size
+        if needed <= len(self._data):
+            return
+        # a new buffer rather than a resize, rows() arrays and row views
+        # may still export the old one
+        data = bytearray(max(needed, 2 * len(self._data)))
+        data[:self._length * _ROW.size] = memoryview(self._data)[:self._length * _ROW.size]
+        self._data = data
+
+    def append(self, record_hdr, udp_hdr=None, rtp_hdr=None, offset=-1):
+        """
+        Add a packet from its decoded headers, offset is where its record
+        starts in the capture
+        """
+        self._reserve(1)
+        if udp_hdr is None:
+            udp = _EMPTY_UDP
+        else:
+            udp = (udp_hdr.source_port, udp_hdr.destination_port, udp_hdr.length, udp_hdr.checksum)
+        if rtp_hdr is None:
+            rtp = _EMPTY_RTP
+        else:
+            rtp = (rtp_hdr.version, rtp_hdr.padding_flag, rtp_hdr.marker_bit, rtp_hdr.payload_type,
+                   rtp_hdr.sequence_number, rtp_hdr.timestamp, rtp_hdr.ssrc, len(rtp_hdr.csrc_list))
+        _ROW.pack_into(self._data, self._length * _ROW.size,
+                       record_hdr.ts_sec, record_hdr.ts_usec, record_hdr.incl_len, record_hdr.orig_len, offset,
+                       *(udp + rtp + (udp_hdr is not None, rtp_hdr is not None)))
+        self._length += 1
+
+    def append_packet(self, record_hdr, packet, offset=-1):
+        """
+        Add an ethernet packet, its udp and rtp fields are read straight
+        from the bytes without building header objects. Rows are the ones
+        extend_columns() adds for the same packet: later fragments, frames
+        with more than capture.columns.MAX_VLAN_TAGS tags and rtp headers
+        whose csrc list is cut short have no udp or rtp fields, payloads
+        that are not rtp version 2 are stored as udp only.
+        """
+        self._reserve(1)
+        udp = _EMPTY_UDP
+        rtp = _EMPTY_RTP
+        has_udp = has_rtp = False
+        link = ethernet.ethernet_payload_offset(packet)
+        if link is not None and link[0] == ethernet.ETHERTYPE_IPV4 and link[1] <= _MAX_LINK_LENGTH:
+            found = flow.flow_key(packet, link[1])
+            if found is not None and found[0][2] == ipv4.PROTOCOL_UDP:
+                (version_ihl, flags_fragment) = _IPV4_FRAGMENT.unpack_from(packet, link[1])
+                # flow_key finds the udp header of the first fragment, a
+                # header length below 20 bytes is not ipv4
+                if version_ihl & 0x0F >= 5 and not flags_fragment & 0x1FFF:
+                    (_, payload_offset, end) = found
+                    udp = _UDP_HDR.unpack_from(packet, payload_offset - _UDP_HDR_LENGTH)
+                    has_udp = True
+                    if end - payload_offset >= _RTP_HDR.size:
+                        (first_byte, second_byte, sequence_number, timestamp,
+                         ssrc) = _RTP_HDR.unpack_from(packet, payload_offset)
+                        if first_byte >> 6 == 2 and end - payload_offset >= _RTP_HDR.size + (first_byte & 0x0F) * 4:
+                            rtp = (2, (first_byte >> 5) & 0x1, second_byte >> 7, second_byte & 0x7F,
+                                   sequence_number, timestamp, ssrc, first_byte & 0x0F)
+                            has_rtp = True
+        _ROW.pack_into(self._data, self._length * _ROW.size,
+                       record_hdr.ts_sec, record_hdr.ts_usec, record_hdr.incl_len, record_hdr.orig_len, offset,
+                       *(udp + rtp + (has_udp, has_rtp)))
+        self._length += 1
+
+    def extend_columns(self, columns):
+        """
+        Add every packet of a capture.columns CaptureColumns, whose offset
+        is that of the packet data rather than of its record
+        """
+        count = len(columns)
+        self._reserve(count)
+        start = self._length
+        rows = np.frombuffer(self._data, dtype=PACKET_DTYPE, count=start + count)[start:]
+        for name in capture_columns.RECORD_DTYPE.names:
+            rows[name] = columns.record[name]
+        rows['offset'] -= pcap.PCAPREC_HDR_LENGTH
+        for name in capture_columns.UDP_DTYPE.names:
+            rows[name] = columns.udp[name]
+        for name in capture_columns.RTP_DTYPE.names:
+            rows[name] = columns.rtp[name]
+        rows['has_udp'] = columns.has_udp
+        rows['has_rtp'] = columns.has_rtp
+        del rows
+        self._length += count
+
+    def rows(self):
+        """
+        PACKET_DTYPE array over the rows, writes to it change the store
+        """
+        return np.frombuffer(self._data, dtype=PACKET_DTYPE, count=self._length)
+
+    def __getitem__(self, key):
+        """
+        PacketRow of the row at an index, a new PacketStore with a copy of
+        the rows for a slice
+        """
+        if isinstance(key, slice):
+            return PacketStore.from_rows(self.rows()[key])
+        if key < 0:
+            key += self._length
+        if not 0 <= key < self._length:
+            raise IndexError('packet index out of range')
+        return PacketRow(self._data, key * _ROW.size)
+
+    def __iter__(self):
+        data = self._data
+        for offset in range(0, self._length * _ROW.size, _ROW.size):
+            yield PacketRow(data, offset)
+
+    def sort_by_timestamp(self):
+        """
+        Sort the rows in place by capture timestamp, packets with equal
+        timestamps keep their order
+        """
+        rows = self.rows()
+        order = np.lexsort((rows['ts_usec'], rows['ts_sec']))
+        rows[:] = rows[order]
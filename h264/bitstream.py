@@ -0,0 +1,122 @@
+"""
+Bit reader for H.264 RBSP syntax, fixed width fields and Exp-Golomb codes
+
+The NAL unit payload is first turned into its raw byte sequence payload by
+removing the emulation prevention bytes (the 0x03 of every 0x000003), then
+read MSB first. The whole RBSP is held as one Python int so a field is a
+shift and a mask and an Exp-Golomb prefix is counted with bit_length(),
+meant for the headers at the start of a NAL unit, not for slice data.
+
+reader = BitReader(rbsp(nal[1:]))
+profile_idc = reader.read_bits(8)
+seq_parameter_set_id = reader.read_ue()
+"""
+
+__author__ = 'wmoorefi'
+
+_EMULATION_PREVENTION = b'\x00\x00\x03'
+
+# longest Exp-Golomb code H.264 uses, 32 bit values
+_MAX_LEADING_ZEROS = 32
+
+
+class BitstreamError(Exception):
+    """
+    Read past the end of the RBSP or a malformed Exp-Golomb code
+    """
+    pass
+
+
+def rbsp(data):
+    """
+    RBSP of the NAL unit payload data (without its header byte), data
+    itself when it holds no emulation prevention byte, else a copy
+    """
+    data = memoryview(data)
+    raw = data.tobytes()
+    if _EMULATION_PREVENTION not in raw:
+        return data
+    # replace() resumes after every match, so 00 00 03 00 00 03 loses both
+    # prevention bytes and the 03 following one is kept as data
+    return raw.replace(_EMULATION_PREVENTION, b'\x00\x00')
+
+
+class BitReader(object):
+    """
+    MSB first reader over bytes-like data, position is in bits from the
+    start
+    """
+    __slots__ = ['position', '_value', '_length']
+
+    def __init__(self, data):
+        self.position = 0
+        self._value = int.from_bytes(data, 'big')
+        self._length = len(data) * 8
+
+    def bits_left(self):
+        return self._length - self.position
+
+    def read_bits(self, count):
+        """
+        Unsigned value of the next count bits, u(n)
+        """
+        end = self.position + count
+        if end > self._length:
+            raise BitstreamError('read of %d bits at bit %d of %d' % (count, self.position, self._length))
+        self.position = end
+        return (self._value >> (self._length - end)) & ((1 << count) - 1)
+
+    def read_bit(self):
+        """
+        Next bit as 0 or 1, u(1)
+        """
+        if self.position >= self._length:
+            raise BitstreamError('read past the end at bit %d' % self.position)
+        self.position += 1
+        return (self._value >> (self._length - self.position)) & 1
+
+    def read_flag(self):
+        return self.read_bit() == 1
+
+    def skip_bits(self, count):
+        if self.position + count > self._length:
+            raise BitstreamError('skip of %d bits at bit %d of %d' % (count, self.position, self._length))
+        self.position += count
+
+    def read_ue(self):
+        """
+        Unsigned Exp-Golomb code, ue(v)
+        """
+        remaining = self._length - self.position
+        rest = self._value & ((1 << remaining) - 1)
+        leading_zeros = remaining - rest.bit_length()
+        if leading_zeros > _MAX_LEADING_ZEROS or not rest:
+            raise BitstreamError('malformed Exp-Golomb code at bit %d' % self.position)
+        # the leading zeros, the 1 and as many bits as there were zeros
+        count = 2 * leading_zeros + 1
+        if count > remaining:
+            raise BitstreamError('truncated Exp-Golomb code at bit %d' % self.position)
+        self.position += count
+        return (rest >> (remaining - count)) - 1
+
+    def read_se(self):
+        """
+        Signed Exp-Golomb code, se(v), 1, 2, 3, 4 ... map to 1, -1, 2, -2 ...
+        """
+        code = self.read_ue()
+        if code & 1:
+            return (code + 1) >> 1
+        return -(code >> 1)
+
+    def more_rbsp_data(self):
+        """
+        True while syntax elements remain before the rbsp_stop_one_bit, the
+        last 1 bit of the RBSP
+        """
+        remaining = self._length - self.position
+        if remaining <= 0:
+            return False
+        rest = self._value & ((1 << remaining) - 1)
+        # trailing zero bits, then the stop bit
+        stop_bit = (rest & -rest).bit_length()
+        return stop_bit != 0 and stop_bit < remaining
@@ -0,0 +1,226 @@
+"""
+RFC 6184 H.264 RTP depacketizer
+
+Single NAL unit, STAP-A and FU-A packets of one RTP stream are turned back
+into NAL units and grouped into access units by RTP timestamp and marker
+bit. Access units are assembled in Annex-B byte stream format in one
+preallocated buffer that is reused for every access unit, it only grows
+when an access unit is larger than anything seen before.
+
+with open('out.h264', 'wb') as output_file:
+    writer = AnnexBWriter(output_file)
+    depacketizer = Depacketizer(writer.write)
+    for rtp_hdr, payload in stream:
+        depacketizer.push(rtp_hdr, payload)
+    depacketizer.flush()
+
+Interleaved mode (STAP-B, MTAP, FU-B) is not supported, those packets are
+counted in unsupported_packets and dropped.
+"""
+
+from h264 import nalu
+from network import flow as network_flow
+
+__author__ = 'wmoorefi'
+
+START_CODE = b'\x00\x00\x00\x01'
+
+_FU_START = 0x80
+_FU_END = 0x40
+
+
+class AccessUnit(object):
+    """
+    One picture worth of NAL units in Annex-B format. data is a memoryview
+    of the depacketizer buffer and is released once the sink returns, copy
+    it with bytes() to keep it. damaged is set when packets of the access
+    unit were lost or malformed.
+    """
+    __slots__ = ['timestamp', 'data', 'nal_unit_types', 'damaged']
+
+    def __init__(self, timestamp, data, nal_unit_types, damaged):
+        self.timestamp = timestamp
+        self.data = data
+        self.nal_unit_types = nal_unit_types
+        self.damaged = damaged
+
+    def __len__(self):
+        return len(self.data)
+
+
+class Depacketizer(object):
+    """
+    Depacketizer for a single SSRC, sink is called with every completed
+    AccessUnit
+    """
+    __slots__ = ['sink', 'packets', 'lost_packets', 'unsupported_packets', 'access_units',
+                 '_buffer', '_length', '_nal_start', '_in_fragment', '_timestamp',
+                 '_last_sequence_number', '_nal_unit_types', '_damaged']
+
+    def __init__(self, sink, capacity=1 << 20):
+        self.sink = sink
+        self.packets = 0
+        self.lost_packets = 0
+        self.unsupported_packets = 0
+        self.access_units = 0
+        self._buffer = bytearray(capacity)
+        self._length = 0
+        self._nal_start = 0
+        self._in_fragment = False
+        self._timestamp = None
+        self._last_sequence_number = None
+        self._nal_unit_types = []
+        self._damaged = False
+
+    def _append(self, data):
+        end = self._length + len(data)
+        if end > len(self._buffer):
+            self._buffer.extend(bytearray(max(end, 2 * len(self._buffer)) - len(self._buffer)))
+        self._buffer[self._length:end] = data
+        self._length = end
+
+    def _start_nal(self):
+        self._nal_start = self._length
+        self._append(START_CODE)
+
+    def _drop_fragment(self):
+        if self._in_fragment:
+            self._length = self._nal_start
+            self._in_fragment = False
+            self._damaged = True
+
+    def flush(self):
+        """
+        Complete the pending access unit, call at the end of the stream
+        """
+        self._drop_fragment()
+        if self._length:
+            data = memoryview(self._buffer)[:self._length]
+            try:
+                self.sink(AccessUnit(self._timestamp, data, self._nal_unit_types, self._damaged))
+            finally:
+                data.release()
+            self.access_units += 1
+        self._length = 0
+        self._nal_unit_types = []
+        self._damaged = False
+
+    def push(self, rtp_hdr, payload):
+        """
+        Depacketize one rtp packet, payload is the rtp payload without
+        padding (see network.rtp.rtp_payload)
+        """
+        self.packets += 1
+
+        if self._timestamp is not None and rtp_hdr.timestamp != self._timestamp:
+            self.flush()
+        self._timestamp = rtp_hdr.timestamp
+
+        if self._last_sequence_number is not None:
+            gap = (rtp_hdr.sequence_number - self._last_sequence_number - 1) & 0xFFFF
+            if gap and gap < 0x8000:
+                self.lost_packets += gap
+                self._damaged = True
+                self._drop_fragment()
+        self._last_sequence_number = rtp_hdr.sequence_number
+
+        if payload is None or not len(payload):
+            self._damaged = True
+        else:
+            nal_unit_type = payload[0] & 0x1F
+            if nal_unit_type == nalu.NALUTYPE_FUA:
+                self._push_fua(payload)
+            elif nal_unit_type == nalu.NALUTYPE_STAPA:
+                self._push_stapa(payload)
+            elif 0 < nal_unit_type < nalu.NALUTYPE_STAPA:
+                self._start_nal()
+                self._append(payload)
+                self._nal_unit_types.append(nal_unit_type)
+            else:
+                self.unsupported_packets += 1
+
+        if rtp_hdr.marker_bit:
+            self.flush()
+
+    def _push_fua(self, payload):
+        if len(payload) < 2:
+            self._damaged = True
+            return
+
+        fu_indicator = payload[0]
+        fu_header = payload[1]
+        if fu_header & _FU_START:
+            self._drop_fragment()
+            self._start_nal()
+            self._append(bytearray(((fu_indicator & 0xE0) | (fu_header & 0x1F),)))
+            self._in_fragment = True
+        elif not self._in_fragment:
+            # start fragment was lost
+            self._damaged = True
+            return
+
+        self._append(payload[2:])
+
+        if fu_header & _FU_END:
+            self._in_fragment = False
+            self._nal_unit_types.append(fu_header & 0x1F)
+
+    def _push_stapa(self, payload):
+        self._drop_fragment()
+        offset = 1
+        end = len(payload)
+        while offset + 2 <= end:
+            size = (payload[offset] << 8) | payload[offset + 1]
+            offset += 2
+            if not size or offset + size > end:
+                self._damaged = True
+                return
+            self._start_nal()
+            self._append(payload[offset:offset + size])
+            self._nal_unit_types.append(payload[offset] & 0x1F)
+            offset += size
+
+
+class AnnexBWriter(object):
+    """
+    Writes access units to an H.264 Annex-B elementary stream file, pass
+    write as the Depacketizer sink
+    """
+    __slots__ = ['output_file', 'access_units', 'bytes_written']
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.access_units = 0
+        self.bytes_written = 0
+
+    def write(self, access_unit):
+        self.output_file.write(access_unit.data)
+        self.access_units += 1
+        self.bytes_written += len(access_unit.data)
+
+
+class FlowDepacketizer(object):
+    """
+    network.flow decoder that depacketizes every flow it is registered for,
+    each flow keeps its own Depacketizer in flow.state
+    """
+    __slots__ = ['sink', 'capacity']
+
+    def __init__(self, sink, capacity=1 << 20):
+        self.sink = sink
+        self.capacity = capacity
+
+    def __call__(self, flow, record_hdr, packet, offset, end):
+        decoded = network_flow.decode_rtp(flow, record_hdr, packet, offset, end)
+        if decoded is None:
+            return
+        (rtp_hdr, payload) = decoded
+
+        if flow.state is None:
+            flow.state = Depacketizer(self.sink, self.capacity)
+        flow.state.push(rtp_hdr, payload)
+        return decoded
+
+    def close(self, flow):
+        if flow.state is not None:
+            flow.state.flush()
@@ -1,9 +1,11 @@
 import struct
 
+from network import dissect
+
 __author__ = 'wmoorefi'
 
 NALUTYPE_UNSPECIFIED = 0
-NALUTYPE_SLICE_NONIDR = 0
+NALUTYPE_SLICE_NONIDR = 1
 NALUTYPE_SLICE_DATAPART_A = 2
 NALUTYPE_SLICE_DATAPART_B = 3
 NALUTYPE_SLICE_DATAPART_C = 4
@@ -27,11 +29,16 @@ NALUTYPE_STAPB = 25  # STAP-B
 NALUTYPE_MTAP16 = 26  # MTAP16
 NALUTYPE_MTAP24 = 27  # MTAP24
 NALUTYPE_FUA = 28  # FU-A
-NALUTYPE_FUB = 20  # FU-B
+NALUTYPE_FUB = 29  # FU-B
 NALUTYPE_PACSI = 30  # PACSI NALU
 NALUTYPE_EMPTY = 31
 NALUTYPE_NI_MTAP = 31
 
+_NALU_HDR = struct.Struct('>B')
+
+# payload types RFC 3551 leaves to dynamic assignment, where H.264 is found
+_DYNAMIC_PAYLOAD_TYPES = range(96, 128)
+
 
 class NaluHeader(object):
     """
@@ -58,16 +65,51 @@ class NaluHeader(object):
 
 def read_nalu_header(input_stream, byte_swap):
     chunk = input_stream.read(1)
-    if chunk == "":
+    if not chunk:
         return
 
-    if byte_swap:
-        raw_unpacked = struct.unpack('<B', chunk)
-    else:
-        raw_unpacked = struct.unpack('>B', chunk)
+    return unpack_nalu_header(chunk, 0, byte_swap)
+
+
+def unpack_nalu_header(buffer, offset, byte_swap):
+    """
+    Parse NAL unit header from buffer starting at offset, returns None when
+    the buffer is too short
 
-    forbidden_zero_bit = raw_unpacked[0] & 0x01
+    A single byte has no byte order, byte_swap is unused
+    """
+    if len(buffer) - offset < 1:
+        return
+
+    raw_unpacked = _NALU_HDR.unpack_from(buffer, offset)
+
+    forbidden_zero_bit = (raw_unpacked[0] >> 7) & 0x01
     nal_ref_idc = (raw_unpacked[0] >> 5) & 0x03
     nal_unit_type = raw_unpacked[0] & 0x1F
 
-    return NaluHeader(forbidden_zero_bit, nal_ref_idc, nal_unit_type)
\ No newline at end of file
+    return NaluHeader(forbidden_zero_bit, nal_ref_idc, nal_unit_type)
+
+
+def dissect_nalu(buffer, offset, end):
+    """
+    Dissector of the NAL unit header at the start of an rtp payload, the
+    last layer
+    """
+    if end - offset < 1:
+        return
+    return unpack_nalu_header(buffer, offset, False), None, offset + 1, end
+
+
+def is_nalu(buffer, offset, end, payload_type):
+    """
+    Heuristic for rtp payloads of dynamic payload types, a NAL unit or
+    RFC 6184 aggregation or fragmentation header with the forbidden bit clear
+    """
+    if payload_type not in _DYNAMIC_PAYLOAD_TYPES or end - offset < 1:
+        return False
+    raw = _NALU_HDR.unpack_from(buffer, offset)[0]
+    return not raw & 0x80 and NALUTYPE_UNSPECIFIED < raw & 0x1F <= NALUTYPE_FUB
+
+
+def register(registry):
+    registry.register_heuristic(dissect.RTP_PAYLOAD_TYPE, 'h264', is_nalu, dissect_nalu)
@@ -0,0 +1,622 @@
+"""
+One pass video quality analysis of H.264 RTP streams: frame sizes, GOP
+structure, frame rate, bitrate, IDR interval and the frames damaged by
+packet loss
+
+Packets are grouped into frames by RTP timestamp, a frame ends with its
+marker bit or the first packet of the next timestamp. The first slice
+header of every frame is parsed against the stream's cached parameter sets
+(h264.syntax) for its slice type and frame_num, nothing else of the slice
+data is looked at.
+
+A sequence number gap is charged to the frame it interrupts: the pending
+frame when the next packet carries its timestamp or when it never saw its
+marker bit, the next frame when it starts with an FU-A fragment that is not
+a start fragment. A gap between a complete frame and the start of the next
+one lost whole frames, their number is estimated from the timestamp jump.
+A damaged or lost reference frame breaks the reference chain, every frame
+decoded until the next undamaged I frame is counted as impaired. Lost
+frames are presumed to be reference frames unless the frame_num of the
+next frame shows no reference frame went missing.
+
+analyzer = VideoQualityAnalyzer()
+for record_hdr, packet in capture.records():
+    ...
+    analyzer.push(rtp_hdr, payload, pcap.record_timestamp(pcap_hdr, record_hdr))
+analyzer.flush()
+for ssrc, stream in analyzer.streams.items():
+    print(hex(ssrc), stream.frame_rate, stream.bitrate, stream.impaired_frames)
+
+State per stream is bounded: the pending frame, counters, the cached
+parameter sets and the last gop_history GOPs. Packets arriving after their
+frame was completed are only counted in late_packets.
+
+python -m h264.quality capture.pcap --ports 5000-5100
+"""
+
+import argparse
+import collections
+import json
+import sys
+
+from h264 import nalu
+from h264 import syntax
+from network import flow as network_flow
+from network import pcap
+from network import pcapng
+from network import rtpstats
+
+__author__ = 'wmoorefi'
+
+FRAME_TYPES = 'IPB?'
+
+# longest GOP frame type pattern kept, 'IPPP...'
+GOP_PATTERN_LENGTH = 64
+
+_FU_START = 0x80
+
+# a larger rtp timestamp step between frames, in seconds, starts a new
+# span for the frame rate instead of stretching it
+MAX_TIMESTAMP_JUMP = 10
+
+# frame type letter of slice_type modulo 5
+_SLICE_FRAME_TYPES = {
+    syntax.SLICE_TYPE_P: 'P',
+    syntax.SLICE_TYPE_B: 'B',
+    syntax.SLICE_TYPE_I: 'I',
+    syntax.SLICE_TYPE_SP: 'P',
+    syntax.SLICE_TYPE_SI: 'I',
+}
+
+
+class Frame(object):
+    """
+    One video frame, an access unit, of a stream. size is in RTP payload
+    bytes, nal_ref_idc the highest seen in its NAL units. slice_header is
+    its first slice header, None when it was lost or could not be parsed.
+    impaired is set when the frame references a damaged frame.
+    """
+    __slots__ = ['ssrc', 'timestamp', 'first_arrival', 'last_arrival', 'first_sequence_number',
+                 'packets', 'size', 'nal_ref_idc', 'idr', 'slice_header', 'lost_packets',
+                 'missing_start', 'complete', 'impaired']
+
+    def __init__(self, ssrc, timestamp, arrival_time, sequence_number):
+        self.ssrc = ssrc
+        self.timestamp = timestamp
+        self.first_arrival = arrival_time
+        self.last_arrival = arrival_time
+        self.first_sequence_number = sequence_number
+        self.packets = 0
+        self.size = 0
+        self.nal_ref_idc = 0
+        self.idr = False
+        self.slice_header = None
+        self.lost_packets = 0
+        self.missing_start = False
+        self.complete = False
+        self.impaired = False
+
+    @property
+    def damaged(self):
+        return bool(self.lost_packets or self.missing_start or not self.complete)
+
+    @property
+    def frame_type(self):
+        """
+        'I', 'P', 'B' or '?' when the slice header is unknown
+        """
+        if self.idr:
+            return 'I'
+        if self.slice_header is None:
+            return '?'
+        return _SLICE_FRAME_TYPES[self.slice_header.slice_type]
+
+    @property
+    def reference(self):
+        return self.nal_ref_idc > 0
+
+
+class Gop(object):
+    """
+    Frames from one I frame up to the next, pattern holds the frame types
+    of the first GOP_PATTERN_LENGTH frames
+    """
+    __slots__ = ['start_timestamp', 'start_arrival', 'idr', 'frames', 'bytes', 'intra_bytes',
+                 'damaged_frames', 'impaired_frames', 'pattern', 'duration']
+
+    def __init__(self, frame):
+        self.start_timestamp = frame.timestamp
+        self.start_arrival = frame.first_arrival
+        self.idr = frame.idr
+        self.frames = 0
+        self.bytes = 0
+        self.intra_bytes = frame.size
+        self.damaged_frames = 0
+        self.impaired_frames = 0
+        self.pattern = ''
+        self.duration = 0.0
+
+    def add(self, frame):
+        self.frames += 1
+        self.bytes += frame.size
+        self.damaged_frames += frame.damaged
+        self.impaired_frames += frame.impaired
+        if len(self.pattern) < GOP_PATTERN_LENGTH:
+            self.pattern += frame.frame_type
+        self.duration = frame.last_arrival - self.start_arrival
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+
+class _Summary(object):
+    """
+    Count, total, min and max of a series of values
+    """
+    __slots__ = ['count', 'total', 'min', 'max']
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / float(self.count) if self.count else None,
+            'min': self.min,
+            'max': self.max,
+        }
+
+
+class VideoStreamQuality(object):
+    """
+    Frame, GOP and loss accounting of one SSRC. sink is called with every
+    completed Frame. Rates are None until two frames were seen.
+    """
+    __slots__ = ['ssrc', 'clock_rate', 'sink', 'parameter_sets', 'packets', 'bytes', 'lost_packets',
+                 'late_packets', 'duplicates', 'resyncs', 'unsupported_packets', 'frames',
+                 'damaged_frames', 'impaired_frames', 'lost_frames', 'frame_num_gaps', 'idr_frames',
+                 'frame_sizes', 'idr_interval_frames', 'idr_interval_seconds', 'gops',
+                 'first_arrival', 'last_arrival', 'width', 'height', '_frame',
+                 '_last_sequence_number', '_last_timestamp', '_position', '_span_min', '_span_max',
+                 '_span_frames', '_spans', '_span_intervals', '_gop', '_chain_broken', '_pending_loss', '_next_frame_num',
+                 '_last_idr']
+
+    def __init__(self, ssrc, clock_rate=rtpstats.DEFAULT_CLOCK_RATE, gop_history=16, sink=None):
+        self.ssrc = ssrc
+        self.clock_rate = clock_rate
+        self.sink = sink
+        self.parameter_sets = syntax.ParameterSetCache()
+        self.packets = 0
+        self.bytes = 0
+        self.lost_packets = 0
+        self.late_packets = 0
+        self.duplicates = 0
+        self.resyncs = 0
+        self.unsupported_packets = 0
+        self.frames = 0
+        self.damaged_frames = 0
+        self.impaired_frames = 0
+        self.lost_frames = 0
+        self.frame_num_gaps = 0
+        self.idr_frames = 0
+        self.frame_sizes = dict((frame_type, _Summary()) for frame_type in FRAME_TYPES)
+        self.idr_interval_frames = _Summary()
+        self.idr_interval_seconds = _Summary()
+        self.gops = collections.deque(maxlen=gop_history)
+        self.first_arrival = None
+        self.last_arrival = None
+        self.width = None
+        self.height = None
+        self._frame = None
+        self._last_sequence_number = None
+        # rtp timestamps of the current span relative to its first frame,
+        # with the total length and frame intervals of the spans before
+        self._last_timestamp = None
+        self._position = 0
+        self._span_min = 0
+        self._span_max = 0
+        self._span_frames = 0
+        self._spans = 0
+        self._span_intervals = 0
+        self._gop = None
+        self._chain_broken = False
+        # frames lost since the last frame, resolved by the next frame_num
+        self._pending_loss = 0
+        self._next_frame_num = None
+        self._last_idr = None
+
+    @property
+    def frame_interval(self):
+        """
+        Mean rtp timestamp step between frames, None before two frames
+        """
+        intervals = self._span_intervals + max(0, self._span_frames - 1)
+        length = self._spans + self._span_max - self._span_min
+        if not intervals or not length:
+            return
+        return length / float(intervals)
+
+    @property
+    def frame_rate(self):
+        frame_interval = self.frame_interval
+        if frame_interval is None:
+            return
+        return self.clock_rate / frame_interval
+
+    @property
+    def bitrate(self):
+        """
+        RTP payload bits per second
+        """
+        if self.first_arrival is None or self.last_arrival <= self.first_arrival:
+            return
+        return self.bytes * 8 / (self.last_arrival - self.first_arrival)
+
+    def _timestamp_step(self, timestamp):
+        """
+        Signed rtp timestamp step from the last frame, None for the first
+        frame and for jumps over MAX_TIMESTAMP_JUMP
+        """
+        if self._last_timestamp is None:
+            return
+        delta = ((timestamp - self._last_timestamp + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+        if abs(delta) > MAX_TIMESTAMP_JUMP * self.clock_rate:
+            return
+        return delta
+
+    def _estimate_lost_frames(self, timestamp, gap):
+        """
+        Whole frames that fit between the last frame and timestamp, at
+        most one per lost packet
+        """
+        frame_interval = self.frame_interval
+        delta = self._timestamp_step(timestamp)
+        if frame_interval is None or delta is None:
+            return 0
+        return min(gap, max(0, int(round(delta / frame_interval)) - 1))
+
+    def push(self, rtp_hdr, payload, arrival_time):
+        """
+        Account one rtp packet, payload without header and padding
+        (network.rtp.rtp_payload), arrival_time in seconds
+        """
+        sequence_number = rtp_hdr.sequence_number
+        timestamp = rtp_hdr.timestamp
+        gap = 0
+        if self._last_sequence_number is not None:
+            udelta = (sequence_number - self._last_sequence_number) & 0xFFFF
+            if udelta == 0:
+                self.duplicates += 1
+                return
+            if udelta > rtpstats.RTP_SEQ_MOD - rtpstats.MAX_MISORDER:
+                self._push_late(timestamp, payload)
+                return
+            if udelta < rtpstats.MAX_DROPOUT:
+                gap = udelta - 1
+            else:
+                # the sender restarted, nothing to charge the jump to
+                self.resyncs += 1
+                self._finish_frame()
+        self._last_sequence_number = sequence_number
+
+        self.packets += 1
+        size = len(payload) if payload is not None else 0
+        self.bytes += size
+        if self.first_arrival is None:
+            self.first_arrival = arrival_time
+        self.last_arrival = arrival_time
+        self.lost_packets += gap
+
+        frame = self._frame
+        if frame is not None and frame.timestamp != timestamp:
+            # the pending frame never saw its marker, it lost its tail
+            frame.lost_packets += gap
+            self._finish_frame()
+            self._pending_loss += self._estimate_lost_frames(timestamp, gap)
+            gap = 0
+            frame = None
+
+        if frame is None:
+            frame = Frame(self.ssrc, timestamp, arrival_time, sequence_number)
+            self._frame = frame
+            if gap:
+                if self._starts_frame(payload):
+                    # only whole frames went missing in between
+                    self._pending_loss += max(1, self._estimate_lost_frames(timestamp, gap))
+                else:
+                    frame.lost_packets += gap
+                    self._pending_loss += self._estimate_lost_frames(timestamp, gap)
+            if not self._starts_frame(payload):
+                frame.missing_start = True
+        else:
+            frame.lost_packets += gap
+
+        frame.packets += 1
+        frame.size += size
+        frame.last_arrival = arrival_time
+        if payload is not None and len(payload):
+            self._push_nal_units(frame, payload)
+
+        if rtp_hdr.marker_bit:
+            frame.complete = True
+            self._finish_frame()
+
+    def _starts_frame(self, payload):
+        """
+        False for a payload that continues a fragmented NAL unit
+        """
+        if payload is None or len(payload) < 2:
+            return False
+        if payload[0] & 0x1F == nalu.NALUTYPE_FUA:
+            return bool(payload[1] & _FU_START)
+        return True
+
+    def _push_late(self, timestamp, payload):
+        """
+        A packet from before the last sequence number, it fills a gap of
+        the pending frame or arrived too late for its frame
+        """
+        size = len(payload) if payload is not None else 0
+        self.packets += 1
+        self.bytes += size
+        self.late_packets += 1
+        frame = self._frame
+        if frame is not None and frame.timestamp == timestamp and frame.lost_packets:
+            frame.lost_packets -= 1
+            frame.size += size
+            self.lost_packets -= 1
+
+    def _push_nal_units(self, frame, payload):
+        nal_unit_type = payload[0] & 0x1F
+        if nal_unit_type == nalu.NALUTYPE_FUA:
+            if len(payload) < 2:
+                return
+            nal_header = (payload[0] & 0xE0) | (payload[1] & 0x1F)
+            if payload[1] & _FU_START:
+                # the slice header is at the start of the first fragment
+                self._push_nal_unit(frame, nal_header, payload, 2)
+            else:
+                self._push_nal_header(frame, nal_header)
+        elif nal_unit_type == nalu.NALUTYPE_STAPA:
+            offset = 1
+            end = len(payload)
+            while offset + 2 < end:
+                size = (payload[offset] << 8) | payload[offset + 1]
+                offset += 2
+                if not size or offset + size > end:
+                    break
+                self._push_nal_unit(frame, payload[offset], payload[offset:offset + size], 1)
+                offset += size
+        elif 0 < nal_unit_type < nalu.NALUTYPE_STAPA:
+            self._push_nal_unit(frame, payload[0], payload, 1)
+        else:
+            self.unsupported_packets += 1
+
+    def _push_nal_header(self, frame, nal_header):
+        nal_ref_idc = (nal_header >> 5) & 0x03
+        if nal_ref_idc > frame.nal_ref_idc:
+            frame.nal_ref_idc = nal_ref_idc
+        if nal_header & 0x1F == nalu.NALUTYPE_SLICE_IDR:
+            frame.idr = True
+
+    def _push_nal_unit(self, frame, nal_header, data, payload_offset):
+        """
+        NAL unit with header nal_header whose payload starts at
+        payload_offset in data
+        """
+        self._push_nal_header(frame, nal_header)
+        nal_unit_type = nal_header & 0x1F
+        if nal_unit_type in (nalu.NALUTYPE_SLICE_NONIDR, nalu.NALUTYPE_SLICE_IDR):
+            if frame.slice_header is None:
+                end = payload_offset + syntax.SLICE_HEADER_BYTES
+                nal = bytearray((nal_header,))
+                nal += data[payload_offset:end]
+                frame.slice_header = self.parameter_sets.slice_header(nal)
+        elif nal_unit_type in (nalu.NALUTYPE_SPS, nalu.NALUTYPE_PPS) and payload_offset == 1:
+            self.parameter_sets.parse(data)
+
+    def _check_frame_num(self, frame):
+        """
+        Resolve frames lost before frame with its frame_num, True when a
+        reference frame is missing
+        """
+        header = frame.slice_header
+        lost_reference = self._pending_loss > 0
+        if header is not None and not frame.idr and self._next_frame_num is not None:
+            if header.frame_num == self._next_frame_num:
+                # only non-reference frames were lost
+                lost_reference = False
+            elif not header.sps.gaps_in_frame_num_allowed_flag and not frame.missing_start:
+                if not lost_reference:
+                    # lost upstream of the capture
+                    self.frame_num_gaps += 1
+                lost_reference = True
+        if header is not None:
+            max_frame_num = 1 << header.sps.log2_max_frame_num
+            self._next_frame_num = (header.frame_num + (1 if frame.reference else 0)) % max_frame_num
+        elif frame.reference:
+            self._next_frame_num = None
+        return lost_reference
+
+    def _advance_timestamp(self, timestamp):
+        delta = self._timestamp_step(timestamp)
+        if delta is None:
+            # first frame or a discontinuity, close the span
+            self._spans += self._span_max - self._span_min
+            self._span_intervals += max(0, self._span_frames - 1)
+            self._position = self._span_min = self._span_max = 0
+            self._span_frames = 0
+        else:
+            self._position += delta
+            self._span_min = min(self._span_min, self._position)
+            self._span_max = max(self._span_max, self._position)
+        self._span_frames += 1 + self._pending_loss
+        self._last_timestamp = timestamp
+
+    def _finish_frame(self):
+        frame = self._frame
+        if frame is None:
+            return
+        self._frame = None
+
+        lost_reference = self._check_frame_num(frame)
+        self._advance_timestamp(frame.timestamp)
+        self.lost_frames += self._pending_loss
+        self._pending_loss = 0
+        if lost_reference:
+            self._chain_broken = True
+
+        frame_type = frame.frame_type
+        if frame_type == 'I' and not frame.damaged:
+            self._chain_broken = False
+        elif self._chain_broken:
+            frame.impaired = True
+        if frame.damaged and frame.reference:
+            self._chain_broken = True
+
+        self.frames += 1
+        self.damaged_frames += frame.damaged
+        self.impaired_frames += frame.impaired
+        self.frame_sizes[frame_type].add(frame.size)
+        if frame.slice_header is not None:
+            self.width = frame.slice_header.sps.width
+            self.height = frame.slice_header.sps.height
+
+        if frame.idr:
+            self.idr_frames += 1
+            if self._last_idr is not None:
+                (last_index, last_arrival) = self._last_idr
+                self.idr_interval_frames.add(self.frames - 1 - last_index)
+                self.idr_interval_seconds.add(frame.first_arrival - last_arrival)
+            self._last_idr = (self.frames - 1, frame.first_arrival)
+
+        if frame_type == 'I' or self._gop is None:
+            self._gop = Gop(frame)
+            self.gops.append(self._gop)
+        self._gop.add(frame)
+
+        if self.sink is not None:
+            self.sink(frame)
+
+    def flush(self):
+        """
+        Complete the pending frame, call at the end of the stream
+        """
+        self._finish_frame()
+
+    def to_dict(self):
+        return {
+            'ssrc': self.ssrc,
+            'packets': self.packets,
+            'bytes': self.bytes,
+            'lost_packets': self.lost_packets,
+            'late_packets': self.late_packets,
+            'duplicates': self.duplicates,
+            'resyncs': self.resyncs,
+            'frames': self.frames,
+            'damaged_frames': self.damaged_frames,
+            'impaired_frames': self.impaired_frames,
+            'lost_frames': self.lost_frames,
+            'frame_num_gaps': self.frame_num_gaps,
+            'idr_frames': self.idr_frames,
+            'width': self.width,
+            'height': self.height,
+            'frame_rate': self.frame_rate,
+            'bitrate': self.bitrate,
+            'idr_interval_frames': self.idr_interval_frames.to_dict(),
+            'idr_interval_seconds': self.idr_interval_seconds.to_dict(),
+            'frame_sizes': dict((frame_type, stats.to_dict())
+                                for (frame_type, stats) in self.frame_sizes.items() if stats.count),
+            'gops': [gop.to_dict() for gop in self.gops],
+        }
+
+
+class VideoQualityAnalyzer(object):
+    """
+    VideoStreamQuality of every SSRC seen, sink is called with every
+    completed Frame of any stream
+    """
+    __slots__ = ['streams', 'clock_rate', 'gop_history', 'sink']
+
+    def __init__(self, clock_rate=rtpstats.DEFAULT_CLOCK_RATE, gop_history=16, sink=None):
+        self.streams = {}
+        self.clock_rate = clock_rate
+        self.gop_history = gop_history
+        self.sink = sink
+
+    def __len__(self):
+        return len(self.streams)
+
+    def stream(self, ssrc):
+        stream = self.streams.get(ssrc)
+        if stream is None:
+            stream = VideoStreamQuality(ssrc, self.clock_rate, self.gop_history, self.sink)
+            self.streams[ssrc] = stream
+        return stream
+
+    def push(self, rtp_hdr, payload, arrival_time):
+        self.stream(rtp_hdr.ssrc).push(rtp_hdr, payload, arrival_time)
+
+    def flush(self):
+        for stream in self.streams.values():
+            stream.flush()
+
+    def to_dict(self):
+        return {'streams': [self.streams[ssrc].to_dict() for ssrc in sorted(self.streams)]}
+
+
+def _port_range(value):
+    (low, _, high) = value.partition('-')
+    return int(low), int(high or low)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('input')
+    parser.add_argument('--ports', type=_port_range, default=(1024, 65535),
+                        help='udp port range of the rtp streams, low-high')
+    parser.add_argument('--gop-history', type=int, default=16, help='GOPs kept per stream')
+    parser.add_argument('--verify-checksums', action='store_true',
+                        help='drop packets with a bad IPv4 header or UDP checksum')
+    parser.add_argument('--output', help='write the JSON results here instead of stdout')
+    args = parser.parse_args(argv)
+
+    analyzer = VideoQualityAnalyzer(gop_history=args.gop_history)
+    flow_table = network_flow.FlowTable(verify_checksums=args.verify_checksums)
+    flow_table.register_port(network_flow.decode_rtp, *args.ports)
+    with open(args.input, 'rb') as input_file:
+        if pcapng.is_pcapng(input_file.read(4)):
+            capture = pcapng.MappedPcapngFile(input_file)
+        else:
+            capture = pcap.MappedPcapFile(input_file)
+        with capture:
+            pcap_hdr = capture.header
+            for (record_hdr, packet) in capture.records():
+                decoded = flow_table.process(record_hdr, packet)
+                if decoded is not None:
+                    analyzer.push(decoded[0], decoded[1], pcap.record_timestamp(pcap_hdr, record_hdr))
+    analyzer.flush()
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(analyzer.to_dict(), output_file, indent=2)
+    else:
+        json.dump(analyzer.to_dict(), sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
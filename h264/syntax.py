@@ -0,0 +1,572 @@
+"""
+H.264 sequence parameter set, picture parameter set and slice header
+parsers, T-REC-H.264 7.3.2.1.1, 7.3.2.2 and 7.3.3
+
+Every parser takes one NAL unit, header byte included and no start code,
+and returns None when it is truncated or malformed. A slice header can only
+be read with the parameter sets it refers to, ParameterSetCache keeps the
+parameter sets of one stream keyed by id and parses an SPS or PPS again
+only when its bytes change, so the slices of every frame are parsed against
+the cached sets.
+
+cache = ParameterSetCache()
+for nal in nal_units:
+    parsed = cache.parse(nal)
+    if isinstance(parsed, SliceHeader):
+        print(parsed.frame_num, parsed.sps.width, parsed.sps.height)
+
+Slice headers are read up to the deblocking filter fields, slice group
+change cycle and the slice data that follow are not.
+"""
+
+from h264 import bitstream
+from h264 import nalu
+
+__author__ = 'wmoorefi'
+
+SLICE_TYPE_P = 0
+SLICE_TYPE_B = 1
+SLICE_TYPE_I = 2
+SLICE_TYPE_SP = 3
+SLICE_TYPE_SI = 4
+
+# profiles whose SPS carries chroma format, bit depth and scaling matrices
+_HIGH_PROFILES = frozenset([100, 110, 118, 122, 128, 134, 135, 138, 139, 144, 244, 44, 83, 86])
+
+_EXTENDED_SAR = 255
+
+# bytes of a slice NAL unit read for the header, it is read again whole
+# when the header is longer, long reference list modifications or weight
+# tables
+SLICE_HEADER_BYTES = 64
+
+
+def _skip_scaling_list(reader, size):
+    last_scale = 8
+    next_scale = 8
+    for _ in range(size):
+        if next_scale:
+            next_scale = (last_scale + reader.read_se() + 256) % 256
+        if next_scale:
+            last_scale = next_scale
+
+
+def _skip_scaling_matrix(reader, count):
+    for index in range(count):
+        if reader.read_bit():
+            _skip_scaling_list(reader, 16 if index < 6 else 64)
+
+
+class SequenceParameterSet(object):
+    """
+    Sequence parameter set, width and height are the cropped picture size
+    in luma samples and frame_rate is only known from the VUI timing info
+    """
+    __slots__ = ['profile_idc', 'constraint_flags', 'level_idc', 'seq_parameter_set_id',
+                 'chroma_format_idc', 'separate_colour_plane_flag', 'bit_depth_luma',
+                 'bit_depth_chroma', 'log2_max_frame_num', 'pic_order_cnt_type',
+                 'log2_max_pic_order_cnt_lsb', 'delta_pic_order_always_zero_flag',
+                 'max_num_ref_frames', 'gaps_in_frame_num_allowed_flag', 'pic_width_in_mbs',
+                 'pic_height_in_map_units', 'frame_mbs_only_flag', 'mb_adaptive_frame_field_flag',
+                 'direct_8x8_inference_flag', 'frame_crop', 'vui_parameters_present_flag',
+                 'sample_aspect_ratio', 'num_units_in_tick', 'time_scale', 'fixed_frame_rate_flag']
+
+    def __init__(self):
+        self.chroma_format_idc = 1
+        self.separate_colour_plane_flag = 0
+        self.bit_depth_luma = 8
+        self.bit_depth_chroma = 8
+        self.log2_max_pic_order_cnt_lsb = 0
+        self.delta_pic_order_always_zero_flag = 0
+        self.mb_adaptive_frame_field_flag = 0
+        self.frame_crop = (0, 0, 0, 0)
+        self.sample_aspect_ratio = None
+        self.num_units_in_tick = 0
+        self.time_scale = 0
+        self.fixed_frame_rate_flag = 0
+
+    @property
+    def chroma_array_type(self):
+        if self.separate_colour_plane_flag:
+            return 0
+        return self.chroma_format_idc
+
+    @property
+    def width(self):
+        (left, right, _, _) = self.frame_crop
+        chroma_array_type = self.chroma_array_type
+        crop_unit_x = 1 if chroma_array_type in (0, 3) else 2
+        return self.pic_width_in_mbs * 16 - crop_unit_x * (left + right)
+
+    @property
+    def height(self):
+        (_, _, top, bottom) = self.frame_crop
+        chroma_array_type = self.chroma_array_type
+        crop_unit_y = 1 if chroma_array_type in (0, 2, 3) else 2
+        crop_unit_y *= 2 - self.frame_mbs_only_flag
+        return (2 - self.frame_mbs_only_flag) * self.pic_height_in_map_units * 16 - crop_unit_y * (top + bottom)
+
+    @property
+    def frame_rate(self):
+        """
+        Frames per second from the VUI timing info, None without it
+        """
+        if not self.num_units_in_tick or not self.time_scale:
+            return
+        return self.time_scale / (2.0 * self.num_units_in_tick)
+
+
+def _read_vui_timing(reader, sps):
+    """
+    VUI parameters up to the timing info, HRD parameters and the rest are
+    skipped
+    """
+    if reader.read_bit():
+        aspect_ratio_idc = reader.read_bits(8)
+        if aspect_ratio_idc == _EXTENDED_SAR:
+            sps.sample_aspect_ratio = (reader.read_bits(16), reader.read_bits(16))
+        else:
+            sps.sample_aspect_ratio = aspect_ratio_idc
+    if reader.read_bit():
+        reader.skip_bits(1)  # overscan_appropriate_flag
+    if reader.read_bit():
+        reader.skip_bits(4)  # video_format, video_full_range_flag
+        if reader.read_bit():
+            reader.skip_bits(24)  # colour_primaries, transfer, matrix
+    if reader.read_bit():
+        reader.read_ue()  # chroma_sample_loc_type_top_field
+        reader.read_ue()  # chroma_sample_loc_type_bottom_field
+    if reader.read_bit():
+        sps.num_units_in_tick = reader.read_bits(32)
+        sps.time_scale = reader.read_bits(32)
+        sps.fixed_frame_rate_flag = reader.read_bit()
+
+
+def parse_sps(nal):
+    """
+    SequenceParameterSet of the SPS NAL unit nal, None when malformed
+    """
+    if len(nal) < 4:
+        return
+    reader = bitstream.BitReader(bitstream.rbsp(memoryview(nal)[1:]))
+    sps = SequenceParameterSet()
+    try:
+        sps.profile_idc = reader.read_bits(8)
+        sps.constraint_flags = reader.read_bits(8)
+        sps.level_idc = reader.read_bits(8)
+        sps.seq_parameter_set_id = reader.read_ue()
+        if sps.profile_idc in _HIGH_PROFILES:
+            sps.chroma_format_idc = reader.read_ue()
+            if sps.chroma_format_idc == 3:
+                sps.separate_colour_plane_flag = reader.read_bit()
+            sps.bit_depth_luma = reader.read_ue() + 8
+            sps.bit_depth_chroma = reader.read_ue() + 8
+            reader.skip_bits(1)  # qpprime_y_zero_transform_bypass_flag
+            if reader.read_bit():
+                _skip_scaling_matrix(reader, 8 if sps.chroma_format_idc != 3 else 12)
+
+        sps.log2_max_frame_num = reader.read_ue() + 4
+        sps.pic_order_cnt_type = reader.read_ue()
+        if sps.pic_order_cnt_type == 0:
+            sps.log2_max_pic_order_cnt_lsb = reader.read_ue() + 4
+        elif sps.pic_order_cnt_type == 1:
+            sps.delta_pic_order_always_zero_flag = reader.read_bit()
+            reader.read_se()  # offset_for_non_ref_pic
+            reader.read_se()  # offset_for_top_to_bottom_field
+            for _ in range(reader.read_ue()):
+                reader.read_se()  # offset_for_ref_frame
+
+        sps.max_num_ref_frames = reader.read_ue()
+        sps.gaps_in_frame_num_allowed_flag = reader.read_bit()
+        sps.pic_width_in_mbs = reader.read_ue() + 1
+        sps.pic_height_in_map_units = reader.read_ue() + 1
+        sps.frame_mbs_only_flag = reader.read_bit()
+        if not sps.frame_mbs_only_flag:
+            sps.mb_adaptive_frame_field_flag = reader.read_bit()
+        sps.direct_8x8_inference_flag = reader.read_bit()
+        if reader.read_bit():
+            sps.frame_crop = (reader.read_ue(), reader.read_ue(), reader.read_ue(), reader.read_ue())
+        sps.vui_parameters_present_flag = reader.read_bit()
+    except bitstream.BitstreamError:
+        return
+
+    if sps.vui_parameters_present_flag:
+        try:
+            _read_vui_timing(reader, sps)
+        except bitstream.BitstreamError:
+            # the picture format is known, keep the SPS without timing
+            sps.num_units_in_tick = 0
+            sps.time_scale = 0
+    return sps
+
+
+class PictureParameterSet(object):
+    """
+    Picture parameter set, the fields after redundant_pic_cnt_present_flag
+    are only present in High profile streams
+    """
+    __slots__ = ['pic_parameter_set_id', 'seq_parameter_set_id', 'entropy_coding_mode_flag',
+                 'bottom_field_pic_order_in_frame_present_flag', 'num_slice_groups',
+                 'slice_group_map_type', 'slice_group_change_rate', 'num_ref_idx_l0_default_active',
+                 'num_ref_idx_l1_default_active', 'weighted_pred_flag', 'weighted_bipred_idc',
+                 'pic_init_qp', 'pic_init_qs', 'chroma_qp_index_offset',
+                 'deblocking_filter_control_present_flag', 'constrained_intra_pred_flag',
+                 'redundant_pic_cnt_present_flag', 'transform_8x8_mode_flag',
+                 'second_chroma_qp_index_offset']
+
+    def __init__(self):
+        self.slice_group_map_type = 0
+        self.slice_group_change_rate = 1
+        self.transform_8x8_mode_flag = 0
+
+
+def parse_pps(nal, chroma_format_idc=1):
+    """
+    PictureParameterSet of the PPS NAL unit nal, None when malformed.
+    chroma_format_idc of its SPS is only needed to skip the scaling
+    matrices of a 4:4:4 stream.
+    """
+    if len(nal) < 2:
+        return
+    reader = bitstream.BitReader(bitstream.rbsp(memoryview(nal)[1:]))
+    pps = PictureParameterSet()
+    try:
+        pps.pic_parameter_set_id = reader.read_ue()
+        pps.seq_parameter_set_id = reader.read_ue()
+        pps.entropy_coding_mode_flag = reader.read_bit()
+        pps.bottom_field_pic_order_in_frame_present_flag = reader.read_bit()
+        pps.num_slice_groups = reader.read_ue() + 1
+        if pps.num_slice_groups > 1:
+            pps.slice_group_map_type = reader.read_ue()
+            if pps.slice_group_map_type == 0:
+                for _ in range(pps.num_slice_groups):
+                    reader.read_ue()  # run_length_minus1
+            elif pps.slice_group_map_type == 2:
+                for _ in range(pps.num_slice_groups - 1):
+                    reader.read_ue()  # top_left
+                    reader.read_ue()  # bottom_right
+            elif pps.slice_group_map_type in (3, 4, 5):
+                reader.skip_bits(1)  # slice_group_change_direction_flag
+                pps.slice_group_change_rate = reader.read_ue() + 1
+            elif pps.slice_group_map_type == 6:
+                id_bits = (pps.num_slice_groups - 1).bit_length()
+                reader.skip_bits(id_bits * (reader.read_ue() + 1))
+        pps.num_ref_idx_l0_default_active = reader.read_ue() + 1
+        pps.num_ref_idx_l1_default_active = reader.read_ue() + 1
+        pps.weighted_pred_flag = reader.read_bit()
+        pps.weighted_bipred_idc = reader.read_bits(2)
+        pps.pic_init_qp = reader.read_se() + 26
+        pps.pic_init_qs = reader.read_se() + 26
+        pps.chroma_qp_index_offset = reader.read_se()
+        pps.second_chroma_qp_index_offset = pps.chroma_qp_index_offset
+        pps.deblocking_filter_control_present_flag = reader.read_bit()
+        pps.constrained_intra_pred_flag = reader.read_bit()
+        pps.redundant_pic_cnt_present_flag = reader.read_bit()
+        if reader.more_rbsp_data():
+            pps.transform_8x8_mode_flag = reader.read_bit()
+            if reader.read_bit():
+                _skip_scaling_matrix(reader, 6 + (2 if chroma_format_idc != 3 else 6) * pps.transform_8x8_mode_flag)
+            pps.second_chroma_qp_index_offset = reader.read_se()
+    except bitstream.BitstreamError:
+        return
+    return pps
+
+
+class SliceHeader(object):
+    """
+    Slice header with the parameter sets it was parsed with. slice_type is
+    taken modulo 5, see SLICE_TYPE_P and the others.
+    """
+    __slots__ = ['nal_unit_type', 'nal_ref_idc', 'sps', 'pps', 'first_mb_in_slice', 'slice_type',
+                 'colour_plane_id', 'frame_num', 'field_pic_flag', 'bottom_field_flag', 'idr_pic_id',
+                 'pic_order_cnt_lsb', 'delta_pic_order_cnt_bottom', 'delta_pic_order_cnt',
+                 'redundant_pic_cnt', 'num_ref_idx_l0_active', 'num_ref_idx_l1_active',
+                 'long_term_reference_flag', 'memory_management_control_operations',
+                 'cabac_init_idc', 'slice_qp_delta', 'disable_deblocking_filter_idc']
+
+    def __init__(self, nal_unit_type, nal_ref_idc, sps, pps):
+        self.nal_unit_type = nal_unit_type
+        self.nal_ref_idc = nal_ref_idc
+        self.sps = sps
+        self.pps = pps
+        self.colour_plane_id = 0
+        self.field_pic_flag = 0
+        self.bottom_field_flag = 0
+        self.idr_pic_id = None
+        self.pic_order_cnt_lsb = 0
+        self.delta_pic_order_cnt_bottom = 0
+        self.delta_pic_order_cnt = (0, 0)
+        self.redundant_pic_cnt = 0
+        self.num_ref_idx_l0_active = 0
+        self.num_ref_idx_l1_active = 0
+        self.long_term_reference_flag = 0
+        self.memory_management_control_operations = ()
+        self.cabac_init_idc = None
+        self.disable_deblocking_filter_idc = 0
+
+    @property
+    def idr(self):
+        return self.nal_unit_type == nalu.NALUTYPE_SLICE_IDR
+
+    @property
+    def intra(self):
+        return self.slice_type in (SLICE_TYPE_I, SLICE_TYPE_SI)
+
+    @property
+    def qp(self):
+        """
+        SliceQPY, the luma quantizer of the slice
+        """
+        return self.pps.pic_init_qp + self.slice_qp_delta
+
+
+def _skip_ref_pic_list_modification(reader):
+    if reader.read_bit():
+        while True:
+            modification_of_pic_nums_idc = reader.read_ue()
+            if modification_of_pic_nums_idc == 3:
+                break
+            if modification_of_pic_nums_idc > 5:
+                raise bitstream.BitstreamError('modification_of_pic_nums_idc %d' % modification_of_pic_nums_idc)
+            reader.read_ue()  # abs_diff_pic_num_minus1, long_term_pic_num or abs_diff_view_idx_minus1
+
+
+def _skip_weights(reader, count, chroma_array_type):
+    for _ in range(count):
+        if reader.read_bit():
+            reader.read_se()  # luma_weight
+            reader.read_se()  # luma_offset
+        if chroma_array_type and reader.read_bit():
+            for _ in range(4):
+                reader.read_se()  # chroma_weight, chroma_offset of Cb and Cr
+
+
+def _read_slice_header(reader, header):
+    sps = header.sps
+    pps = header.pps
+    if sps.separate_colour_plane_flag:
+        header.colour_plane_id = reader.read_bits(2)
+    header.frame_num = reader.read_bits(sps.log2_max_frame_num)
+    if not sps.frame_mbs_only_flag:
+        header.field_pic_flag = reader.read_bit()
+        if header.field_pic_flag:
+            header.bottom_field_flag = reader.read_bit()
+    if header.idr:
+        header.idr_pic_id = reader.read_ue()
+    bottom_field_present = pps.bottom_field_pic_order_in_frame_present_flag and not header.field_pic_flag
+    if sps.pic_order_cnt_type == 0:
+        header.pic_order_cnt_lsb = reader.read_bits(sps.log2_max_pic_order_cnt_lsb)
+        if bottom_field_present:
+            header.delta_pic_order_cnt_bottom = reader.read_se()
+    elif sps.pic_order_cnt_type == 1 and not sps.delta_pic_order_always_zero_flag:
+        delta_pic_order_cnt = reader.read_se()
+        header.delta_pic_order_cnt = (delta_pic_order_cnt, reader.read_se() if bottom_field_present else 0)
+    if pps.redundant_pic_cnt_present_flag:
+        header.redundant_pic_cnt = reader.read_ue()
+
+    slice_type = header.slice_type
+    if slice_type == SLICE_TYPE_B:
+        reader.skip_bits(1)  # direct_spatial_mv_pred_flag
+    if slice_type in (SLICE_TYPE_P, SLICE_TYPE_SP, SLICE_TYPE_B):
+        header.num_ref_idx_l0_active = pps.num_ref_idx_l0_default_active
+        if slice_type == SLICE_TYPE_B:
+            header.num_ref_idx_l1_active = pps.num_ref_idx_l1_default_active
+        if reader.read_bit():
+            header.num_ref_idx_l0_active = reader.read_ue() + 1
+            if slice_type == SLICE_TYPE_B:
+                header.num_ref_idx_l1_active = reader.read_ue() + 1
+
+    if not header.intra:
+        _skip_ref_pic_list_modification(reader)
+        if slice_type == SLICE_TYPE_B:
+            _skip_ref_pic_list_modification(reader)
+
+    if ((pps.weighted_pred_flag and slice_type in (SLICE_TYPE_P, SLICE_TYPE_SP)) or
+            (pps.weighted_bipred_idc == 1 and slice_type == SLICE_TYPE_B)):
+        chroma_array_type = sps.chroma_array_type
+        reader.read_ue()  # luma_log2_weight_denom
+        if chroma_array_type:
+            reader.read_ue()  # chroma_log2_weight_denom
+        _skip_weights(reader, header.num_ref_idx_l0_active, chroma_array_type)
+        if slice_type == SLICE_TYPE_B:
+            _skip_weights(reader, header.num_ref_idx_l1_active, chroma_array_type)
+
+    if header.nal_ref_idc:
+        if header.idr:
+            reader.skip_bits(1)  # no_output_of_prior_pics_flag
+            header.long_term_reference_flag = reader.read_bit()
+        elif reader.read_bit():
+            operations = []
+            while True:
+                operation = reader.read_ue()
+                if operation == 0:
+                    break
+                if operation > 6:
+                    raise bitstream.BitstreamError('memory_management_control_operation %d' % operation)
+                operations.append(operation)
+                if operation in (1, 3):
+                    reader.read_ue()  # difference_of_pic_nums_minus1
+                if operation == 2:
+                    reader.read_ue()  # long_term_pic_num
+                if operation in (3, 6):
+                    reader.read_ue()  # long_term_frame_idx
+                if operation == 4:
+                    reader.read_ue()  # max_long_term_frame_idx_plus1
+            header.memory_management_control_operations = tuple(operations)
+
+    if pps.entropy_coding_mode_flag and not header.intra:
+        header.cabac_init_idc = reader.read_ue()
+    header.slice_qp_delta = reader.read_se()
+    if slice_type in (SLICE_TYPE_SP, SLICE_TYPE_SI):
+        if slice_type == SLICE_TYPE_SP:
+            reader.skip_bits(1)  # sp_for_switch_flag
+        reader.read_se()  # slice_qs_delta
+    if pps.deblocking_filter_control_present_flag:
+        header.disable_deblocking_filter_idc = reader.read_ue()
+        if header.disable_deblocking_filter_idc != 1:
+            reader.read_se()  # slice_alpha_c0_offset_div2
+            reader.read_se()  # slice_beta_offset_div2
+
+
+def _parse_slice_data(nal, sps_table, pps_table, limit):
+    reader = bitstream.BitReader(bitstream.rbsp(memoryview(nal)[1:limit]))
+    first_mb_in_slice = reader.read_ue()
+    slice_type = reader.read_ue()
+    pic_parameter_set_id = reader.read_ue()
+    pps = pps_table.get(pic_parameter_set_id)
+    if pps is None:
+        return
+    sps = sps_table.get(pps.seq_parameter_set_id)
+    if sps is None:
+        return
+    if slice_type > 9:
+        raise bitstream.BitstreamError('slice_type %d' % slice_type)
+
+    header = SliceHeader(nal[0] & 0x1F, (nal[0] >> 5) & 0x03, sps, pps)
+    header.first_mb_in_slice = first_mb_in_slice
+    header.slice_type = slice_type % 5
+    _read_slice_header(reader, header)
+    return header
+
+
+def parse_slice_header(nal, sps_table, pps_table):
+    """
+    SliceHeader of the coded slice NAL unit nal (type 1 or 5), with the
+    parameter sets looked up by id in the dicts sps_table and pps_table.
+    None when malformed or a parameter set is missing.
+    """
+    if len(nal) < 2:
+        return
+    try:
+        return _parse_slice_data(nal, sps_table, pps_table, SLICE_HEADER_BYTES + 1)
+    except bitstream.BitstreamError:
+        if len(nal) <= SLICE_HEADER_BYTES + 1:
+            return
+    try:
+        return _parse_slice_data(nal, sps_table, pps_table, len(nal))
+    except bitstream.BitstreamError:
+        return
+
+
+class ParameterSetCache(object):
+    """
+    Parameter sets of one stream keyed by id, an SPS or PPS that repeats
+    with the same bytes, as streams resend them before every IDR picture,
+    is not parsed again
+    """
+    __slots__ = ['sps', 'pps', 'parameter_sets_parsed', 'parameter_sets_reused', 'slices_parsed',
+                 'missing_parameter_sets', 'malformed', '_raw_sps', '_raw_pps']
+
+    def __init__(self):
+        self.sps = {}
+        self.pps = {}
+        self.parameter_sets_parsed = 0
+        self.parameter_sets_reused = 0
+        self.slices_parsed = 0
+        self.missing_parameter_sets = 0
+        self.malformed = 0
+        self._raw_sps = {}
+        self._raw_pps = {}
+
+    def add_sps(self, nal):
+        """
+        Parse and keep the SPS NAL unit nal, returns the SequenceParameterSet
+        """
+        raw = bytes(nal)
+        for (seq_parameter_set_id, cached) in self._raw_sps.items():
+            if cached == raw:
+                self.parameter_sets_reused += 1
+                return self.sps[seq_parameter_set_id]
+        sps = parse_sps(raw)
+        if sps is None:
+            self.malformed += 1
+            return
+        self.parameter_sets_parsed += 1
+        self.sps[sps.seq_parameter_set_id] = sps
+        self._raw_sps[sps.seq_parameter_set_id] = raw
+        return sps
+
+    def add_pps(self, nal):
+        """
+        Parse and keep the PPS NAL unit nal, returns the PictureParameterSet
+        """
+        raw = bytes(nal)
+        for (pic_parameter_set_id, cached) in self._raw_pps.items():
+            if cached == raw:
+                self.parameter_sets_reused += 1
+                return self.pps[pic_parameter_set_id]
+        pps = parse_pps(raw)
+        if pps is None:
+            self.malformed += 1
+            return
+        sps = self.sps.get(pps.seq_parameter_set_id)
+        if sps is not None and sps.chroma_format_idc == 3:
+            pps = parse_pps(raw, sps.chroma_format_idc)
+        self.parameter_sets_parsed += 1
+        self.pps[pps.pic_parameter_set_id] = pps
+        self._raw_pps[pps.pic_parameter_set_id] = raw
+        return pps
+
+    def slice_header(self, nal):
+        """
+        SliceHeader of the coded slice NAL unit nal, None when malformed or
+        its parameter sets were not seen yet
+        """
+        header = parse_slice_header(nal, self.sps, self.pps)
+        if header is not None:
+            self.slices_parsed += 1
+        elif len(nal) > 1:
+            # tell a slice referring to an unknown PPS from a broken one
+            try:
+                pic_parameter_set_id = _pic_parameter_set_id(nal)
+            except bitstream.BitstreamError:
+                pic_parameter_set_id = None
+            pps = self.pps.get(pic_parameter_set_id)
+            if pic_parameter_set_id is not None and (pps is None or pps.seq_parameter_set_id not in self.sps):
+                self.missing_parameter_sets += 1
+            else:
+                self.malformed += 1
+        return header
+
+    def parse(self, nal):
+        """
+        Parse the NAL unit nal when it is an SPS, PPS or coded slice, returns
+        the SequenceParameterSet, PictureParameterSet or SliceHeader, None
+        for other NAL unit types or when it cannot be parsed
+        """
+        if not len(nal):
+            return
+        nal_unit_type = nal[0] & 0x1F
+        if nal_unit_type in (nalu.NALUTYPE_SLICE_NONIDR, nalu.NALUTYPE_SLICE_IDR):
+            return self.slice_header(nal)
+        if nal_unit_type == nalu.NALUTYPE_SPS:
+            return self.add_sps(nal)
+        if nal_unit_type == nalu.NALUTYPE_PPS:
+            return self.add_pps(nal)
+
+
+def _pic_parameter_set_id(nal):
+    reader = bitstream.BitReader(bitstream.rbsp(memoryview(nal)[1:SLICE_HEADER_BYTES + 1]))
+    reader.read_ue()  # first_mb_in_slice
+    reader.read_ue()  # slice_type
+    return reader.read_ue()
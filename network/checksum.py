@@ -0,0 +1,114 @@
+"""
+RFC 1071 internet checksum of IPv4 headers and UDP datagrams, one packet at
+a time
+
+The one's complement sum of a run of bytes is taken as a single big endian
+integer modulo 0xFFFF, every 16 bit word is worth 1 modulo 0xFFFF whatever
+its position, so the whole sum is one int.from_bytes() and one modulo.
+
+verify_ipv4_header(packet, ip_offset)   # True, False or None
+verify_udp_checksum(packet, ip_offset)  # True, False or None
+
+Verification returns None when the packet cannot be checked: it is
+truncated, a UDP datagram is fragmented or sent without a checksum.
+capture.checksums verifies whole batches of packets with NumPy.
+"""
+
+import struct
+
+from network import ipv4
+
+__author__ = 'wmoorefi'
+
+# version/ihl, total length, flags/fragment offset, protocol, source and
+# destination address
+_IPV4_PSEUDO = struct.Struct('>BxH2xHxB2xII')
+_UDP_LENGTH_CHECKSUM = struct.Struct('>4xHH')
+
+_MORE_FRAGMENTS_OFFSET = 0x3FFF
+
+
+def ones_complement_sum(buffer, offset, length, total=0):
+    """
+    16 bit one's complement sum of the length bytes of buffer at offset
+    added to total, an odd last byte is padded with a zero byte
+    """
+    value = int.from_bytes(memoryview(buffer)[offset:offset + length], 'big')
+    if length & 1:
+        value <<= 8
+    value += total
+    folded = value % 0xFFFF
+    # 0 and 0xFFFF are both zero in one's complement, only an all zero
+    # input sums to 0
+    if folded == 0 and value:
+        return 0xFFFF
+    return folded
+
+
+def ipv4_header_checksum(buffer, offset, length):
+    """
+    Internet checksum of the ip header at offset, computed with the
+    checksum field taken as zero
+    """
+    total = ones_complement_sum(buffer, offset, 10)
+    total = ones_complement_sum(buffer, offset + 12, length - 12, total)
+    return ~total & 0xFFFF
+
+
+def verify_ipv4_header(buffer, offset):
+    """
+    True when the header checksum of the ip header at offset is correct,
+    None when the header is truncated or not IPv4
+    """
+    if len(buffer) - offset < 20:
+        return
+    version_ihl = buffer[offset]
+    header_length = (version_ihl & 0x0F) * 4
+    if version_ihl >> 4 != 4 or header_length < 20 or len(buffer) - offset < header_length:
+        return
+    return ones_complement_sum(buffer, offset, header_length) == 0xFFFF
+
+
+def udp_pseudo_header_sum(source_ip, destination_ip, udp_length):
+    """
+    One's complement sum of the IPv4 pseudo header of a UDP datagram
+    """
+    return ((source_ip >> 16) + (source_ip & 0xFFFF) + (destination_ip >> 16) +
+            (destination_ip & 0xFFFF) + ipv4.PROTOCOL_UDP + udp_length)
+
+
+def udp_checksum(buffer, offset, length, source_ip, destination_ip):
+    """
+    Checksum of the UDP datagram of length bytes at offset, computed with
+    the checksum field taken as zero. A computed 0 is sent as 0xFFFF.
+    """
+    total = udp_pseudo_header_sum(source_ip, destination_ip, length)
+    total = ones_complement_sum(buffer, offset, 6, total)
+    total = ones_complement_sum(buffer, offset + 8, length - 8, total)
+    return (~total & 0xFFFF) or 0xFFFF
+
+
+def verify_udp_checksum(buffer, ip_offset):
+    """
+    True when the checksum of the UDP datagram in the ip packet at
+    ip_offset is correct, None when it cannot be checked: not UDP, a
+    fragment, a zero checksum (none sent) or a datagram cut short by the
+    capture
+    """
+    end = len(buffer)
+    if end - ip_offset < 20:
+        return
+    (version_ihl, total_length, flags_offset, protocol,
+     source_ip, destination_ip) = _IPV4_PSEUDO.unpack_from(buffer, ip_offset)
+    if protocol != ipv4.PROTOCOL_UDP or flags_offset & _MORE_FRAGMENTS_OFFSET:
+        return
+    udp_offset = ip_offset + (version_ihl & 0x0F) * 4
+    if end - udp_offset < 8:
+        return
+    (udp_length, checksum) = _UDP_LENGTH_CHECKSUM.unpack_from(buffer, udp_offset)
+    if (not checksum or udp_length < 8 or udp_offset + udp_length > end or
+            udp_offset + udp_length > ip_offset + total_length):
+        return
+
+    total = udp_pseudo_header_sum(source_ip, destination_ip, udp_length)
+    return ones_complement_sum(buffer, udp_offset, udp_length, total) == 0xFFFF
@@ -0,0 +1,220 @@
+"""
+Protocol dissector registry, packets are decoded one layer at a time and
+the dissector of the next layer is found with a single lookup in a
+dispatch table
+
+Protocol modules register their dissectors in a table under the key the
+layer below hands off with: the pcap link type, the ethertype, the IP
+protocol number, the UDP port or the RTP payload type. Tables keyed by
+small integers are compiled into lists indexed by the key, the others into
+dicts. Heuristic dissectors are only tried when the table has no entry for
+the key.
+
+registry = default_registry()
+registry.register(UDP_PORT, 20010, 'rtp', rtp.dissect_rtp, RTP_PAYLOAD_TYPE)
+for record_hdr, packet in capture.records():
+    layers = registry.dissect(packet, pcap_hdr.network, stop_at='udp')
+
+A dissector is called as dissect(buffer, offset, end) and returns
+(header, key, payload offset, payload end) or None when the buffer does not
+hold its header, key selects the next dissector in the dispatch table named
+when it was registered and is None when there is nothing to hand off. A
+key may be a tuple of keys tried in order, udp hands off the destination
+then the source port. A heuristic is tested with test(buffer, offset, end,
+key) before its dissector is called.
+
+Dissectors decode their headers through the module level unpack_*
+functions so capture.instrument counts them, a registry built after
+instrument.enable() is counted as well as one built before.
+"""
+
+import importlib
+
+__author__ = 'wmoorefi'
+
+LINKTYPE = 'linktype'
+ETHERTYPE = 'ethertype'
+IP_PROTOCOL = 'ip.protocol'
+UDP_PORT = 'udp.port'
+RTP_PAYLOAD_TYPE = 'rtp.payload_type'
+
+# tables compiled into lists, every key is below the size
+TABLE_SIZES = {
+    IP_PROTOCOL: 256,
+    UDP_PORT: 65536,
+    RTP_PAYLOAD_TYPE: 128,
+}
+
+# modules with a register(registry) function, in the order default_registry
+# imports them
+DEFAULT_MODULES = ['network.ethernet', 'network.ipv4', 'network.udp', 'network.rtp', 'h264.nalu']
+
+
+class Layer(object):
+    """
+    One decoded layer, its header spans buffer[offset:end] with its payload
+    """
+    __slots__ = ['name', 'header', 'offset', 'end']
+
+    def __init__(self, name, header, offset, end):
+        self.name = name
+        self.header = header
+        self.offset = offset
+        self.end = end
+
+
+class _Dissector(object):
+    __slots__ = ['name', 'dissect', 'next_table', 'test', 'next_lookup', 'next_heuristics']
+
+    def __init__(self, name, dissect, next_table, test=None):
+        self.name = name
+        self.dissect = dissect
+        self.next_table = next_table
+        self.test = test
+        # filled in by DissectorRegistry.compile()
+        self.next_lookup = None
+        self.next_heuristics = ()
+
+
+class _DictTable(dict):
+    """
+    dict whose missing keys read as None, so a dict and a list table are
+    both a single subscript
+    """
+    __slots__ = []
+
+    def __missing__(self, key):
+        return
+
+
+class DissectorRegistry(object):
+    """
+    Dispatch tables of dissectors, compiled on the first dissect() after
+    a registration
+    """
+    __slots__ = ['_entries', '_heuristics', '_tables']
+
+    def __init__(self):
+        self._entries = {}
+        self._heuristics = {}
+        self._tables = None
+
+    def register(self, table, key, name, dissect, next_table=None):
+        """
+        Dissect payloads handed off with key in table with dissect, naming
+        the layer name, its own payloads are dispatched through next_table.
+        A later registration of the same key replaces the earlier one.
+        """
+        size = TABLE_SIZES.get(table)
+        if size is not None and not 0 <= key < size:
+            raise Exception('key %r out of range of the %s table' % (key, table))
+        self._entries.setdefault(table, {})[key] = _Dissector(name, dissect, next_table)
+        self._tables = None
+
+    def register_heuristic(self, table, name, test, dissect, next_table=None):
+        """
+        Dissect payloads of table keys without an entry with dissect when
+        test(buffer, offset, end, key) is true, heuristics are tried in the
+        order they were registered
+        """
+        self._heuristics.setdefault(table, []).append(_Dissector(name, dissect, next_table, test))
+        self._tables = None
+
+    def unregister(self, table, key):
+        self._entries.get(table, {}).pop(key, None)
+        self._tables = None
+
+    def compile(self):
+        """
+        Build the dispatch tables and link every dissector to the table of
+        its next layer
+        """
+        tables = {}
+        for (table, entries) in self._entries.items():
+            size = TABLE_SIZES.get(table)
+            if size is None:
+                lookup = _DictTable(entries)
+            else:
+                lookup = [None] * size
+                for (key, dissector) in entries.items():
+                    lookup[key] = dissector
+            tables[table] = lookup
+
+        dissectors = [dissector for entries in self._entries.values() for dissector in entries.values()]
+        dissectors.extend(dissector for heuristics in self._heuristics.values() for dissector in heuristics)
+        for dissector in dissectors:
+            dissector.next_lookup = tables.get(dissector.next_table)
+            dissector.next_heuristics = tuple(self._heuristics.get(dissector.next_table, ()))
+            if dissector.next_lookup is None and dissector.next_heuristics:
+                dissector.next_lookup = _DictTable()
+        self._tables = tables
+        return tables
+
+    def dissect(self, buffer, linktype, offset=0, end=None, max_depth=None, stop_at=None):
+        """
+        Layers of the packet in buffer captured with the pcap linktype,
+        decoding stops after max_depth layers or after the layer named
+        stop_at, or when no dissector is registered for a payload
+        """
+        tables = self._tables
+        if tables is None:
+            tables = self.compile()
+        if end is None:
+            end = len(buffer)
+
+        layers = []
+        lookup = tables.get(LINKTYPE)
+        if lookup is None:
+            return layers
+        dissector = lookup[linktype]
+        heuristics = ()
+        key = linktype
+        remaining = -1 if max_depth is None else max_depth
+        while remaining:
+            if dissector is None:
+                for heuristic in heuristics:
+                    if heuristic.test(buffer, offset, end, key):
+                        dissector = heuristic
+                        break
+                else:
+                    break
+            decoded = dissector.dissect(buffer, offset, end)
+            if decoded is None:
+                break
+            (header, key, payload_offset, payload_end) = decoded
+            layers.append(Layer(dissector.name, header, offset, end))
+            lookup = dissector.next_lookup
+            if key is None or lookup is None or dissector.name == stop_at:
+                break
+            heuristics = dissector.next_heuristics
+            if type(key) is tuple:
+                for candidate in key:
+                    next_dissector = lookup[candidate]
+                    if next_dissector is not None:
+                        break
+            else:
+                next_dissector = lookup[key]
+            dissector = next_dissector
+            offset = payload_offset
+            end = payload_end
+            remaining -= 1
+        return layers
+
+
+def find_layer(layers, name):
+    """
+    Header of the layer named name, None when the packet does not have it
+    """
+    for layer in layers:
+        if layer.name == name:
+            return layer.header
+
+
+def default_registry():
+    """
+    Registry with the dissectors of DEFAULT_MODULES
+    """
+    registry = DissectorRegistry()
+    for module_name in DEFAULT_MODULES:
+        importlib.import_module(module_name).register(registry)
+    return registry
@@ -1,11 +1,23 @@
 import struct
 
+from network import dissect
+from network import lazy
+from network import pcap
+
 __author__ = 'wmoorefi'
 
 ETHERTYPE_IPV4 = 0x0800
 ETHERTYPE_8021Q = 0x8100
 ETHERTYPE_8021AD = 0x88A8
 
+_ETHERNET_HDR = struct.Struct('>BBBBBBBBBBBBH')
+_MAC = struct.Struct('>BBBBBB')
+_ETHERTYPE = struct.Struct('>H')
+# tag control information and the ethertype following a vlan tag
+_VLAN_TAG = struct.Struct('>HH')
+
+_VLAN_TPIDS = (ETHERTYPE_8021Q, ETHERTYPE_8021AD)
+
 
 class EthernetExtensionHeader(object):
     """"
@@ -36,27 +48,155 @@ class EthernetHeader(object):
     """
     __slots__ = ['destination_mac', 'source_mac', 'ethertype', 'ext']
 
-    def __init__(self, destination_mac, source_mac, ethertype, ext=[]):
+    def __init__(self, destination_mac, source_mac, ethertype, ext=()):
         self.destination_mac = destination_mac
         self.source_mac = source_mac
         self.ethertype = ethertype
         self.ext = ext
 
     def __len__(self):
-        return 14  # FIXME account for ext size
+        return 14 + (len(self.ext) * 4)
+
+    @property
+    def payload_ethertype(self):
+        """
+        Ethertype of the payload, after any vlan tags
+        """
+        if self.ext:
+            return self.ext[-1].ethertype
+        return self.ethertype
 
 
 def read_ethernet_header(input_stream, byte_swap):
     chunk = input_stream.read(14)
-    if chunk == '':
+    if not chunk:
         return
 
-    if byte_swap:
-        raw_unpacked = struct.unpack('<BBBBBBBBBBBBH', chunk)
-    else:
-        raw_unpacked = struct.unpack('>BBBBBBBBBBBBH', chunk)
+    # one vlan tag per read until the ethertype is not a tag protocol id
+    while len(chunk) >= 14 and _ETHERTYPE.unpack_from(chunk, len(chunk) - 2)[0] in _VLAN_TPIDS:
+        tag_chunk = input_stream.read(_VLAN_TAG.size)
+        if len(tag_chunk) < _VLAN_TAG.size:
+            return
+        chunk += tag_chunk
+
+    return unpack_ethernet_header(chunk, 0, byte_swap)
+
+
+def _unpack_vlan_tags(buffer, offset):
+    ext = []
+    ethertype = _ETHERTYPE.unpack_from(buffer, offset + 12)[0]
+    offset += 14
+    while ethertype in _VLAN_TPIDS:
+        if len(buffer) - offset < _VLAN_TAG.size:
+            break
+        (tci, ethertype) = _VLAN_TAG.unpack_from(buffer, offset)
+        ext.append(EthernetExtensionHeader(tci >> 13, (tci >> 12) & 0x1, tci & 0x0FFF, ethertype))
+        offset += _VLAN_TAG.size
+    return tuple(ext)
+
+
+def ethernet_payload_offset(buffer, offset=0):
+    """
+    (payload ethertype, payload offset) of the ethernet frame at offset,
+    walking stacked 802.1Q/802.1ad tags without building header objects,
+    returns None when the buffer is too short
+    """
+    end = len(buffer)
+    if end - offset < 14:
+        return
+    ethertype = _ETHERTYPE.unpack_from(buffer, offset + 12)[0]
+    offset += 14
+    while ethertype in _VLAN_TPIDS:
+        if end - offset < _VLAN_TAG.size:
+            return
+        ethertype = _ETHERTYPE.unpack_from(buffer, offset + 2)[0]
+        offset += _VLAN_TAG.size
+    return ethertype, offset
+
+
+def unpack_ethernet_header(buffer, offset, byte_swap):
+    """
+    Parse ethernet header, with any stacked vlan tags, from buffer starting
+    at offset, returns None when the buffer is too short
+
+    Header fields are always in network byte order, byte_swap only applies
+    to the pcap framing and is accepted to keep the parser signatures alike
+    """
+    if len(buffer) - offset < 14:
+        return
+
+    raw_unpacked = _ETHERNET_HDR.unpack_from(buffer, offset)
     destination_mac = raw_unpacked[:6]
     source_mac = raw_unpacked[6:12]
     ethertype = raw_unpacked[-1]
+    if ethertype in _VLAN_TPIDS:
+        ext = _unpack_vlan_tags(buffer, offset)
+        if not ext or ext[-1].ethertype in _VLAN_TPIDS:
+            return  # truncated in the tags
+        return EthernetHeader(destination_mac, source_mac, ethertype, ext)
 
     return EthernetHeader(destination_mac, source_mac, ethertype)
+
+
+class EthernetHeaderView(EthernetHeader):
+    """
+    EthernetHeader decoded lazily, each field is unpacked from the packet
+    buffer when it is read. Views are read-only and only valid while the
+    buffer is.
+    """
+    __slots__ = ['_buffer', '_offset']
+
+    destination_mac = lazy.cached_field(lambda buffer, offset: _MAC.unpack_from(buffer, offset),
+                                        EthernetHeader.destination_mac)
+    source_mac = lazy.cached_field(lambda buffer, offset: _MAC.unpack_from(buffer, offset + 6),
+                                   EthernetHeader.source_mac)
+    ethertype = lazy.field(_ETHERTYPE, 12)
+    ext = lazy.cached_field(_unpack_vlan_tags, EthernetHeader.ext)
+
+    def __init__(self, buffer, offset):
+        self._buffer = buffer
+        self._offset = offset
+
+    def unpack(self):
+        """
+        Eager header of the same bytes, for a packet whose other fields are
+        all going to be read
+        """
+        return unpack_ethernet_header(self._buffer, self._offset, False)
+
+    def __len__(self):
+        if self.ethertype in _VLAN_TPIDS:
+            return 14 + (len(self.ext) * 4)
+        return 14
+
+    @property
+    def payload_ethertype(self):
+        ethertype = self.ethertype
+        if ethertype in _VLAN_TPIDS and self.ext:
+            return self.ext[-1].ethertype
+        return ethertype
+
+
+def view_ethernet_header(buffer, offset):
+    """
+    Lazily decoding EthernetHeaderView of the header at offset, returns None
+    when the buffer is too short, vlan tags are only checked when ext is read
+    """
+    if len(buffer) - offset < 14:
+        return
+
+    return EthernetHeaderView(buffer, offset)
+
+
+def dissect_ethernet(buffer, offset, end):
+    """
+    Dissector of ethernet frames, hands off the ethertype after any vlan tags
+    """
+    eth_hdr = unpack_ethernet_header(buffer, offset, False)
+    if eth_hdr is None:
+        return
+    return eth_hdr, eth_hdr.payload_ethertype, offset + len(eth_hdr), end
+
+
+def register(registry):
+    registry.register(dissect.LINKTYPE, pcap.LINKTYPE_ETHERNET, 'ethernet', dissect_ethernet, dissect.ETHERTYPE)
@@ -0,0 +1,361 @@
+"""
+Capture filter expressions evaluated against raw packet bytes
+
+A small BPF-like language over the fields of EthernetHeader, Ipv4Header,
+UdpHeader and RtpHeader:
+
+    ipv4.protocol == 17 and udp.destination_port >= 20000
+    rtp.ssrc in (0x1234, 0x5678) and not rtp.marker_bit == 1
+    ipv4.source_ip == 10.0.0.1 or ethernet.source_mac == 0a:0b:0c:0d:0e:0f
+    udp and not rtp
+
+Fields are written layer.attribute with the attribute names of the header
+classes, a bare layer name tests that the layer is present. Comparisons
+are == != < <= > >= and "in (value, ...)", values are integers (decimal or
+0x hex), dotted IPv4 addresses or colon separated MAC addresses.
+
+An expression is compiled once to Python code that reads each field with
+a precompiled struct at its fixed offset in the packet, no header objects
+are built. A comparison on a layer the packet does not have is false. The
+rtp layer is assumed as the udp payload when its version field reads 2.
+IPv4 fragments after the first have no udp or rtp layer.
+
+capture_filter = compile_filter('udp.destination_port == 20010')
+for record_hdr, packet in filter_records(pcap_hdr, buffer, capture_filter):
+    ...
+"""
+
+import re
+import struct
+
+from network import ethernet
+from network import ipv4
+from network import pcap
+
+__author__ = 'wmoorefi'
+
+_B = struct.Struct('>B')
+_H = struct.Struct('>H')
+_I = struct.Struct('>I')
+
+_ETHERNET_HDR_LENGTH = 14
+_VLAN_TAGS_LENGTH = 8
+_UDP_HDR_LENGTH = 8
+_RTP_HDR_LENGTH = 12
+
+# layer -> field -> (offset in layer, struct, shift, mask)
+_INTEGER_FIELDS = {
+    'ethernet': {
+        'ethertype': (12, _H, 0, 0xFFFF),
+    },
+    'ipv4': {
+        'version': (0, _B, 4, 0x0F),
+        'internet_hdr_length': (0, _B, 0, 0x0F),  # scaled to bytes below
+        'dscp': (1, _B, 2, 0x3F),
+        'explicit_congestion_notification': (1, _B, 0, 0x03),
+        'total_length': (2, _H, 0, 0xFFFF),
+        'identification': (4, _H, 0, 0xFFFF),
+        'flags': (6, _H, 13, 0x07),
+        'fragment_offset': (6, _H, 0, 0x1FFF),
+        'time_to_live': (8, _B, 0, 0xFF),
+        'protocol': (9, _B, 0, 0xFF),
+        'header_checksum': (10, _H, 0, 0xFFFF),
+        'source_ip': (12, _I, 0, 0xFFFFFFFF),
+        'destination_ip': (16, _I, 0, 0xFFFFFFFF),
+    },
+    'udp': {
+        'source_port': (0, _H, 0, 0xFFFF),
+        'destination_port': (2, _H, 0, 0xFFFF),
+        'length': (4, _H, 0, 0xFFFF),
+        'checksum': (6, _H, 0, 0xFFFF),
+    },
+    'rtp': {
+        'version': (0, _B, 6, 0x03),
+        'padding_flag': (0, _B, 5, 0x01),
+        'marker_bit': (1, _B, 7, 0x01),
+        'payload_type': (1, _B, 0, 0x7F),
+        'sequence_number': (2, _H, 0, 0xFFFF),
+        'timestamp': (4, _I, 0, 0xFFFFFFFF),
+        'ssrc': (8, _I, 0, 0xFFFFFFFF),
+    },
+}
+
+# layer -> field -> (offset in layer, length)
+_BYTES_FIELDS = {
+    'ethernet': {
+        'destination_mac': (0, 6),
+        'source_mac': (6, 6),
+    },
+}
+
+_LAYERS = ['ethernet', 'ipv4', 'udp', 'rtp']
+
+# bytes of the packet the deepest layer can reach, ethernet with two vlan
+# tags (QinQ) and ipv4 with full options
+_LAYER_SNAP_LENGTH = {
+    'ethernet': _ETHERNET_HDR_LENGTH,
+    'ipv4': _ETHERNET_HDR_LENGTH + _VLAN_TAGS_LENGTH + 60,
+    'udp': _ETHERNET_HDR_LENGTH + _VLAN_TAGS_LENGTH + 60 + _UDP_HDR_LENGTH,
+    'rtp': _ETHERNET_HDR_LENGTH + _VLAN_TAGS_LENGTH + 60 + _UDP_HDR_LENGTH + _RTP_HDR_LENGTH,
+}
+
+_TOKEN_RE = re.compile(r'''
+    \s*(?:
+        (?P<mac>[0-9A-Fa-f]{2}(?::[0-9A-Fa-f]{2}){5})
+      | (?P<ip>\d+\.\d+\.\d+\.\d+)
+      | (?P<number>0[xX][0-9A-Fa-f]+|\d+)
+      | (?P<name>[A-Za-z_][A-Za-z_0-9]*(?:\.[A-Za-z_][A-Za-z_0-9]*)?)
+      | (?P<op>==|!=|<=|>=|<|>|\(|\)|,)
+    )''', re.VERBOSE)
+
+_COMPARISONS = ['==', '!=', '<', '<=', '>', '>=']
+
+
+class FilterError(Exception):
+    pass
+
+
+def _ipv4_offset(packet):
+    link = ethernet.ethernet_payload_offset(packet)
+    if link is None or link[0] != ethernet.ETHERTYPE_IPV4:
+        return -1
+    offset = link[1]
+    if len(packet) < offset + 20 or _B.unpack_from(packet, offset)[0] >> 4 != 4:
+        return -1
+    return offset
+
+
+def _udp_offset(packet, ipv4_offset):
+    if ipv4_offset < 0 or _B.unpack_from(packet, ipv4_offset + 9)[0] != ipv4.PROTOCOL_UDP:
+        return -1
+    if _H.unpack_from(packet, ipv4_offset + 6)[0] & 0x1FFF:
+        return -1  # later fragment, its payload does not start with a udp header
+    offset = ipv4_offset + (_B.unpack_from(packet, ipv4_offset)[0] & 0x0F) * 4
+    if len(packet) < offset + _UDP_HDR_LENGTH:
+        return -1
+    return offset
+
+
+def _rtp_offset(packet, udp_offset):
+    if udp_offset < 0:
+        return -1
+    offset = udp_offset + _UDP_HDR_LENGTH
+    if len(packet) < offset + _RTP_HDR_LENGTH or _B.unpack_from(packet, offset)[0] >> 6 != 2:
+        return -1
+    return offset
+
+
+class _Parser(object):
+    """
+    Recursive descent parser emitting a Python expression over the layer
+    offset variables ethernet, ipv4, udp and rtp
+    """
+
+    def __init__(self, expression):
+        self.tokens = self._tokenize(expression)
+        self.position = 0
+        self.layers = set()
+
+    @staticmethod
+    def _tokenize(expression):
+        tokens = []
+        position = 0
+        expression = expression.rstrip()
+        while position < len(expression):
+            match = _TOKEN_RE.match(expression, position)
+            if match is None or match.end() == position:
+                raise FilterError('unexpected input at %d: %r' % (position, expression[position:]))
+            tokens.append((match.lastgroup, match.group(match.lastgroup)))
+            position = match.end()
+        return tokens
+
+    def _peek(self):
+        if self.position < len(self.tokens):
+            return self.tokens[self.position]
+        return None, None
+
+    def _next(self):
+        token = self._peek()
+        if token[0] is None:
+            raise FilterError('unexpected end of expression')
+        self.position += 1
+        return token
+
+    def _expect(self, value):
+        kind, text = self._next()
+        if text != value:
+            raise FilterError('expected %r, found %r' % (value, text))
+
+    def parse(self):
+        if not self.tokens:
+            return 'True'
+        code = self._or()
+        if self._peek()[0] is not None:
+            raise FilterError('unexpected %r' % (self._peek()[1],))
+        return code
+
+    def _or(self):
+        terms = [self._and()]
+        while self._peek() == ('name', 'or'):
+            self._next()
+            terms.append(self._and())
+        return terms[0] if len(terms) == 1 else '(%s)' % ' or '.join(terms)
+
+    def _and(self):
+        terms = [self._not()]
+        while self._peek() == ('name', 'and'):
+            self._next()
+            terms.append(self._not())
+        return terms[0] if len(terms) == 1 else '(%s)' % ' and '.join(terms)
+
+    def _not(self):
+        if self._peek() == ('name', 'not'):
+            self._next()
+            return '(not %s)' % self._not()
+        return self._atom()
+
+    def _atom(self):
+        kind, text = self._next()
+        if text == '(':
+            code = self._or()
+            self._expect(')')
+            return code
+        if kind != 'name':
+            raise FilterError('expected a field, found %r' % (text,))
+
+        if '.' not in text:
+            if text not in _LAYERS:
+                raise FilterError('unknown layer %r' % (text,))
+            self.layers.add(text)
+            return '(%s >= 0)' % text
+
+        (layer, field) = text.split('.')
+        if layer not in _LAYERS:
+            raise FilterError('unknown layer %r' % (layer,))
+        self.layers.add(layer)
+
+        if field in _BYTES_FIELDS.get(layer, {}):
+            return self._bytes_comparison(layer, field)
+        if field not in _INTEGER_FIELDS[layer]:
+            raise FilterError('unknown field %r' % (text,))
+        return self._integer_comparison(layer, field)
+
+    def _value(self):
+        kind, text = self._next()
+        if kind == 'number':
+            return int(text, 0)
+        if kind == 'ip':
+            octets = [int(octet) for octet in text.split('.')]
+            if any(octet > 255 for octet in octets):
+                raise FilterError('invalid address %r' % (text,))
+            return _I.unpack(bytearray(octets))[0]
+        raise FilterError('expected a value, found %r' % (text,))
+
+    def _integer_comparison(self, layer, field):
+        (offset, field_struct, shift, mask) = _INTEGER_FIELDS[layer][field]
+        access = '_%s(packet, %s + %d)[0]' % ({_B: 'B', _H: 'H', _I: 'I'}[field_struct], layer, offset)
+        if shift:
+            access = '(%s >> %d)' % (access, shift)
+        if mask != (0xFF, 0xFFFF, 0xFFFFFFFF)[[_B, _H, _I].index(field_struct)] >> shift:
+            access = '(%s & 0x%x)' % (access, mask)
+        if layer == 'ipv4' and field == 'internet_hdr_length':
+            access = '(%s * 4)' % access
+
+        kind, text = self._next()
+        if text == 'in':
+            self._expect('(')
+            values = [self._value()]
+            while self._peek()[1] == ',':
+                self._next()
+                values.append(self._value())
+            self._expect(')')
+            return '(%s >= 0 and %s in %r)' % (layer, access, frozenset(values))
+        if text not in _COMPARISONS:
+            raise FilterError('expected a comparison, found %r' % (text,))
+        return '(%s >= 0 and %s %s %d)' % (layer, access, text, self._value())
+
+    def _bytes_comparison(self, layer, field):
+        (offset, length) = _BYTES_FIELDS[layer][field]
+        kind, op = self._next()
+        if op not in ('==', '!='):
+            raise FilterError('%s.%s only supports == and !=' % (layer, field))
+        kind, text = self._next()
+        if kind != 'mac':
+            raise FilterError('expected a MAC address, found %r' % (text,))
+        value = bytes(bytearray(int(octet, 16) for octet in text.split(':')))
+        return '(%s >= 0 and bytes(packet[%s + %d:%s + %d]) %s %r)' % (layer, layer, offset, layer,
+                                                                     offset + length, op, value)
+
+
+class CaptureFilter(object):
+    """
+    Compiled filter, call it with the packet data of a record. snap_length
+    is the number of leading packet bytes the predicate can look at.
+    """
+    __slots__ = ['expression', 'source', 'predicate', 'snap_length']
+
+    def __init__(self, expression, source, predicate, snap_length):
+        self.expression = expression
+        self.source = source
+        self.predicate = predicate
+        self.snap_length = snap_length
+
+    def __call__(self, packet):
+        return self.predicate(packet)
+
+
+def compile_filter(expression):
+    """
+    Compile a filter expression, raises FilterError on syntax errors
+    """
+    parser = _Parser(expression)
+    condition = parser.parse()
+
+    deepest = max([_LAYERS.index(layer) for layer in parser.layers] or [-1])
+    lines = ['def predicate(packet):']
+    if deepest >= 0:
+        lines.append('    ethernet = 0 if len(packet) >= %d else -1' % _ETHERNET_HDR_LENGTH)
+    if deepest >= 1:
+        lines.append('    ipv4 = _ipv4_offset(packet)')
+    if deepest >= 2:
+        lines.append('    udp = _udp_offset(packet, ipv4)')
+    if deepest >= 3:
+        lines.append('    rtp = _rtp_offset(packet, udp)')
+    lines.append('    return bool(%s)' % condition)
+    source = '\n'.join(lines)
+
+    namespace = {'_B': _B.unpack_from, '_H': _H.unpack_from, '_I': _I.unpack_from,
+                 '_ipv4_offset': _ipv4_offset, '_udp_offset': _udp_offset, '_rtp_offset': _rtp_offset}
+    exec(compile(source, '<filter %r>' % expression, 'exec'), namespace)
+
+    snap_length = _LAYER_SNAP_LENGTH[_LAYERS[deepest]] if deepest >= 0 else 0
+    return CaptureFilter(expression, source, namespace['predicate'], snap_length)
+
+
+def filter_records(pcap_hdr, buffer, capture_filter, offset=pcap.PCAP_HDR_LENGTH):
+    """
+    Walk the records of an in-memory or memory-mapped capture and yield
+    (record header, packet data) for those matching the filter
+    """
+    for record_hdr, packet in pcap.iter_pcap_records(pcap_hdr, buffer, offset):
+        if capture_filter(packet):
+            yield record_hdr, packet
+
+
+def filter_stream(pcap_hdr, input_file, capture_filter):
+    """
+    Read records from a stream positioned after the pcap header, only the
+    first snap_length bytes of a packet are read to test it, the rest of a
+    rejected packet is skipped with seek using incl_len. Yields
+    (record header, packet data) for matching records.
+    """
+    while True:
+        record_hdr = pcap.read_pcap_record(pcap_hdr, input_file)
+        if record_hdr is None:
+            break
+
+        head = input_file.read(min(record_hdr.incl_len, capture_filter.snap_length))
+        if capture_filter(head):
+            yield record_hdr, head + input_file.read(record_hdr.incl_len - len(head))
+        else:
+            input_file.seek(record_hdr.incl_len - len(head), 1)
@@ -0,0 +1,264 @@
+"""
+Flow table keyed by the IPv4 5-tuple with per-flow payload dispatch
+
+The 5-tuple is read straight from the packet bytes at fixed offsets, no
+header objects are built to find the flow a packet belongs to. The payload
+decoder of a flow is resolved once, when the flow is first seen, from the
+exact flows and port ranges registered on the table. Packets of flows
+without a decoder are only counted.
+
+flow_table = FlowTable(idle_timeout=60)
+flow_table.register_port(decode_rtp, 20000, 20010)
+for record_hdr, packet in capture.records():
+    result = flow_table.process(record_hdr, packet)
+
+Decoders are called as decoder(flow, record_hdr, packet, offset, end) with
+offset and end delimiting the transport payload in packet. A decoder with a
+close(flow) method is told when a flow is evicted or the table closed.
+
+With verify_checksums process() checks the IPv4 header and UDP checksums of
+every packet it would hand to a decoder, packets that fail are counted in
+checksum_errors of their flow instead.
+"""
+
+import collections
+import struct
+
+from network import checksum
+from network import ethernet
+from network import ipv4
+from network import rtp
+
+__author__ = 'wmoorefi'
+
+# version/ihl, flags/fragment offset, protocol, source and destination address
+_IPV4_FLOW = struct.Struct('>B5xHxB2xII')
+_IPV4_TOTAL_LENGTH = struct.Struct('>2xH')
+_PORTS = struct.Struct('>HH')
+# data offset of the tcp header, in 32 bit words
+_TCP_DATA_OFFSET = struct.Struct('>12xB')
+
+_ETHERNET_HDR_LENGTH = 14
+_UDP_HDR_LENGTH = 8
+_TCP_HDR_LENGTH = 20
+
+
+class Flow(object):
+    """
+    Counters and decoder of one 5-tuple, key is (source_ip, destination_ip,
+    protocol, source_port, destination_port) with addresses as uint32.
+    first_seen and last_seen are record ts_sec values, state is free for the
+    decoder to keep per flow data in. checksum_errors counts the packets
+    process() dropped for a bad checksum.
+    """
+    __slots__ = ['key', 'decoder', 'packets', 'bytes', 'first_seen', 'last_seen', 'state',
+                 'checksum_errors']
+
+    def __init__(self, key, decoder, first_seen):
+        self.key = key
+        self.decoder = decoder
+        self.packets = 0
+        self.bytes = 0
+        self.first_seen = first_seen
+        self.last_seen = first_seen
+        self.state = None
+        self.checksum_errors = 0
+
+
+def flow_key(packet, offset=_ETHERNET_HDR_LENGTH):
+    """
+    5-tuple of the IPv4 packet starting at offset, returns
+    (key, payload offset, payload end) or None when the packet is not
+    IPv4 or its udp or tcp header is truncated. The payload follows the
+    udp header, or the tcp header and its options. Ports are zero for
+    protocols other than UDP and TCP and for fragments after the first,
+    reassemble fragments beforehand with network.reassembly to have them
+    classified with their flow.
+    """
+    end = len(packet)
+    if end - offset < 20:
+        return
+
+    (version_ihl, flags_offset, protocol, source_ip, destination_ip) = _IPV4_FLOW.unpack_from(packet, offset)
+    if version_ihl >> 4 != 4:
+        return
+    payload_offset = offset + (version_ihl & 0x0F) * 4
+    end = min(end, offset + _IPV4_TOTAL_LENGTH.unpack_from(packet, offset)[0])
+
+    if (protocol == ipv4.PROTOCOL_UDP or protocol == ipv4.PROTOCOL_TCP) and not flags_offset & 0x1FFF:
+        if protocol == ipv4.PROTOCOL_UDP:
+            header_length = _UDP_HDR_LENGTH
+        elif end - payload_offset < _TCP_HDR_LENGTH:
+            return
+        else:
+            header_length = (_TCP_DATA_OFFSET.unpack_from(packet, payload_offset)[0] >> 4) * 4
+        if end - payload_offset < header_length:
+            return
+        (source_port, destination_port) = _PORTS.unpack_from(packet, payload_offset)
+        payload_offset += header_length
+    else:
+        source_port = destination_port = 0
+
+    return (source_ip, destination_ip, protocol, source_port, destination_port), payload_offset, end
+
+
+def decode_raw(flow, record_hdr, packet, offset, end):
+    """
+    Payload as a memoryview slice of the packet
+    """
+    return memoryview(packet)[offset:end]
+
+
+def decode_rtp(flow, record_hdr, packet, offset, end):
+    """
+    (RtpHeader, payload) of an rtp packet, None when it does not parse
+    """
+    rtp_hdr = rtp.unpack_rtp_header(packet, offset, False)
+    if rtp_hdr is None or rtp_hdr.version != 2:
+        return
+    return rtp_hdr, rtp.rtp_payload(packet, offset, rtp_hdr, end)
+
+
+class FlowTable(object):
+    """
+    Flows live until they have been idle for idle_timeout seconds of capture
+    time, at most max_flows are kept, the least recently seen are evicted
+    first. flows is kept in least recently seen order, a hit moves its flow
+    to the end and a full table evicts from the front. on_evict is called
+    with every flow leaving the table. verify_checksums drops packets with
+    a bad IPv4 header or UDP checksum in process().
+    """
+    __slots__ = ['flows', 'idle_timeout', 'max_flows', 'on_evict', 'verify_checksums', 'evicted',
+                 '_flow_decoders', '_port_decoders', '_next_sweep']
+
+    def __init__(self, idle_timeout=300, max_flows=65536, on_evict=None, verify_checksums=False):
+        self.flows = collections.OrderedDict()
+        self.idle_timeout = idle_timeout
+        self.max_flows = max_flows
+        self.on_evict = on_evict
+        self.verify_checksums = verify_checksums
+        self.evicted = 0
+        self._flow_decoders = {}
+        self._port_decoders = []
+        self._next_sweep = None
+
+    def __len__(self):
+        return len(self.flows)
+
+    def register_flow(self, key, decoder):
+        """
+        Decode the flow with exactly this 5-tuple, takes precedence over
+        port ranges
+        """
+        self._flow_decoders[key] = decoder
+
+    def register_port(self, decoder, low_port, high_port=None, protocol=ipv4.PROTOCOL_UDP):
+        """
+        Decode flows with a source or destination port in
+        [low_port, high_port], the first registered range that matches wins
+        """
+        if high_port is None:
+            high_port = low_port
+        self._port_decoders.append((protocol, low_port, high_port, decoder))
+
+    def _resolve_decoder(self, key):
+        decoder = self._flow_decoders.get(key)
+        if decoder is not None:
+            return decoder
+
+        (source_ip, destination_ip, protocol, source_port, destination_port) = key
+        for (range_protocol, low_port, high_port, decoder) in self._port_decoders:
+            if range_protocol == protocol and (low_port <= destination_port <= high_port or
+                                               low_port <= source_port <= high_port):
+                return decoder
+
+    def classify(self, record_hdr, packet):
+        """
+        Find or create the flow of an ethernet packet and count it, returns
+        (flow, payload offset, payload end), flow is None for packets
+        that are not IPv4. Vlan tagged frames are classified on their
+        payload.
+        """
+        return self._classify(record_hdr, packet)[1:]
+
+    def _classify(self, record_hdr, packet):
+        """
+        classify() with the offset of the ip header in front
+        """
+        link = ethernet.ethernet_payload_offset(packet)
+        if link is None or link[0] != ethernet.ETHERTYPE_IPV4:
+            return 0, None, 0, 0
+        found = flow_key(packet, link[1])
+        if found is None:
+            return 0, None, 0, 0
+        (key, offset, end) = found
+
+        now = record_hdr.ts_sec
+        flow = self.flows.get(key)
+        if flow is None:
+            if self._next_sweep is None:
+                self._next_sweep = now + self._sweep_interval()
+            if len(self.flows) >= self.max_flows:
+                self._evict_oldest(len(self.flows) - self.max_flows + 1)
+            flow = Flow(key, self._resolve_decoder(key), now)
+            self.flows[key] = flow
+        else:
+            self.flows.move_to_end(key)
+        flow.packets += 1
+        flow.bytes += record_hdr.orig_len
+        flow.last_seen = now
+
+        if now >= self._next_sweep:
+            self.evict_idle(now)
+
+        return link[1], flow, offset, end
+
+    def process(self, record_hdr, packet):
+        """
+        classify() and hand the payload to the flow decoder, returns what
+        the decoder returns or None when the flow has no decoder
+        """
+        (ip_offset, flow, offset, end) = self._classify(record_hdr, packet)
+        if flow is None or flow.decoder is None:
+            return
+        if self.verify_checksums and (checksum.verify_ipv4_header(packet, ip_offset) is False or
+                                      checksum.verify_udp_checksum(packet, ip_offset) is False):
+            flow.checksum_errors += 1
+            return
+        return flow.decoder(flow, record_hdr, packet, offset, end)
+
+    def _sweep_interval(self):
+        return max(1, self.idle_timeout // 4)
+
+    def _evict(self, flow):
+        del self.flows[flow.key]
+        self.evicted += 1
+        close = getattr(flow.decoder, 'close', None)
+        if close is not None:
+            close(flow)
+        if self.on_evict is not None:
+            self.on_evict(flow)
+
+    def _evict_oldest(self, count):
+        for _ in range(count):
+            self._evict(next(iter(self.flows.values())))
+
+    def evict_idle(self, now):
+        """
+        Evict flows not seen for idle_timeout seconds before now, the scan
+        stops at the first flow seen since
+        """
+        self._next_sweep = now + self._sweep_interval()
+        cutoff = now - self.idle_timeout
+        while self.flows:
+            flow = next(iter(self.flows.values()))
+            if flow.last_seen >= cutoff:
+                break
+            self._evict(flow)
+
+    def close(self):
+        """
+        Evict every flow, call at the end of the capture
+        """
+        for flow in list(self.flows.values()):
+            self._evict(flow)
@@ -1,5 +1,9 @@
 import struct
 
+from network import dissect
+from network import ethernet
+from network import lazy
+
 __author__ = 'wmoorefi'
 
 # http://www.iana.org/assignments/protocol-numbers/protocol-numbers.txt
@@ -23,6 +27,40 @@ PROTOCOL_CHAOS = 16
 PROTOCOL_UDP = 17
 PROTOCOL_MUX = 18
 
+# http://www.iana.org/assignments/ip-parameters/ip-parameters.txt
+OPTION_END_OF_LIST = 0
+OPTION_NO_OPERATION = 1
+OPTION_RECORD_ROUTE = 7
+OPTION_TIMESTAMP = 68
+OPTION_LOOSE_SOURCE_ROUTE = 131
+OPTION_STRICT_SOURCE_ROUTE = 137
+OPTION_ROUTER_ALERT = 148
+
+_IPV4_HDR = struct.Struct('>BBHHBBBBHBBBBBBBB')
+_U8 = struct.Struct('>B')
+_U16 = struct.Struct('>H')
+_ADDRESS = struct.Struct('>BBBB')
+
+
+class Ipv4Option(object):
+    """
+    RFC791
+        +--------+--------+--------...
+        |  type  | length | data
+        +--------+--------+--------...
+
+        Length counts the type and length octets. End of list and no
+        operation are single octet options and are not kept.
+    """
+    __slots__ = ['option_type', 'data']
+
+    def __init__(self, option_type, data):
+        self.option_type = option_type
+        self.data = data
+
+    def __len__(self):
+        return 2 + len(self.data)
+
 
 class Ipv4Header(object):
     """
@@ -52,7 +90,7 @@ class Ipv4Header(object):
                  version, internet_hdr_length, dscp, explicit_congestion_notification,
                  total_length, identification, flags, fragment_offset,
                  time_to_live, protocol, header_checksum, source_ip,
-                 destination_ip, options=[]):
+                 destination_ip, options=()):
         self.version = version
         self.internet_hdr_length = internet_hdr_length
         self.dscp = dscp
@@ -74,13 +112,54 @@ class Ipv4Header(object):
 
 def read_ipv4_header(input_stream, byte_swap):
     chunk = input_stream.read(20)
-    if chunk == '':
+    if not chunk:
         return
 
-    if byte_swap:
-        raw_unpacked = struct.unpack('<BBHHBBBBHBBBBBBBB', chunk)
-    else:
-        raw_unpacked = struct.unpack('>BBHHBBBBHBBBBBBBB', chunk)
+    internet_hdr_length = (bytearray(chunk[:1])[0] & 0x0F) * 4
+    if internet_hdr_length > 20:
+        options_chunk = input_stream.read(internet_hdr_length - 20)
+        if len(options_chunk) < internet_hdr_length - 20:
+            return
+        chunk += options_chunk
+
+    return unpack_ipv4_header(chunk, 0, byte_swap)
+
+
+def _unpack_options(buffer, offset, end):
+    options = []
+    while offset < end:
+        option_type = _U8.unpack_from(buffer, offset)[0]
+        if option_type == OPTION_END_OF_LIST:
+            break
+        if option_type == OPTION_NO_OPERATION:
+            offset += 1
+            continue
+        if end - offset < 2:
+            break
+        length = _U8.unpack_from(buffer, offset + 1)[0]
+        if length < 2 or offset + length > end:
+            break  # malformed, keep the options parsed so far
+        options.append(Ipv4Option(option_type, bytes(buffer[offset + 2:offset + length])))
+        offset += length
+    return tuple(options)
+
+
+def _view_options(buffer, offset):
+    internet_hdr_length = (_U8.unpack_from(buffer, offset)[0] & 0x0F) * 4
+    return _unpack_options(buffer, offset + 20, offset + internet_hdr_length)
+
+
+def unpack_ipv4_header(buffer, offset, byte_swap):
+    """
+    Parse ipv4 header, with its options, from buffer starting at offset,
+    returns None when the buffer is too short
+
+    Header fields are always in network byte order, byte_swap is unused
+    """
+    if len(buffer) - offset < 20:
+        return
+
+    raw_unpacked = _IPV4_HDR.unpack_from(buffer, offset)
 
     version = raw_unpacked[0] >> 4
     internet_hdr_length = (raw_unpacked[0] & 0x0F) * 4
@@ -96,10 +175,90 @@ def read_ipv4_header(input_stream, byte_swap):
     source_address = raw_unpacked[9:13]
     destination_address = raw_unpacked[13:17]
 
-    # FIXME read ipv4 options
     # FIXME store flags as namedtuple
 
+    if internet_hdr_length > 20:
+        if len(buffer) - offset < internet_hdr_length:
+            return
+        return Ipv4Header(version, internet_hdr_length, dscp, explicit_congestion_notification,
+                          total_length, identification, flags, fragment_offset,
+                          time_to_live, protocol, header_checksum, source_address,
+                          destination_address,
+                          _unpack_options(buffer, offset + 20, offset + internet_hdr_length))
+
     return Ipv4Header(version, internet_hdr_length, dscp, explicit_congestion_notification,
                       total_length, identification, flags, fragment_offset,
                       time_to_live, protocol, header_checksum, source_address,
                       destination_address)
+
+
+class Ipv4HeaderView(Ipv4Header):
+    """
+    Ipv4Header decoded lazily, each field is unpacked from the packet buffer
+    when it is read. Views are read-only and only valid while the buffer is.
+    """
+    __slots__ = ['_buffer', '_offset']
+
+    version = lazy.field(_U8, 0, 4)
+    dscp = lazy.field(_U8, 1, 2)
+    explicit_congestion_notification = lazy.field(_U8, 1, 0, 0x03)
+    total_length = lazy.field(_U16, 2)
+    identification = lazy.field(_U16, 4)
+    flags = lazy.field(_U8, 6, 5)
+    fragment_offset = lazy.field(_U16, 6, 0, 0x1FFF)
+    time_to_live = lazy.field(_U8, 8)
+    protocol = lazy.field(_U8, 9)
+    header_checksum = lazy.field(_U16, 10)
+    source_ip = lazy.cached_field(lambda buffer, offset: _ADDRESS.unpack_from(buffer, offset + 12),
+                                  Ipv4Header.source_ip)
+    destination_ip = lazy.cached_field(lambda buffer, offset: _ADDRESS.unpack_from(buffer, offset + 16),
+                                       Ipv4Header.destination_ip)
+    options = lazy.cached_field(_view_options, Ipv4Header.options)
+
+    def __init__(self, buffer, offset):
+        self._buffer = buffer
+        self._offset = offset
+
+    def unpack(self):
+        """
+        Eager header of the same bytes, for a packet whose other fields are
+        all going to be read
+        """
+        return unpack_ipv4_header(self._buffer, self._offset, False)
+
+    @property
+    def internet_hdr_length(self):
+        return (_U8.unpack_from(self._buffer, self._offset)[0] & 0x0F) * 4
+
+
+def view_ipv4_header(buffer, offset):
+    """
+    Lazily decoding Ipv4HeaderView of the header at offset, returns None
+    when the buffer is too short for the header and its options
+    """
+    if len(buffer) - offset < 20:
+        return
+    if len(buffer) - offset < (_U8.unpack_from(buffer, offset)[0] & 0x0F) * 4:
+        return
+
+    return Ipv4HeaderView(buffer, offset)
+
+
+def dissect_ipv4(buffer, offset, end):
+    """
+    Dissector of ipv4 datagrams, hands off the protocol, the payload ends
+    with the total length. Later fragments are not handed off, their
+    payload does not start with the next header.
+    """
+    ipv4_hdr = unpack_ipv4_header(buffer, offset, False)
+    if ipv4_hdr is None or ipv4_hdr.version != 4 or ipv4_hdr.internet_hdr_length < 20:
+        return
+    if ipv4_hdr.fragment_offset:
+        protocol = None
+    else:
+        protocol = ipv4_hdr.protocol
+    return ipv4_hdr, protocol, offset + ipv4_hdr.internet_hdr_length, min(end, offset + ipv4_hdr.total_length)
+
+
+def register(registry):
+    registry.register(dissect.ETHERTYPE, ethernet.ETHERTYPE_IPV4, 'ipv4', dissect_ipv4, dissect.IP_PROTOCOL)
@@ -0,0 +1,51 @@
+"""
+Building blocks for header views, header classes whose fields are decoded
+from the packet buffer when they are read instead of when the header is
+parsed. A view keeps the packet buffer and the offset of its header in the
+_buffer and _offset slots.
+
+Views pay off when a few fields of most headers are read, e.g. to filter
+packets. Every read of a field decodes it, so reading all of them costs
+about twice an eager decode; views have unpack() for the eager header of a
+packet that was kept.
+"""
+
+__author__ = 'wmoorefi'
+
+
+def field(field_struct, field_offset, shift=0, mask=None):
+    """
+    Read-only property decoding a single integer field, unpacked with
+    field_struct at field_offset from the start of the header then shifted
+    right and masked. Scalar fields are cheaper to decode again than to cache.
+    """
+    unpack_from = field_struct.unpack_from
+
+    if mask is None:
+        def getter(self):
+            return unpack_from(self._buffer, self._offset + field_offset)[0] >> shift
+    elif shift:
+        def getter(self):
+            return (unpack_from(self._buffer, self._offset + field_offset)[0] >> shift) & mask
+    else:
+        def getter(self):
+            return unpack_from(self._buffer, self._offset + field_offset)[0] & mask
+
+    return property(getter)
+
+
+def cached_field(decoder, storage):
+    """
+    Read-only property decoding a field with decoder(buffer, offset) on first
+    access and keeping the result in storage, the slot descriptor of the
+    eager header class the field shadows
+    """
+    def getter(self):
+        try:
+            return storage.__get__(self)
+        except AttributeError:
+            value = decoder(self._buffer, self._offset)
+            storage.__set__(self, value)
+            return value
+
+    return property(getter)
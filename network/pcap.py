@@ -1,4 +1,5 @@
 import logging
+import mmap
 import struct
 import sys
 
@@ -7,6 +8,31 @@ __author__ = 'wmoorefi'
 _PCAP_HDR_MAGIC_NUMBER = 0xA1B2C3D4  # seconds and microseconds
 _PCAP_HDR_MAGIC_NUMBER_NS = 0xA1B23C4D  # seconds and nanoseconds
 
+PCAP_HDR_LENGTH = 24
+PCAPREC_HDR_LENGTH = 16
+
+LINKTYPE_ETHERNET = 1
+
+# largest snaplen libpcap writes, stands in for the 0 (no limit) of a pcapng
+# interface when a classic header is written
+MAX_SNAPLEN = 262144
+
+_BIG_ENDIAN_MAGIC = (struct.pack('>I', _PCAP_HDR_MAGIC_NUMBER),
+                     struct.pack('>I', _PCAP_HDR_MAGIC_NUMBER_NS))
+_LITTLE_ENDIAN_MAGIC = (struct.pack('<I', _PCAP_HDR_MAGIC_NUMBER),
+                        struct.pack('<I', _PCAP_HDR_MAGIC_NUMBER_NS))
+
+# decoders keyed by the byte order of the capture file, thiszone is the
+# only signed field
+_PCAP_HDR_STRUCTS = {
+    '<': struct.Struct('<IHHiIII'),
+    '>': struct.Struct('>IHHiIII'),
+}
+_PCAPREC_HDR_STRUCTS = {
+    '<': struct.Struct('<IIII'),
+    '>': struct.Struct('>IIII'),
+}
+
 _module_logger = logging.getLogger(__name__)
 
 class PcapHeader(object):
@@ -24,7 +50,7 @@ class PcapHeader(object):
     """
     __slots__ = ['magic_number', 'version_major', 'version_minor', 'thiszone',
                  'sigfigs', 'snaplen', 'network', 'byte_swap',
-                 'timestamp_in_ns']
+                 'timestamp_in_ns', 'byte_order']
 
     def __init__(self,
                  magic_number, version_major, version_minor, thiszone,
@@ -39,6 +65,11 @@ class PcapHeader(object):
         self.network = network
         self.byte_swap = byte_swap
         self.timestamp_in_ns = timestamp_in_ns
+        # struct byte order of the file, derived once from byte_swap
+        if (sys.byteorder == 'little') != bool(byte_swap):
+            self.byte_order = '<'
+        else:
+            self.byte_order = '>'
 
 
 class PcapRecordHeader(object):
@@ -74,30 +105,40 @@ def read_pcap_header(input_file):
         guint32 network;        /* data link type */
     } pcap_hdr_t;
     """
-    pcap_hdr_fmt = "IhhIIII"
-
     try:
-        raw_header = input_file.read(24)  # size of header
+        raw_header = input_file.read(PCAP_HDR_LENGTH)
     except UnicodeDecodeError:
         _module_logger.error('Unable to read pcap header')
         raise
 
-    if raw_header[:4] in [struct.pack('>I', _PCAP_HDR_MAGIC_NUMBER),
-                          struct.pack('>I', _PCAP_HDR_MAGIC_NUMBER_NS)]:
-        # Big Endian
-        byte_swap = True if sys.byteorder == 'little' else False
+    pcap_header = unpack_pcap_header(raw_header)
 
-        unpack_template = ''.join(['>', pcap_hdr_fmt])
-    elif raw_header[:4] in [struct.pack('<I', _PCAP_HDR_MAGIC_NUMBER),
-                            struct.pack('<I', _PCAP_HDR_MAGIC_NUMBER_NS)]:
-        # Little Endian
-        byte_swap = True if sys.byteorder == 'big' else False
+    _module_logger.info('[%d] pcap header magic 0x%08x, byteswap %s',
+                        input_file.tell(), pcap_header.magic_number, pcap_header.byte_swap)
+    #_module_logger.info('read the pacp header %r', pcap_header)
 
-        unpack_template = ''.join(['<', pcap_hdr_fmt])
+    return pcap_header
+
+
+def unpack_pcap_header(buffer, offset=0):
+    """
+    Parse pcap header from a buffer (bytes, bytearray, mmap or memoryview)
+    starting at offset
+    """
+    if len(buffer) - offset < PCAP_HDR_LENGTH:
+        raise Exception('Invalid pcap stream, truncated header')
+
+    raw_magic = bytes(buffer[offset:offset + 4])
+    if raw_magic in _BIG_ENDIAN_MAGIC:
+        byte_swap = True if sys.byteorder == 'little' else False
+        byte_order = '>'
+    elif raw_magic in _LITTLE_ENDIAN_MAGIC:
+        byte_swap = True if sys.byteorder == 'big' else False
+        byte_order = '<'
     else:
         raise Exception('Invalid pcap stream, magic number not found')
 
-    unpacked_header = struct.unpack(unpack_template, raw_header)
+    unpacked_header = _PCAP_HDR_STRUCTS[byte_order].unpack_from(buffer, offset)
     (magic_number, version_major, version_minor, thiszone, sigfigs, snaplen, network) = unpacked_header
     pcap_header = PcapHeader(magic_number,
                              version_major,
@@ -111,9 +152,6 @@ def read_pcap_header(input_file):
 
     # todo validate header
 
-    _module_logger.info('[%d] pcap header %r, byteswap %s', input_file.tell(), unpacked_header, byte_swap)
-    #_module_logger.info('read the pacp header %r', pcap_header)
-
     return pcap_header
 
 
@@ -128,29 +166,216 @@ def read_pcap_record(pcap_hdr, input_file):
         guint32 orig_len;       /* actual length of packet */
     } pcaprec_hdr_t;
     """
-    pcaprec_hdr_fmt = "IIII"
-
     try:
-        raw_header = input_file.read(16)  # size of header
+        raw_header = input_file.read(PCAPREC_HDR_LENGTH)
     except UnicodeDecodeError:
         _module_logger.error('Unable to read pcap packet header')
         raise
 
-    if raw_header == '':
+    if not raw_header:
+        return  # end of stream
+
+    # None on a truncated record header, per record logging stays off the
+    # hot path, see capture.instrument for counters
+    return unpack_pcap_record(pcap_hdr, raw_header)
+
+
+def unpack_pcap_record(pcap_hdr, buffer, offset=0):
+    """
+    Parse pcap record header from a buffer starting at offset, returns None
+    when fewer than PCAPREC_HDR_LENGTH bytes remain
+    """
+    if len(buffer) - offset < PCAPREC_HDR_LENGTH:
         return
 
-    if pcap_hdr.byte_swap:
-        unpack_template = ''.join(['>', pcaprec_hdr_fmt])
-    else:
-        unpack_template = ''.join(['<', pcaprec_hdr_fmt])
+    (ts_sec, ts_usec, incl_len, orig_len) = _PCAPREC_HDR_STRUCTS[pcap_hdr.byte_order].unpack_from(buffer, offset)
+    return PcapRecordHeader(ts_sec,
+                            ts_usec,
+                            incl_len,
+                            orig_len)
+
+
+def write_pcap_header(output_file, pcap_hdr):
+    """
+    Write pcap_hdr to stream in its byte order
+    """
+    output_file.write(_PCAP_HDR_STRUCTS[pcap_hdr.byte_order].pack(
+        pcap_hdr.magic_number, pcap_hdr.version_major, pcap_hdr.version_minor, pcap_hdr.thiszone,
+        pcap_hdr.sigfigs, pcap_hdr.snaplen, pcap_hdr.network))
+
+
+def write_pcap_record(pcap_hdr, output_file, pcap_record, packet):
+    """
+    Write a record header and its packet data to stream, packet holds
+    incl_len bytes
+    """
+    output_file.write(_PCAPREC_HDR_STRUCTS[pcap_hdr.byte_order].pack(
+        pcap_record.ts_sec, pcap_record.ts_usec, pcap_record.incl_len, pcap_record.orig_len))
+    output_file.write(packet)
+
+
+def new_pcap_header(network, snaplen=65535, timestamp_in_ns=False, thiszone=0):
+    """
+    PcapHeader of a version 2.4 capture in host byte order
+    """
+    magic_number = _PCAP_HDR_MAGIC_NUMBER_NS if timestamp_in_ns else _PCAP_HDR_MAGIC_NUMBER
+    return PcapHeader(magic_number, 2, 4, thiszone, 0, snaplen, network, False, timestamp_in_ns)
+
+
+class PcapWriter(object):
+    """
+    Buffered pcap writer, records are packed into a buffer that is written
+    out once it holds buffer_size bytes. Packets longer than snaplen are
+    truncated, orig_len keeps their length on the wire. The capture is
+    written in the byte order of pcap_hdr so records read from a capture in
+    the same byte order can be copied with write_raw unchanged.
+
+    with open('out.pcap', 'wb') as fp, PcapWriter(fp, capture.header) as writer:
+        for record_hdr, packet in capture.records():
+            writer.write_record(record_hdr, packet)
+    """
+    __slots__ = ['header', 'output_file', 'buffer_size', 'records', '_buffer', '_record_struct']
+
+    def __init__(self, output_file, pcap_hdr, snaplen=None, buffer_size=1 << 20):
+        if snaplen is None:
+            snaplen = pcap_hdr.snaplen
+        self.header = PcapHeader(pcap_hdr.magic_number, pcap_hdr.version_major, pcap_hdr.version_minor,
+                                 pcap_hdr.thiszone, pcap_hdr.sigfigs, snaplen, pcap_hdr.network,
+                                 pcap_hdr.byte_swap, pcap_hdr.timestamp_in_ns)
+        self.output_file = output_file
+        self.buffer_size = buffer_size
+        self.records = 0
+        self._buffer = bytearray(_PCAP_HDR_STRUCTS[self.header.byte_order].pack(
+            self.header.magic_number, self.header.version_major, self.header.version_minor,
+            self.header.thiszone, self.header.sigfigs, self.header.snaplen, self.header.network))
+        self._record_struct = _PCAPREC_HDR_STRUCTS[self.header.byte_order]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write_record(self, pcap_record, packet):
+        """
+        Append a record, packet holds at least incl_len bytes
+        """
+        incl_len = min(pcap_record.incl_len, self.header.snaplen)
+        buffer = self._buffer
+        buffer += self._record_struct.pack(pcap_record.ts_sec, pcap_record.ts_usec, incl_len, pcap_record.orig_len)
+        buffer += packet[:incl_len]
+        self.records += 1
+        if len(buffer) >= self.buffer_size:
+            self.flush()
+
+    def write_raw(self, data, record_count=1):
+        """
+        Append already encoded records, record headers included, large
+        chunks go straight to the stream without passing through the buffer
+        """
+        self.records += record_count
+        if len(data) >= self.buffer_size:
+            self.flush()
+            self.output_file.write(data)
+            return
+        self._buffer += data
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self.output_file.write(self._buffer)
+            del self._buffer[:]
+        self.output_file.flush()
+
+    def close(self):
+        """
+        Flush the buffered records, the stream is left open
+        """
+        self.flush()
+
+
+def record_timestamp(pcap_hdr, pcap_record):
+    """
+    Capture time of a record in seconds, honoring nanosecond captures
+    """
+    if pcap_hdr.timestamp_in_ns:
+        return pcap_record.ts_sec + pcap_record.ts_usec / 1e9
+    return pcap_record.ts_sec + pcap_record.ts_usec / 1e6
+
+
+def record_header_struct(pcap_hdr):
+    """
+    Precompiled struct.Struct for the record headers of a capture, resolve it
+    once and call unpack_from(buffer, offset) per record
+    """
+    return _PCAPREC_HDR_STRUCTS[pcap_hdr.byte_order]
+
+
+def iter_pcap_records(pcap_hdr, buffer, offset=PCAP_HDR_LENGTH):
+    """
+    Walk the records of an in-memory or memory-mapped capture by offset.
+    Yields (record header, packet data) where packet data is a memoryview
+    slice of buffer, the packet bytes are never copied.
+
+    Stops at the end of the buffer or at a truncated trailing record.
+    """
+    view = memoryview(buffer)
+    end = len(view)
+    unpack_record = record_header_struct(pcap_hdr).unpack_from
+
+    while offset + PCAPREC_HDR_LENGTH <= end:
+        (ts_sec, ts_usec, incl_len, orig_len) = unpack_record(view, offset)
+        offset += PCAPREC_HDR_LENGTH
+
+        next_offset = offset + incl_len
+        if next_offset > end:
+            _module_logger.warning('[%d] truncated record, %d of %d bytes present',
+                                   offset, end - offset, incl_len)
+            break
+
+        yield PcapRecordHeader(ts_sec, ts_usec, incl_len, orig_len), view[offset:next_offset]
+        offset = next_offset
+
+
+class MappedPcapFile(object):
+    """
+    Read-only memory map of a pcap file, the whole capture is addressed by
+    offset so reading it costs no read() calls per record
+
+    with open('test.pcap', 'rb') as fp:
+        with MappedPcapFile(fp) as capture:
+            for record_hdr, packet in capture.records():
+                eth_hdr = ethernet.unpack_ethernet_header(packet, 0, capture.header.byte_swap)
+    """
+    __slots__ = ['header', 'buffer', '_mapped']
+
+    def __init__(self, input_file):
+        self._mapped = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buffer = memoryview(self._mapped)
+        try:
+            self.header = unpack_pcap_header(self.buffer)
+        except Exception:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-    unpacked_header = struct.unpack(unpack_template, raw_header)
-    (ts_sec, ts_usec, incl_len, orig_len) = unpacked_header
-    pcap_record = PcapRecordHeader(ts_sec,
-                                   ts_usec,
-                                   incl_len,
-                                   orig_len)
+    def __len__(self):
+        return len(self.buffer)
 
-    _module_logger.info('[%d] record header %r', input_file.tell(), unpacked_header)
+    def records(self, offset=PCAP_HDR_LENGTH):
+        return iter_pcap_records(self.header, self.buffer, offset)
 
-    return pcap_record
+    def close(self):
+        self.buffer.release()
+        try:
+            self._mapped.close()
+        except BufferError:
+            # packet slices are still referenced, the map is released
+            # once the last of them is garbage collected
+            _module_logger.debug('pcap map still exported, deferring close')
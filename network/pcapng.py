@@ -0,0 +1,485 @@
+"""
+pcapng reader
+https://wiki.wireshark.org/Development/PcapNg
+https://datatracker.ietf.org/doc/draft-ietf-opsawg-pcapng/
+
+Section Header, Interface Description, Enhanced Packet and Simple Packet
+blocks are decoded, every other block is skipped by its length without
+reading its body. Packet timestamps are converted with the if_tsresol and
+if_tsoffset of their interface into the ts_sec/ts_usec of a
+PcapRecordHeader (ts_usec holds nanoseconds when the header asks for
+them), so records come out exactly as they do from a classic pcap file:
+
+with open('test.pcapng', 'rb') as fp:
+    pcap_hdr = read_pcapng_header(fp)
+    for record_hdr in read_pcapng_records(pcap_hdr, fp):
+        packet = fp.read(record_hdr.incl_len)
+
+with open('test.pcapng', 'rb') as fp, MappedPcapngFile(fp) as capture:
+    for record_hdr, packet in capture.records():
+        ...
+"""
+
+import logging
+import mmap
+import struct
+import sys
+
+from network import pcap
+
+__author__ = 'wmoorefi'
+
+BLOCKTYPE_SECTION_HEADER = 0x0A0D0D0A
+BLOCKTYPE_INTERFACE_DESCRIPTION = 0x00000001
+BLOCKTYPE_SIMPLE_PACKET = 0x00000003
+BLOCKTYPE_ENHANCED_PACKET = 0x00000006
+
+_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+OPTION_END = 0
+OPTION_IF_NAME = 2
+OPTION_IF_TSRESOL = 9
+OPTION_IF_TSOFFSET = 14
+
+_DEFAULT_UNITS_PER_SECOND = 1000000
+
+_BLOCK_HDR_LENGTH = 8
+_SHB_BODY_LENGTH = 16
+_EPB_BODY_LENGTH = 20
+_SPB_BODY_LENGTH = 4
+
+# decoders keyed by the byte order of the section
+_BLOCK_HDR_STRUCTS = {'<': struct.Struct('<II'), '>': struct.Struct('>II')}
+_SHB_STRUCTS = {'<': struct.Struct('<IHHq'), '>': struct.Struct('>IHHq')}
+_IDB_STRUCTS = {'<': struct.Struct('<HHI'), '>': struct.Struct('>HHI')}
+_EPB_STRUCTS = {'<': struct.Struct('<IIIII'), '>': struct.Struct('>IIIII')}
+# enhanced packet body read together with the block header
+_EPB_BLOCK_STRUCTS = {'<': struct.Struct('<IIIIIII'), '>': struct.Struct('>IIIIIII')}
+_SPB_STRUCTS = {'<': struct.Struct('<I'), '>': struct.Struct('>I')}
+_OPTION_STRUCTS = {'<': struct.Struct('<HH'), '>': struct.Struct('>HH')}
+_TSOFFSET_STRUCTS = {'<': struct.Struct('<q'), '>': struct.Struct('>q')}
+_U32 = struct.Struct('<I')
+
+_module_logger = logging.getLogger(__name__)
+
+
+class PcapngRecordHeader(pcap.PcapRecordHeader):
+    """
+    PcapRecordHeader of an enhanced or simple packet block, with the index
+    of the interface it was captured on. Packets of interface 0 are built
+    with the four argument constructor of PcapRecordHeader and read
+    interface_id from the class, so they cost no more than a record of a
+    classic capture. record_header() builds either kind.
+    """
+    __slots__ = []
+    interface_id = 0
+
+
+class _InterfaceRecordHeader(PcapngRecordHeader):
+    """
+    PcapngRecordHeader of a packet of any interface but the first
+    """
+    __slots__ = ['interface_id']
+
+    def __init__(self, ts_sec, ts_usec, incl_len, orig_len, interface_id):
+        self.ts_sec = ts_sec
+        self.ts_usec = ts_usec
+        self.incl_len = incl_len
+        self.orig_len = orig_len
+        self.interface_id = interface_id
+
+
+def record_header(ts_sec, ts_usec, incl_len, orig_len, interface_id=0):
+    """
+    PcapngRecordHeader of a packet captured on interface_id
+    """
+    if interface_id:
+        return _InterfaceRecordHeader(ts_sec, ts_usec, incl_len, orig_len, interface_id)
+    return PcapngRecordHeader(ts_sec, ts_usec, incl_len, orig_len)
+
+
+class PcapngInterface(object):
+    """
+    Interface Description Block, units_per_second from if_tsresol and
+    offset_seconds from if_tsoffset
+    """
+    __slots__ = ['linktype', 'snaplen', 'name', 'units_per_second', 'offset_seconds']
+
+    def __init__(self, linktype, snaplen, name=None,
+                 units_per_second=_DEFAULT_UNITS_PER_SECOND, offset_seconds=0):
+        self.linktype = linktype
+        self.snaplen = snaplen
+        self.name = name
+        self.units_per_second = units_per_second
+        self.offset_seconds = offset_seconds
+
+    def timestamp(self, timestamp, fraction_per_second):
+        """
+        Split a raw block timestamp into seconds and fraction_per_second
+        units, 10**6 for microseconds or 10**9 for nanoseconds
+        """
+        (ts_sec, fraction) = divmod(timestamp, self.units_per_second)
+        if self.units_per_second != fraction_per_second:
+            fraction = fraction * fraction_per_second // self.units_per_second
+        return ts_sec + self.offset_seconds, fraction
+
+
+def is_pcapng(raw_header):
+    """
+    True when the first bytes of a capture are a pcapng section header
+    """
+    return len(raw_header) >= 4 and _U32.unpack_from(raw_header)[0] == BLOCKTYPE_SECTION_HEADER
+
+
+def _section_byte_order(buffer, offset):
+    # the byte-order magic follows the block type and length
+    magic = bytes(buffer[offset + 8:offset + 12])
+    if magic == struct.pack('<I', _BYTE_ORDER_MAGIC):
+        return '<'
+    if magic == struct.pack('>I', _BYTE_ORDER_MAGIC):
+        return '>'
+    raise Exception('Invalid pcapng stream, byte-order magic not found')
+
+
+def _section_header(buffer, offset, byte_order, timestamp_in_ns):
+    (magic, version_major, version_minor, section_length) = _SHB_STRUCTS[byte_order].unpack_from(buffer, offset + 8)
+    byte_swap = (byte_order == '<') != (sys.byteorder == 'little')
+    return pcap.PcapHeader(BLOCKTYPE_SECTION_HEADER, version_major, version_minor, 0,
+                           0, 0, 0, byte_swap, timestamp_in_ns)
+
+
+def _interface(buffer, offset, block_length, byte_order):
+    (linktype, reserved, snaplen) = _IDB_STRUCTS[byte_order].unpack_from(buffer, offset + 8)
+    interface = PcapngInterface(linktype, snaplen)
+
+    unpack_option = _OPTION_STRUCTS[byte_order].unpack_from
+    option_offset = offset + 16
+    options_end = offset + block_length - 4
+    while option_offset + 4 <= options_end:
+        (code, length) = unpack_option(buffer, option_offset)
+        value_offset = option_offset + 4
+        if code == OPTION_END or value_offset + length > options_end:
+            break
+        if code == OPTION_IF_TSRESOL and length >= 1:
+            resolution = bytearray(buffer[value_offset:value_offset + 1])[0]
+            if resolution & 0x80:
+                interface.units_per_second = 2 ** (resolution & 0x7F)
+            else:
+                interface.units_per_second = 10 ** resolution
+        elif code == OPTION_IF_TSOFFSET and length >= 8:
+            interface.offset_seconds = _TSOFFSET_STRUCTS[byte_order].unpack_from(buffer, value_offset)[0]
+        elif code == OPTION_IF_NAME:
+            interface.name = bytes(buffer[value_offset:value_offset + length]).rstrip(b'\0').decode('utf-8', 'replace')
+        option_offset = value_offset + ((length + 3) & ~3)
+
+    return interface
+
+
+def _update_header(pcap_hdr, interface):
+    # the classic header describes the first interface of the section
+    if not pcap_hdr.network and not pcap_hdr.snaplen:
+        pcap_hdr.network = interface.linktype
+        pcap_hdr.snaplen = interface.snaplen
+
+
+def iter_pcapng_records(buffer, offset=0, timestamp_in_ns=False, pcap_hdr=None):
+    """
+    Walk the blocks of an in-memory or memory-mapped pcapng capture by
+    offset. Yields (PcapngRecordHeader, packet data) where packet data is a
+    memoryview slice of buffer. pcap_hdr, when given, is updated with the
+    byte order, link type and snaplen of the sections read.
+    """
+    view = memoryview(buffer)
+    end = len(view)
+    if end - offset < 12 or _U32.unpack_from(view, offset)[0] != BLOCKTYPE_SECTION_HEADER:
+        raise Exception('Invalid pcapng stream, section header not found')
+    byte_order = _section_byte_order(view, offset)
+    unpack_block = _BLOCK_HDR_STRUCTS[byte_order].unpack_from
+    unpack_epb = _EPB_BLOCK_STRUCTS[byte_order].unpack_from
+    interfaces = []
+    interface_count = 0
+    fraction_per_second = 1000000000 if timestamp_in_ns else 1000000
+    # per interface, the divisor splitting a raw timestamp into ts_sec and
+    # ts_usec, 0 when it needs rescaling or an offset
+    divisors = []
+    # raw timestamps of the second clock_second share the high word
+    # clock_high and have a low word in [clock_low, clock_low + divisor),
+    # packets within it are converted with a subtraction instead of a 64 bit
+    # divmod
+    clock_high = clock_low = clock_second = -1
+    # the divisor when the section has a single interface without
+    # rescaling, its enhanced packet blocks take the loop below
+    single_divisor = 0
+    enhanced_packet = BLOCKTYPE_ENHANCED_PACKET
+    epb_length = _BLOCK_HDR_LENGTH + _EPB_BODY_LENGTH
+    last_epb = end - epb_length
+    # header, body and trailing block length of an enhanced packet block
+    epb_overhead = epb_length + 4
+
+    while offset + 12 <= end:
+        if single_divisor:
+            # runs of enhanced packet blocks, every other block or an
+            # invalid one leaves it for the general decoding below
+            while offset <= last_epb:
+                (block_type, block_length, interface_id, timestamp_high, timestamp_low,
+                 captured_length, original_length) = unpack_epb(view, offset)
+                next_offset = offset + block_length
+                # the data, its padding and the trailing block length fit
+                if (block_type != enhanced_packet or interface_id or
+                        captured_length > block_length - epb_overhead or next_offset > end):
+                    break
+                ts_usec = timestamp_low - clock_low
+                if timestamp_high != clock_high or not 0 <= ts_usec < single_divisor:
+                    (clock_second, ts_usec) = divmod((timestamp_high << 32) | timestamp_low, single_divisor)
+                    clock_high = timestamp_high
+                    clock_low = timestamp_low - ts_usec
+                offset += epb_length
+                yield (PcapngRecordHeader(clock_second, ts_usec, captured_length, original_length),
+                       view[offset:offset + captured_length])
+                offset = next_offset
+            if offset + 12 > end:
+                break
+
+        # block header and enhanced packet body in one unpack
+        if offset + epb_length <= end:
+            (block_type, block_length, interface_id, timestamp_high, timestamp_low,
+             captured_length, original_length) = unpack_epb(view, offset)
+        else:
+            (block_type, block_length) = unpack_block(view, offset)
+            # too short for an enhanced packet body
+            interface_id = interface_count
+
+        next_offset = offset + block_length
+
+        if block_type == BLOCKTYPE_ENHANCED_PACKET and interface_id < interface_count:
+            data_offset = offset + epb_length
+            data_end = data_offset + captured_length
+            # the data, its padding and the trailing block length
+            if data_end + 4 <= next_offset <= end:
+                divisor = divisors[interface_id]
+                ts_usec = timestamp_low - clock_low
+                if divisor and timestamp_high == clock_high and 0 <= ts_usec < divisor:
+                    ts_sec = clock_second
+                elif divisor:
+                    (ts_sec, ts_usec) = divmod((timestamp_high << 32) | timestamp_low, divisor)
+                    clock_high = timestamp_high
+                    clock_low = timestamp_low - ts_usec
+                    clock_second = ts_sec
+                else:
+                    (ts_sec, ts_usec) = interfaces[interface_id].timestamp((timestamp_high << 32) | timestamp_low,
+                                                                           fraction_per_second)
+                yield (record_header(ts_sec, ts_usec, captured_length, original_length, interface_id),
+                       view[data_offset:data_end])
+                offset = next_offset
+                continue
+
+        if block_type == BLOCKTYPE_ENHANCED_PACKET:
+            if block_length < 12 or next_offset > end:
+                _module_logger.warning('[%d] truncated or invalid block, length %d', offset, block_length)
+                break
+            _module_logger.warning('[%d] invalid enhanced packet block', offset)
+            offset = next_offset
+            continue
+
+        if block_type == BLOCKTYPE_SECTION_HEADER:
+            # the section header block type reads the same in both byte orders
+            byte_order = _section_byte_order(view, offset)
+            unpack_block = _BLOCK_HDR_STRUCTS[byte_order].unpack_from
+            unpack_epb = _EPB_BLOCK_STRUCTS[byte_order].unpack_from
+            (block_type, block_length) = unpack_block(view, offset)
+            next_offset = offset + block_length
+            interfaces = []
+            interface_count = 0
+            divisors = []
+            single_divisor = 0
+            if pcap_hdr is not None:
+                section = _section_header(view, offset, byte_order, timestamp_in_ns)
+                pcap_hdr.byte_swap = section.byte_swap
+                pcap_hdr.byte_order = section.byte_order
+
+        if block_length < 12 or block_length & 3 or next_offset > end:
+            _module_logger.warning('[%d] truncated or invalid block, length %d', offset, block_length)
+            break
+
+        if block_type == BLOCKTYPE_SIMPLE_PACKET:
+            original_length = _SPB_STRUCTS[byte_order].unpack_from(view, offset + 8)[0]
+            data_offset = offset + _BLOCK_HDR_LENGTH + _SPB_BODY_LENGTH
+            captured_length = min(original_length, block_length - 16)
+            if interfaces and interfaces[0].snaplen:
+                captured_length = min(captured_length, interfaces[0].snaplen)
+            # simple packets carry no timestamp
+            yield (PcapngRecordHeader(0, 0, captured_length, original_length),
+                   view[data_offset:data_offset + captured_length])
+        elif block_type == BLOCKTYPE_INTERFACE_DESCRIPTION:
+            interface = _interface(view, offset, block_length, byte_order)
+            interfaces.append(interface)
+            interface_count += 1
+            if interface.units_per_second == fraction_per_second and not interface.offset_seconds:
+                divisors.append(fraction_per_second)
+            else:
+                divisors.append(0)
+            single_divisor = divisors[0] if interface_count == 1 else 0
+            if pcap_hdr is not None:
+                _update_header(pcap_hdr, interface)
+
+        offset = next_offset
+
+
+class MappedPcapngFile(object):
+    """
+    Read-only memory map of a pcapng file, the counterpart of
+    pcap.MappedPcapFile. header is built from the first section header and
+    interface description blocks.
+    """
+    __slots__ = ['header', 'buffer', 'timestamp_in_ns', '_mapped']
+
+    def __init__(self, input_file, timestamp_in_ns=False):
+        self._mapped = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.buffer = memoryview(self._mapped)
+        self.timestamp_in_ns = timestamp_in_ns
+        try:
+            if not is_pcapng(self.buffer):
+                raise Exception('Invalid pcapng stream, section header not found')
+            self.header = _section_header(self.buffer, 0, _section_byte_order(self.buffer, 0), timestamp_in_ns)
+            self._read_interfaces()
+        except Exception:
+            self.close()
+            raise
+
+    def _read_interfaces(self):
+        # link type and snaplen of the header come from the leading IDBs
+        byte_order = self.header.byte_order
+        offset = 0
+        while offset + 12 <= len(self.buffer):
+            (block_type, block_length) = _BLOCK_HDR_STRUCTS[byte_order].unpack_from(self.buffer, offset)
+            if block_length < 12 or offset + block_length > len(self.buffer):
+                break
+            if block_type == BLOCKTYPE_INTERFACE_DESCRIPTION:
+                _update_header(self.header, _interface(self.buffer, offset, block_length, byte_order))
+                break
+            if block_type in (BLOCKTYPE_ENHANCED_PACKET, BLOCKTYPE_SIMPLE_PACKET):
+                break
+            offset += block_length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def records(self, offset=0):
+        return iter_pcapng_records(self.buffer, offset, self.timestamp_in_ns, self.header)
+
+    def close(self):
+        self.buffer.release()
+        try:
+            self._mapped.close()
+        except BufferError:
+            # packet slices are still referenced, the map is released
+            # once the last of them is garbage collected
+            _module_logger.debug('pcapng map still exported, deferring close')
+
+
+def read_pcapng_header(input_file, timestamp_in_ns=False):
+    """
+    Parse the first section header block from stream, returns a PcapHeader
+    with magic_number BLOCKTYPE_SECTION_HEADER and the link type and
+    snaplen of the first interface description block, like
+    MappedPcapngFile.header. The stream is left at the start of the file so
+    read_pcapng_records sees the section header too.
+    """
+    start = input_file.tell()
+    raw_header = input_file.read(_BLOCK_HDR_LENGTH + _SHB_BODY_LENGTH)
+    input_file.seek(start)
+
+    if len(raw_header) < _BLOCK_HDR_LENGTH + _SHB_BODY_LENGTH or not is_pcapng(raw_header):
+        raise Exception('Invalid pcapng stream, section header not found')
+
+    byte_order = _section_byte_order(raw_header, 0)
+    pcap_hdr = _section_header(raw_header, 0, byte_order, timestamp_in_ns)
+
+    # skip the section header and any other block up to the first IDB
+    unpack_block = _BLOCK_HDR_STRUCTS[byte_order].unpack_from
+    position = start
+    while True:
+        input_file.seek(position)
+        raw_block_header = input_file.read(_BLOCK_HDR_LENGTH)
+        if len(raw_block_header) < _BLOCK_HDR_LENGTH:
+            break
+        (block_type, block_length) = unpack_block(raw_block_header)
+        if block_length < 12 or block_length & 3:
+            break
+        if block_type == BLOCKTYPE_INTERFACE_DESCRIPTION:
+            raw_block = raw_block_header + input_file.read(block_length - _BLOCK_HDR_LENGTH)
+            if len(raw_block) == block_length:
+                _update_header(pcap_hdr, _interface(raw_block, 0, block_length, byte_order))
+            break
+        if block_type in (BLOCKTYPE_ENHANCED_PACKET, BLOCKTYPE_SIMPLE_PACKET) or (
+                block_type == BLOCKTYPE_SECTION_HEADER and position != start):
+            break
+        position += block_length
+    input_file.seek(start)
+
+    return pcap_hdr
+
+
+def read_pcapng_records(pcap_hdr, input_file):
+    """
+    Stream counterpart of pcapfile.record_reader: yields a
+    PcapngRecordHeader per packet with input_file positioned at the packet
+    data, the caller reads incl_len bytes. Unknown blocks are skipped with
+    seek, the stream must be seekable.
+    """
+    byte_order = pcap_hdr.byte_order
+    interfaces = []
+    fraction_per_second = 1000000000 if pcap_hdr.timestamp_in_ns else 1000000
+    position = input_file.tell()
+
+    while True:
+        input_file.seek(position)
+        raw_block_header = input_file.read(12)
+        if len(raw_block_header) < 12:
+            break
+
+        if is_pcapng(raw_block_header):
+            byte_order = _section_byte_order(raw_block_header, 0)
+            pcap_hdr.byte_swap = (byte_order == '<') != (sys.byteorder == 'little')
+            pcap_hdr.byte_order = byte_order
+            interfaces = []
+
+        (block_type, block_length) = _BLOCK_HDR_STRUCTS[byte_order].unpack_from(raw_block_header)
+        if block_length < 12 or block_length & 3:
+            _module_logger.warning('[%d] invalid block, length %d', position, block_length)
+            break
+        block_end = position + block_length
+
+        if block_type == BLOCKTYPE_ENHANCED_PACKET:
+            raw_body = raw_block_header[_BLOCK_HDR_LENGTH:] + input_file.read(_EPB_BODY_LENGTH - 4)
+            if len(raw_body) < _EPB_BODY_LENGTH:
+                break
+            (interface_id, timestamp_high, timestamp_low, captured_length,
+             original_length) = _EPB_STRUCTS[byte_order].unpack(raw_body)
+            if interface_id < len(interfaces):
+                (ts_sec, ts_usec) = interfaces[interface_id].timestamp((timestamp_high << 32) | timestamp_low,
+                                                                       fraction_per_second)
+                yield record_header(ts_sec, ts_usec, captured_length, original_length, interface_id)
+            else:
+                _module_logger.warning('[%d] packet of unknown interface %d', position, interface_id)
+        elif block_type == BLOCKTYPE_SIMPLE_PACKET:
+            original_length = _SPB_STRUCTS[byte_order].unpack_from(raw_block_header, _BLOCK_HDR_LENGTH)[0]
+            input_file.seek(position + _BLOCK_HDR_LENGTH + _SPB_BODY_LENGTH)
+            captured_length = min(original_length, block_length - 16)
+            if interfaces and interfaces[0].snaplen:
+                captured_length = min(captured_length, interfaces[0].snaplen)
+            yield PcapngRecordHeader(0, 0, captured_length, original_length)
+        elif block_type == BLOCKTYPE_INTERFACE_DESCRIPTION:
+            raw_block = raw_block_header + input_file.read(block_length - 12)
+            if len(raw_block) < block_length:
+                break
+            interfaces.append(_interface(raw_block, 0, block_length, byte_order))
+            _update_header(pcap_hdr, interfaces[-1])
+
+        position = block_end
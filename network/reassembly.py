@@ -0,0 +1,266 @@
+"""
+IPv4 fragment reassembly
+
+Fragments are collected per (source_ip, destination_ip, protocol,
+identification) and copied once, straight into the buffer of the datagram
+they belong to, at their final position. The headers of the first fragment
+are written in front of the payload so a completed datagram comes back as an
+unfragmented ethernet frame that the flow table, unpack_ipv4_header and
+unpack_udp_header decode like any other packet.
+
+reassembler = Ipv4Reassembler(timeout=30, max_bytes=4 << 20)
+for record_hdr, packet in capture.records():
+    packet = reassembler.reassemble(record_hdr, packet)
+    if packet is None:
+        continue  # fragment held back until its datagram is complete
+"""
+
+import bisect
+import collections
+import logging
+import struct
+
+from network import checksum
+from network import ethernet
+
+__author__ = 'wmoorefi'
+
+# version/ihl, total length, identification, flags/fragment offset,
+# protocol, source and destination address
+_IPV4_FRAGMENT = struct.Struct('>BxHHHxBxxII')
+_ETHERTYPE = struct.Struct('>H')
+_U16 = struct.Struct('>H')
+
+_FLAG_DONT_FRAGMENT = 0x4000
+_FLAG_MORE_FRAGMENTS = 0x2000
+_FRAGMENT_OFFSET_MASK = 0x1FFF
+
+_MAX_DATAGRAM_LENGTH = 65535
+
+# room in front of the payload for the link and ip headers of the first
+# fragment, ethernet with two vlan tags and an ip header with options
+HEADROOM = 128
+
+_module_logger = logging.getLogger(__name__)
+
+
+class IntervalSet(object):
+    """
+    Sorted disjoint [start, end) intervals, touching intervals are merged
+    """
+    __slots__ = ['starts', 'ends']
+
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def __len__(self):
+        return len(self.starts)
+
+    def add(self, start, end):
+        """
+        Add [start, end), returns the parts of it that were not yet covered
+        as a list of (start, end)
+        """
+        starts = self.starts
+        ends = self.ends
+        first = bisect.bisect_left(ends, start)
+        last = bisect.bisect_right(starts, end)
+
+        gaps = []
+        cursor = start
+        for index in range(first, last):
+            if starts[index] > cursor:
+                gaps.append((cursor, starts[index]))
+            cursor = max(cursor, ends[index])
+        if cursor < end:
+            gaps.append((cursor, end))
+
+        if first < last:
+            start = min(start, starts[first])
+            end = max(end, ends[last - 1])
+        starts[first:last] = [start]
+        ends[first:last] = [end]
+        return gaps
+
+    def covers(self, start, end):
+        """
+        True when [start, end) is covered by a single interval
+        """
+        index = bisect.bisect_right(self.starts, start) - 1
+        return index >= 0 and self.ends[index] >= end
+
+
+class _Datagram(object):
+    """
+    Reassembly state of one datagram, payload byte n is kept at
+    buffer[HEADROOM + n] and the frame starts at buffer[frame_start]
+    once the first fragment arrived
+    """
+    __slots__ = ['key', 'buffer', 'received', 'payload_length', 'frame_start', 'ip_offset', 'first_seen']
+
+    def __init__(self, key, first_seen):
+        self.key = key
+        self.buffer = bytearray(HEADROOM)
+        self.received = IntervalSet()
+        self.payload_length = None
+        self.frame_start = None
+        self.ip_offset = None
+        self.first_seen = first_seen
+
+    def complete(self):
+        return (self.frame_start is not None and self.payload_length is not None and
+                self.received.covers(0, self.payload_length))
+
+
+class Ipv4Reassembler(object):
+    """
+    Datagrams still incomplete timeout seconds of capture time after their
+    first fragment are dropped, at most max_bytes are buffered for
+    incomplete datagrams, the oldest are dropped first beyond that.
+
+    Overlapping fragments keep the bytes that arrived first.
+    """
+    __slots__ = ['timeout', 'max_bytes', 'buffered', 'fragments', 'datagrams',
+                 'overlaps', 'invalid', 'timeouts', 'evictions', '_pending']
+
+    def __init__(self, timeout=30, max_bytes=4 << 20):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.buffered = 0
+        self.fragments = 0
+        self.datagrams = 0
+        self.overlaps = 0
+        self.invalid = 0
+        self.timeouts = 0
+        self.evictions = 0
+        # insertion ordered, the oldest datagram is always first
+        self._pending = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def reassemble(self, record_hdr, packet, offset=None):
+        """
+        Feed a frame whose IPv4 header, if any, starts at offset, by default
+        right after the ethernet header and its vlan tags. Returns
+        packet itself when it is not a fragment, a memoryview of the
+        reassembled frame when it completes a datagram and None while the
+        datagram is incomplete or when the fragment is dropped.
+        """
+        if offset is None:
+            link = ethernet.ethernet_payload_offset(packet)
+            if link is None:
+                return packet
+            offset = link[1]
+        if (len(packet) - offset < 20 or
+                _ETHERTYPE.unpack_from(packet, offset - 2)[0] != ethernet.ETHERTYPE_IPV4):
+            return packet
+
+        (version_ihl, total_length, identification, flags_offset,
+         protocol, source_ip, destination_ip) = _IPV4_FRAGMENT.unpack_from(packet, offset)
+        if version_ihl >> 4 != 4 or not flags_offset & (_FLAG_MORE_FRAGMENTS | _FRAGMENT_OFFSET_MASK):
+            return packet
+
+        self.fragments += 1
+        now = record_hdr.ts_sec
+        self._expire(now)
+
+        header_length = (version_ihl & 0x0F) * 4
+        payload_start = offset + header_length
+        payload_end = min(len(packet), offset + total_length)
+        fragment_start = (flags_offset & _FRAGMENT_OFFSET_MASK) * 8
+        fragment_end = fragment_start + payload_end - payload_start
+        more_fragments = flags_offset & _FLAG_MORE_FRAGMENTS
+
+        if (payload_end <= payload_start or fragment_end + header_length > _MAX_DATAGRAM_LENGTH or
+                (more_fragments and (payload_end - payload_start) % 8)):
+            self.invalid += 1
+            return
+
+        key = (source_ip, destination_ip, protocol, identification)
+        datagram = self._pending.get(key)
+        if datagram is None:
+            datagram = _Datagram(key, now)
+            self._pending[key] = datagram
+            self.buffered += HEADROOM
+
+        if not more_fragments:
+            if datagram.payload_length is not None and datagram.payload_length != fragment_end:
+                self._drop(datagram)
+                self.invalid += 1
+                return
+            datagram.payload_length = fragment_end
+        if datagram.payload_length is not None and fragment_end > datagram.payload_length:
+            self._drop(datagram)
+            self.invalid += 1
+            return
+
+        buffer = datagram.buffer
+        if len(buffer) < HEADROOM + fragment_end:
+            # grow once to the full length when the last fragment is known
+            grow_to = HEADROOM + max(fragment_end, datagram.payload_length or 0)
+            self.buffered += grow_to - len(buffer)
+            buffer.extend(b'\x00' * (grow_to - len(buffer)))
+
+        view = memoryview(packet)
+        copied = 0
+        for (gap_start, gap_end) in datagram.received.add(fragment_start, fragment_end):
+            source = payload_start + gap_start - fragment_start
+            buffer[HEADROOM + gap_start:HEADROOM + gap_end] = view[source:source + gap_end - gap_start]
+            copied += gap_end - gap_start
+        if copied != fragment_end - fragment_start:
+            self.overlaps += 1
+
+        if fragment_start == 0 and datagram.frame_start is None:
+            if payload_start > HEADROOM:
+                self._drop(datagram)
+                self.invalid += 1
+                return
+            datagram.frame_start = HEADROOM - payload_start
+            datagram.ip_offset = offset
+            buffer[datagram.frame_start:HEADROOM] = view[:payload_start]
+
+        if datagram.complete():
+            return self._complete(datagram)
+
+        if self.buffered > self.max_bytes:
+            self._evict_oldest()
+
+    def _complete(self, datagram):
+        del self._pending[datagram.key]
+        self.buffered -= len(datagram.buffer)
+        self.datagrams += 1
+
+        buffer = datagram.buffer
+        ip_start = datagram.frame_start + datagram.ip_offset
+        header_length = HEADROOM - ip_start
+        frame_end = HEADROOM + datagram.payload_length
+
+        # rewrite the first fragment header to describe the whole datagram
+        _U16.pack_into(buffer, ip_start + 2, header_length + datagram.payload_length)
+        flags_offset = _U16.unpack_from(buffer, ip_start + 6)[0]
+        _U16.pack_into(buffer, ip_start + 6, flags_offset & _FLAG_DONT_FRAGMENT)
+        _U16.pack_into(buffer, ip_start + 10, checksum.ipv4_header_checksum(buffer, ip_start, header_length))
+
+        return memoryview(buffer)[datagram.frame_start:frame_end]
+
+    def _drop(self, datagram):
+        del self._pending[datagram.key]
+        self.buffered -= len(datagram.buffer)
+
+    def _expire(self, now):
+        cutoff = now - self.timeout
+        while self._pending:
+            datagram = next(iter(self._pending.values()))
+            if datagram.first_seen >= cutoff:
+                break
+            self._drop(datagram)
+            self.timeouts += 1
+
+    def _evict_oldest(self):
+        while self.buffered > self.max_bytes and self._pending:
+            datagram = next(iter(self._pending.values()))
+            _module_logger.debug('reassembly buffer full, dropping datagram %r', datagram.key)
+            self._drop(datagram)
+            self.evictions += 1
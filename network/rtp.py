@@ -1,7 +1,23 @@
 import struct
 
+from network import dissect
+from network import lazy
+
 __author__ = 'wmoorefi'
 
+_RTP_HDR = struct.Struct('>BBHII')
+# indexed by csrc count, CC is a 4 bit field
+_CSRC_LISTS = [struct.Struct('>%dI' % count) for count in range(16)]
+_EXTENSION_HDR = struct.Struct('>HH')
+_PADDING_COUNT = struct.Struct('>B')
+_U8 = struct.Struct('>B')
+_U16 = struct.Struct('>H')
+_U32 = struct.Struct('>I')
+
+# second byte of rtcp sender report to application defined packets read as
+# marker bit and payload type
+_RTCP_PAYLOAD_TYPES = range(72, 77)
+
 class RtpHeaderExtension(object):
     """
     RFC3550
@@ -69,13 +85,38 @@ class RtpHeader(object):
 
 def read_rtp_header(input_stream, byte_swap):
     chunk = input_stream.read(12)
-    if chunk == '':
+    if not chunk:
         return
 
-    if byte_swap:
-        raw_unpacked = struct.unpack('<BBHII', chunk)
-    else:
-        raw_unpacked = struct.unpack('>BBHII', chunk)
+    first_byte = bytearray(chunk[:1])[0]
+    csrc_count = first_byte & 0x0F
+    if csrc_count:
+        csrc_chunk = input_stream.read(csrc_count * 4)
+        if len(csrc_chunk) < csrc_count * 4:
+            return
+        chunk += csrc_chunk
+
+    if (first_byte >> 4) & 0x1:
+        extension_chunk = input_stream.read(_EXTENSION_HDR.size)
+        if len(extension_chunk) < _EXTENSION_HDR.size:
+            return
+        (header_id, length) = _EXTENSION_HDR.unpack(extension_chunk)
+        chunk += extension_chunk + input_stream.read(length * 4)
+
+    return unpack_rtp_header(chunk, 0, byte_swap)
+
+
+def unpack_rtp_header(buffer, offset, byte_swap):
+    """
+    Parse rtp header, including the csrc list and header extension, from
+    buffer starting at offset, returns None when the buffer is too short
+
+    Header fields are always in network byte order, byte_swap is unused
+    """
+    if len(buffer) - offset < 12:
+        return
+
+    raw_unpacked = _RTP_HDR.unpack_from(buffer, offset)
 
     version = raw_unpacked[0] >> 6
     padding_flag = (raw_unpacked[0] >> 5) & 0x1
@@ -86,24 +127,144 @@ def read_rtp_header(input_stream, byte_swap):
     sequence_number = raw_unpacked[2]
     timestamp = raw_unpacked[3]
     ssrc = raw_unpacked[4]
-    csrc_list = []
-    extension_headers = []
-
-    # FIXME - there is a pattern here and this code looks ugly
-    for i in range(0, csrc_count):
-        chunk = input_stream.read(4)
-        if chunk == '':
-            return
+    extension_headers = ()
 
-        if byte_swap:
-            raw_unpacked = struct.unpack('<I', chunk)
-        else:
-            raw_unpacked = struct.unpack('>I', chunk)
+    if len(buffer) - offset < 12 + (csrc_count * 4):
+        return
 
-        csrc_list.append(raw_unpacked[0])
+    csrc_list = _CSRC_LISTS[csrc_count].unpack_from(buffer, offset + 12)
 
-    # FIXME - handle hdr extensions
+    if extension_header_present_flag:
+        extension_offset = offset + 12 + (csrc_count * 4)
+        if len(buffer) - extension_offset < _EXTENSION_HDR.size:
+            return
+        (header_id, length) = _EXTENSION_HDR.unpack_from(buffer, extension_offset)
+        data_offset = extension_offset + _EXTENSION_HDR.size
+        if len(buffer) - data_offset < length * 4:
+            return
+        extension_headers = (RtpHeaderExtension(header_id, length,
+                                                bytes(buffer[data_offset:data_offset + length * 4])),)
 
     return RtpHeader(version, padding_flag, marker_bit, payload_type,
                      sequence_number, timestamp, ssrc, csrc_list,
-                     extension_headers)
\ No newline at end of file
+                     extension_headers)
+
+
+def _unpack_csrc_list(buffer, offset):
+    csrc_count = _U8.unpack_from(buffer, offset)[0] & 0x0F
+    return _CSRC_LISTS[csrc_count].unpack_from(buffer, offset + 12)
+
+
+def _unpack_extension_headers(buffer, offset):
+    first_byte = _U8.unpack_from(buffer, offset)[0]
+    if not (first_byte >> 4) & 0x1:
+        return ()
+
+    extension_offset = offset + 12 + ((first_byte & 0x0F) * 4)
+    if len(buffer) - extension_offset < _EXTENSION_HDR.size:
+        return ()
+    (header_id, length) = _EXTENSION_HDR.unpack_from(buffer, extension_offset)
+    data_offset = extension_offset + _EXTENSION_HDR.size
+    if len(buffer) - data_offset < length * 4:
+        return ()
+    return (RtpHeaderExtension(header_id, length, bytes(buffer[data_offset:data_offset + length * 4])),)
+
+
+class RtpHeaderView(RtpHeader):
+    """
+    RtpHeader decoded lazily, each field is unpacked from the packet buffer
+    when it is read. A truncated header extension decodes as no extension
+    headers. Views are read-only and only valid while the buffer is.
+    """
+    __slots__ = ['_buffer', '_offset']
+
+    version = lazy.field(_U8, 0, 6)
+    padding_flag = lazy.field(_U8, 0, 5, 0x1)
+    marker_bit = lazy.field(_U8, 1, 7)
+    payload_type = lazy.field(_U8, 1, 0, 0x7F)
+    sequence_number = lazy.field(_U16, 2)
+    timestamp = lazy.field(_U32, 4)
+    ssrc = lazy.field(_U32, 8)
+    csrc_list = lazy.cached_field(_unpack_csrc_list, RtpHeader.csrc_list)
+    extension_headers = lazy.cached_field(_unpack_extension_headers, RtpHeader.extension_headers)
+
+    def __init__(self, buffer, offset):
+        self._buffer = buffer
+        self._offset = offset
+
+    def unpack(self):
+        """
+        Eager header of the same bytes, for a packet whose other fields are
+        all going to be read
+        """
+        return unpack_rtp_header(self._buffer, self._offset, False)
+
+
+def view_rtp_header(buffer, offset):
+    """
+    Lazily decoding RtpHeaderView of the header at offset, returns None when
+    the buffer is too short for the fixed header and csrc list
+    """
+    if len(buffer) - offset < 12:
+        return
+    if len(buffer) - offset < 12 + ((_U8.unpack_from(buffer, offset)[0] & 0x0F) * 4):
+        return
+
+    return RtpHeaderView(buffer, offset)
+
+
+def rtp_payload(buffer, offset, rtp_hdr, end=None):
+    """
+    Payload of the rtp packet whose header starts at offset, as a
+    memoryview slice without the header and padding, returns None when the
+    padding count is invalid. end defaults to the end of buffer, pass the
+    end of the udp datagram to drop ethernet trailer bytes.
+    """
+    view = memoryview(buffer)
+    start = offset + len(rtp_hdr)
+    if end is None:
+        end = len(view)
+    if rtp_hdr.padding_flag:
+        if end <= start:
+            return
+        end -= _PADDING_COUNT.unpack_from(view, end - 1)[0]
+        if end < start:
+            return
+    return view[start:end]
+
+
+def dissect_rtp(buffer, offset, end):
+    """
+    Dissector of rtp version 2 packets, hands off the payload type, the
+    payload ends before any padding
+    """
+    if end - offset < 12:
+        return
+    rtp_hdr = unpack_rtp_header(buffer, offset, False)
+    if rtp_hdr is None or rtp_hdr.version != 2:
+        return
+    payload_offset = offset + len(rtp_hdr)
+    if payload_offset > end:
+        return
+    if rtp_hdr.padding_flag:
+        if end <= payload_offset:
+            return
+        end -= _PADDING_COUNT.unpack_from(buffer, end - 1)[0]
+        if end < payload_offset:
+            return
+    return rtp_hdr, rtp_hdr.payload_type, payload_offset, end
+
+
+def is_rtp(buffer, offset, end, port):
+    """
+    Heuristic for udp payloads on ports without a dissector, version 2 and
+    a payload type rtcp does not use
+    """
+    if end - offset < 12:
+        return False
+    (first_byte, second_byte) = _RTP_HDR.unpack_from(buffer, offset)[:2]
+    return first_byte >> 6 == 2 and (second_byte & 0x7F) not in _RTCP_PAYLOAD_TYPES
+
+
+def register(registry):
+    registry.register_heuristic(dissect.UDP_PORT, 'rtp', is_rtp, dissect_rtp, dissect.RTP_PAYLOAD_TYPE)
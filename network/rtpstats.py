@@ -0,0 +1,265 @@
+"""
+Per-SSRC RTP stream statistics
+
+Packet loss, duplicates, reordering, sequence wraparound and the RFC 3550
+interarrival jitter, computed incrementally in one pass over the rtp
+headers with a fixed amount of state per stream.
+
+tracker = RtpStreamTracker()
+for record_hdr, packet in capture.records():
+    ...
+    tracker.update(rtp_hdr, pcap.record_timestamp(pcap_hdr, record_hdr))
+for ssrc, stats in tracker.streams.items():
+    print(hex(ssrc), stats.received, stats.lost, stats.jitter)
+
+bulk_stream_stats() computes the same statistics from arrays of sequence
+numbers, rtp timestamps and arrival times with NumPy.
+"""
+
+__author__ = 'wmoorefi'
+
+RTP_SEQ_MOD = 1 << 16
+MAX_DROPOUT = 3000
+MAX_MISORDER = 100
+# number of recent sequence numbers remembered to tell duplicates from
+# reordered packets
+DUPLICATE_WINDOW = 1024
+
+DEFAULT_CLOCK_RATE = 90000  # video
+
+_WINDOW_MASK = (1 << DUPLICATE_WINDOW) - 1
+
+
+def _timestamp_delta(timestamp, previous_timestamp):
+    """
+    Signed difference of two 32 bit rtp timestamps
+    """
+    delta = (timestamp - previous_timestamp) & 0xFFFFFFFF
+    if delta >= 0x80000000:
+        delta -= 0x100000000
+    return delta
+
+
+class RtpStreamStats(object):
+    """
+    Statistics of a single SSRC, RFC 3550 A.1 sequence number validation
+    and A.8 jitter.
+
+    jitter is in rtp timestamp units, divide by clock_rate for seconds.
+    A duplicate older than DUPLICATE_WINDOW packets is counted as
+    reordered. A jump larger than MAX_DROPOUT is confirmed by the next
+    packet and then restarts the sequence, counted in resyncs.
+    """
+    __slots__ = ['ssrc', 'clock_rate', 'base_seq', 'max_seq', 'cycles', 'received',
+                 'duplicates', 'reordered', 'resyncs', 'jitter', 'first_arrival',
+                 'last_arrival', '_last_timestamp', '_bad_seq', '_seen', '_prior_expected']
+
+    def __init__(self, ssrc, clock_rate=DEFAULT_CLOCK_RATE):
+        self.ssrc = ssrc
+        self.clock_rate = clock_rate
+        self.base_seq = 0
+        self.max_seq = 0
+        self.cycles = 0
+        self.received = 0
+        self.duplicates = 0
+        self.reordered = 0
+        self.resyncs = 0
+        self.jitter = 0.0
+        self.first_arrival = None
+        self.last_arrival = None
+        self._last_timestamp = 0
+        self._bad_seq = RTP_SEQ_MOD + 1
+        self._seen = 0
+        self._prior_expected = 0
+
+    @property
+    def extended_max_seq(self):
+        return self.cycles + self.max_seq
+
+    @property
+    def wraparounds(self):
+        return self.cycles >> 16
+
+    @property
+    def expected(self):
+        if not self.received:
+            return 0
+        return self._prior_expected + self.extended_max_seq - self.base_seq + 1
+
+    @property
+    def lost(self):
+        """
+        Cumulative number of packets lost, negative when duplicates
+        outnumber the losses (RFC 3550 6.4.1)
+        """
+        return self.expected - self.received
+
+    def _restart(self, sequence_number):
+        self.base_seq = sequence_number
+        self.max_seq = sequence_number
+        self.cycles = 0
+        self._bad_seq = RTP_SEQ_MOD + 1
+        self._seen = 1
+
+    def update(self, sequence_number, timestamp, arrival_time):
+        """
+        Account one packet, arrival_time in seconds
+        """
+        if self.received:
+            udelta = (sequence_number - self.max_seq) & 0xFFFF
+            if udelta == 0:
+                self.duplicates += 1
+            elif udelta < MAX_DROPOUT:
+                # in order, with permissible gap
+                if sequence_number < self.max_seq:
+                    self.cycles += RTP_SEQ_MOD
+                self.max_seq = sequence_number
+                self._seen = ((self._seen << udelta) | 1) & _WINDOW_MASK
+            elif udelta <= RTP_SEQ_MOD - MAX_MISORDER:
+                # very large jump, restart once the next packet confirms it
+                if sequence_number != self._bad_seq:
+                    self._bad_seq = (sequence_number + 1) & 0xFFFF
+                    return
+                # the probation packet was not counted in received either
+                self._prior_expected = self.expected
+                self.resyncs += 1
+                self._restart(sequence_number)
+            else:
+                # duplicate or reordered packet from before max_seq
+                back = RTP_SEQ_MOD - udelta
+                if back < DUPLICATE_WINDOW and (self._seen >> back) & 1:
+                    self.duplicates += 1
+                else:
+                    self.reordered += 1
+                    if back < DUPLICATE_WINDOW:
+                        self._seen |= 1 << back
+
+            transit_delta = ((arrival_time - self.last_arrival) * self.clock_rate -
+                             _timestamp_delta(timestamp, self._last_timestamp))
+            self.jitter += (abs(transit_delta) - self.jitter) / 16.0
+        else:
+            self._restart(sequence_number)
+            self.first_arrival = arrival_time
+
+        self.received += 1
+        self.last_arrival = arrival_time
+        self._last_timestamp = timestamp
+
+
+class RtpStreamTracker(object):
+    """
+    RtpStreamStats for every SSRC seen, clock_rates maps payload types to
+    their rtp clock rate, other payload types use clock_rate
+    """
+    __slots__ = ['streams', 'clock_rate', 'clock_rates']
+
+    def __init__(self, clock_rate=DEFAULT_CLOCK_RATE, clock_rates=None):
+        self.streams = {}
+        self.clock_rate = clock_rate
+        self.clock_rates = clock_rates or {}
+
+    def __len__(self):
+        return len(self.streams)
+
+    def stream(self, ssrc, payload_type=None):
+        stats = self.streams.get(ssrc)
+        if stats is None:
+            stats = RtpStreamStats(ssrc, self.clock_rates.get(payload_type, self.clock_rate))
+            self.streams[ssrc] = stats
+        return stats
+
+    def update(self, rtp_hdr, arrival_time):
+        """
+        Account one decoded RtpHeader, arrival_time in seconds
+        """
+        self.stream(rtp_hdr.ssrc, rtp_hdr.payload_type).update(rtp_hdr.sequence_number,
+                                                                rtp_hdr.timestamp,
+                                                                arrival_time)
+
+
+def _jitter(transit_deltas, block_size=512):
+    """
+    J(i) = J(i-1) + (|D(i)| - J(i-1)) / 16 for all i, evaluated in closed
+    form per block so the powers of 16/15 stay in float range
+    """
+    import numpy as np
+
+    decay = 15.0 / 16.0
+    jitter = np.empty(len(transit_deltas))
+    previous = 0.0
+    for start in range(0, len(transit_deltas), block_size):
+        block = np.abs(transit_deltas[start:start + block_size])
+        powers = decay ** np.arange(1, len(block) + 1)
+        jitter[start:start + len(block)] = powers * (previous + np.cumsum(block / powers) / 16.0)
+        previous = jitter[start + len(block) - 1]
+    return jitter
+
+
+def _bulk_single_stream(ssrc, sequence_numbers, timestamps, arrival_times, clock_rate):
+    import numpy as np
+
+    stats = RtpStreamStats(ssrc, clock_rate)
+    count = len(sequence_numbers)
+    if not count:
+        return stats
+
+    # unwrap to extended sequence numbers, every step taken as the nearest
+    # signed 16 bit distance
+    steps = ((np.diff(sequence_numbers) + 0x8000) & 0xFFFF) - 0x8000
+    extended = sequence_numbers[0] + np.concatenate(([0], np.cumsum(steps)))
+
+    running_max = np.maximum.accumulate(extended)
+    first_seen = np.zeros(count, dtype=bool)
+    first_seen[np.unique(extended, return_index=True)[1]] = True
+
+    stats.base_seq = int(sequence_numbers[0])
+    stats.cycles = int(running_max[-1] - (running_max[-1] & 0xFFFF))
+    stats.max_seq = int(running_max[-1] & 0xFFFF)
+    stats.received = count
+    stats.duplicates = int(count - first_seen.sum())
+    stats.reordered = int((first_seen[1:] & (extended[1:] < running_max[:-1])).sum())
+
+    if count > 1:
+        timestamp_steps = ((np.diff(timestamps) + 0x80000000) & 0xFFFFFFFF) - 0x80000000
+        transit_deltas = np.diff(arrival_times) * clock_rate - timestamp_steps
+        stats.jitter = float(_jitter(transit_deltas)[-1])
+
+    stats.first_arrival = float(arrival_times[0])
+    stats.last_arrival = float(arrival_times[-1])
+    stats._last_timestamp = int(timestamps[-1])
+
+    # leave the duplicate window as update() would so streaming can resume
+    maximum = int(running_max[-1])
+    for value in np.unique(extended[extended > maximum - DUPLICATE_WINDOW]):
+        stats._seen |= 1 << (maximum - int(value))
+
+    return stats
+
+
+def bulk_stream_stats(sequence_numbers, timestamps, arrival_times, ssrcs=None,
+                      clock_rate=DEFAULT_CLOCK_RATE):
+    """
+    Vectorized statistics over arrays in arrival order, for instance the
+    rtp columns of capture.columns. Returns {ssrc: RtpStreamStats}, with
+    ssrcs None all values are taken as one stream keyed 0.
+
+    Sequence numbers are unwrapped by the nearest signed distance between
+    consecutive packets, large jumps are not resynchronized as update()
+    does.
+    """
+    import numpy as np
+
+    sequence_numbers = np.asarray(sequence_numbers, dtype=np.int64)
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    arrival_times = np.asarray(arrival_times, dtype=np.float64)
+
+    if ssrcs is None:
+        return {0: _bulk_single_stream(0, sequence_numbers, timestamps, arrival_times, clock_rate)}
+
+    ssrcs = np.asarray(ssrcs)
+    streams = {}
+    for ssrc in np.unique(ssrcs):
+        selected = ssrcs == ssrc
+        streams[int(ssrc)] = _bulk_single_stream(int(ssrc), sequence_numbers[selected], timestamps[selected],
+                                                 arrival_times[selected], clock_rate)
+    return streams
@@ -1,7 +1,12 @@
 import struct
 
+from network import dissect
+from network import ipv4
+
 __author__ = 'wmoorefi'
 
+_UDP_HDR = struct.Struct('>HHHH')
+
 
 class UdpHeader(object):
     """
@@ -28,13 +33,23 @@ class UdpHeader(object):
 
 def read_udp_header(input_stream, byte_swap):
     chunk = input_stream.read(8)
-    if chunk == '':
+    if not chunk:
+        return
+
+    return unpack_udp_header(chunk, 0, byte_swap)
+
+
+def unpack_udp_header(buffer, offset, byte_swap):
+    """
+    Parse udp header from buffer starting at offset, returns None when
+    the buffer is too short
+
+    Header fields are always in network byte order, byte_swap is unused
+    """
+    if len(buffer) - offset < 8:
         return
 
-    if byte_swap:
-        raw_unpacked = struct.unpack('<HHHH', chunk)
-    else:
-        raw_unpacked = struct.unpack('>HHHH', chunk)
+    raw_unpacked = _UDP_HDR.unpack_from(buffer, offset)
 
     source_port = raw_unpacked[0]
     destination_port = raw_unpacked[1]
@@ -45,3 +60,19 @@ def read_udp_header(input_stream, byte_swap):
     # FIXME store flags as namedtuple
 
     return UdpHeader(source_port, destination_port, length, checksum)
+
+
+def dissect_udp(buffer, offset, end):
+    """
+    Dissector of udp datagrams, hands off the destination then the source
+    port, the payload ends with the udp length
+    """
+    if end - offset < 8:
+        return
+    udp_hdr = unpack_udp_header(buffer, offset, False)
+    return (udp_hdr, (udp_hdr.destination_port, udp_hdr.source_port),
+            offset + 8, min(end, offset + max(8, udp_hdr.length)))
+
+
+def register(registry):
+    registry.register(dissect.IP_PROTOCOL, ipv4.PROTOCOL_UDP, 'udp', dissect_udp, dissect.UDP_PORT)
@@ -9,12 +9,20 @@ Global Header
     ... repeat
 """
 
+from __future__ import print_function
+
+import json
 import logging
+from capture import instrument
+from network import dissect
 from network import ethernet
-from network import pcap
 from network import ipv4
-from network import udp
+from network import pcap
+from network import pcapng
+from network import reassembly
 from network import rtp
+from network import udp
+from h264 import depacketizer
 from h264 import nalu
 
 __author__ = 'Wayne Moorefield'
@@ -32,13 +40,24 @@ def get_logger():
 
 def load(input_file):
     """
-    Loads a pcap file
+    Loads a pcap or pcapng file
     """
+    start = input_file.tell()
+    raw_magic = input_file.read(4)
+    input_file.seek(start)
+
+    if pcapng.is_pcapng(raw_magic):
+        return pcapng.read_pcapng_header(input_file)
     header = pcap.read_pcap_header(input_file)
     return header
 
 
 def record_reader(pcap_hdr, input_file):
+    if pcap_hdr.magic_number == pcapng.BLOCKTYPE_SECTION_HEADER:
+        for record in pcapng.read_pcapng_records(pcap_hdr, input_file):
+            yield record
+        return
+
     while True:
         try:
             record = pcap.read_pcap_record(pcap_hdr, input_file)
@@ -47,7 +66,22 @@ def record_reader(pcap_hdr, input_file):
             else:
                 break
         except UnicodeDecodeError:
-            pass  # ignore, file done
+            _module_logger.error('Unable to read pcap record, open the file in binary mode')
+            raise
+
+
+def load_mapped(input_file):
+    """
+    Memory-maps a pcap or pcapng file, iterate records with .records(), each
+    record is yielded with a zero-copy memoryview of the packet data
+    """
+    start = input_file.tell()
+    raw_magic = input_file.read(4)
+    input_file.seek(start)
+
+    if pcapng.is_pcapng(raw_magic):
+        return pcapng.MappedPcapngFile(input_file)
+    return pcap.MappedPcapFile(input_file)
 
 
 def payload_reader(input_stream, remaining_bytes):
@@ -65,70 +99,103 @@ _module_logger.setLevel(logging.DEBUG)
 _module_logger.addHandler(ch)
 # End Temporary Code
 
+
+def print_ethernet_header(eth_hdr):
+    print('dst:', ' '.join([hex(i) for i in eth_hdr.destination_mac]))
+    print('src:', ' '.join([hex(i) for i in eth_hdr.source_mac]))
+    print('type:', hex(eth_hdr.ethertype))
+    for tag in eth_hdr.ext:
+        print('vlan:', tag.vid, 'pcp:', tag.pcp, 'type:', hex(tag.ethertype))
+
+
+def print_ipv4_header(ipv4_hdr):
+    print('version: ', hex(ipv4_hdr.version))
+    print('hdr len: ', ipv4_hdr.internet_hdr_length)
+    print('dscp: ', ipv4_hdr.dscp)
+    print('total len: ', ipv4_hdr.total_length, ' bytes')
+    print('identification: ', hex(ipv4_hdr.identification))
+    print('flags: ', hex(ipv4_hdr.flags))
+    print('fragment_offset: ', ipv4_hdr.fragment_offset)
+    print('time_to_live: ', ipv4_hdr.time_to_live)
+    print('protocol: ', ipv4_hdr.protocol)
+    print('checksum: ', hex(ipv4_hdr.header_checksum))
+    print('src:', '.'.join([str(i) for i in ipv4_hdr.source_ip]))
+    print('dst:', '.'.join([str(i) for i in ipv4_hdr.destination_ip]))
+
+
+def print_udp_header(udp_hdr):
+    print('src_port: ', udp_hdr.source_port)
+    print('dst_port: ', udp_hdr.destination_port)
+    print('length: ', udp_hdr.length)
+    print('checksum: ', hex(udp_hdr.checksum))
+
+
+def print_rtp_header(rtp_hdr):
+    print('version: ', rtp_hdr.version)
+    print('payload_type: ', rtp_hdr.payload_type)
+    print('seq number: ', rtp_hdr.sequence_number)
+    print('timestamp: ', rtp_hdr.timestamp)
+    print('ssrc: ', hex(rtp_hdr.ssrc))
+
+
+def print_nalu_header(nalu_header):
+    print('nal_ref_idc:', nalu_header.nal_ref_idc)
+    print('nal_unit_type:', nalu_header.nal_unit_type)
+
+
+_LAYER_PRINTERS = {
+    'ethernet': print_ethernet_header,
+    'ipv4': print_ipv4_header,
+    'udp': print_udp_header,
+    'rtp': print_rtp_header,
+    'h264': print_nalu_header,
+}
+
 if __name__ == '__main__':
-    with open('test.pcap', 'rb') as fp:
-        pcap_hdr = load(fp)
-        for record_hdr in record_reader(pcap_hdr, fp):
-            remaining_bytes = record_hdr.incl_len
-
-            eth_hdr = ethernet.read_ethernet_header(fp, pcap_hdr.byte_swap)
-            print 'ethernet header ****************'
-            print 'dst:', ' '.join([hex(i) for i in eth_hdr.destination_mac])
-            print 'src:', ' '.join([hex(i) for i in eth_hdr.source_mac])
-            print 'type:', hex(eth_hdr.ethertype)
-
-            remaining_bytes -= len(eth_hdr)
-
-            if eth_hdr.ethertype == ethernet.ETHERTYPE_IPV4:
-                ipv4_hdr = ipv4.read_ipv4_header(fp, pcap_hdr.byte_swap)
-                print 'ipv4 header ****************'
-                print 'version: ', hex(ipv4_hdr.version)
-                print 'hdr len: ', ipv4_hdr.internet_hdr_length
-                print 'dscp: ', ipv4_hdr.dscp
-                print 'total len: ', ipv4_hdr.total_length, ' bytes'
-                print 'identification: ', hex(ipv4_hdr.identification)
-                print 'flags: ', hex(ipv4_hdr.flags)
-                print 'fragment_offset: ', ipv4_hdr.fragment_offset
-                print 'time_to_live: ', ipv4_hdr.time_to_live
-                print 'protocol: ', ipv4_hdr.protocol
-                print 'checksum: ', hex(ipv4_hdr.header_checksum)
-                print 'src:', '.'.join([str(i) for i in ipv4_hdr.source_ip])
-                print 'dst:', '.'.join([str(i) for i in ipv4_hdr.destination_ip])
-
-                remaining_bytes -= len(ipv4_hdr)
-
-                if ipv4_hdr.protocol == ipv4.PROTOCOL_UDP:
-                    udp_hdr = udp.read_udp_header(fp, pcap_hdr.byte_swap)
-                    print 'udp header ****************'
-                    print 'src_port: ', udp_hdr.source_port
-                    print 'dst_port: ', udp_hdr.destination_port
-                    print 'length: ', udp_hdr.length
-                    print 'checksum: ', hex(udp_hdr.checksum)
-
-                    remaining_bytes -= len(udp_hdr)
-
-                    # FIXME for now assume RTP as the UDP payload
-                    rtp_hdr = rtp.read_rtp_header(fp, pcap_hdr.byte_swap)
-                    print 'rtp header ****************'
-                    print 'version: ', rtp_hdr.version
-                    print 'payload_type: ', rtp_hdr.payload_type
-                    print 'seq number: ', rtp_hdr.sequence_number
-                    print 'timestamp: ', rtp_hdr.timestamp
-                    print 'ssrc: ', hex(rtp_hdr.ssrc)
-
-                    remaining_bytes -= len(rtp_hdr)
-
-                    if udp_hdr.destination_port == 20010:
-                        # H264 NAL
-                        nalu_header = nalu.read_nalu_header(fp, pcap_hdr.byte_swap)
-                        print 'nalu header ****************'
-                        print 'nal_ref_idc:', nalu_header.nal_ref_idc
-                        print 'nal_unit_type:', nalu_header.nal_unit_type
-                        break
-
-                    if udp_hdr.destination_port == 20008:
-                        # Audio
-                        pass
-
-            payload_reader(fp, remaining_bytes)
-            #break
+    if '--stats' in sys.argv[1:]:
+        instrument.enable(interval=10)
+
+    with open('test.pcap', 'rb') as fp, load_mapped(fp) as capture, open('test.h264', 'wb') as h264_fp:
+        pcap_hdr = capture.header
+        annexb_writer = depacketizer.AnnexBWriter(h264_fp)
+
+        reassembler = reassembly.Ipv4Reassembler()
+        depacketizers = {}  # per ssrc of the H264 port
+
+        # only the ports decoded below get an rtp dissector, other udp
+        # packets stop at the udp layer
+        registry = dissect.DissectorRegistry()
+        for module in (ethernet, ipv4, udp, nalu):
+            module.register(registry)
+        registry.register(dissect.UDP_PORT, 20010, 'rtp', rtp.dissect_rtp, dissect.RTP_PAYLOAD_TYPE)  # H264
+        registry.register(dissect.UDP_PORT, 20008, 'rtp', rtp.dissect_rtp)  # Audio
+
+        for record_hdr, packet in capture.records():
+            packet = reassembler.reassemble(record_hdr, packet)
+            if packet is None:
+                continue  # fragment of an incomplete datagram
+
+            layers = registry.dissect(packet, pcap_hdr.network)
+            if len(layers) < 4 or layers[3].name != 'rtp':
+                continue  # not a flow we decode
+
+            for layer in layers:
+                print(layer.name, 'header ****************')
+                _LAYER_PRINTERS[layer.name](layer.header)
+
+            # the depacketizer is fed from the rtp layer already decoded
+            udp_hdr = layers[2].header
+            if 20010 in (udp_hdr.destination_port, udp_hdr.source_port):
+                rtp_layer = layers[3]
+                rtp_hdr = rtp_layer.header
+                h264_decoder = depacketizers.get(rtp_hdr.ssrc)
+                if h264_decoder is None:
+                    h264_decoder = depacketizers[rtp_hdr.ssrc] = depacketizer.Depacketizer(annexb_writer.write)
+                h264_decoder.push(rtp_hdr, rtp.rtp_payload(packet, rtp_layer.offset, rtp_hdr, rtp_layer.end))
+
+        for h264_decoder in depacketizers.values():
+            h264_decoder.flush()
+        print('wrote', annexb_writer.access_units, 'access units to test.h264')
+
+    if instrument.enabled():
+        print(json.dumps(instrument.disable().snapshot(), indent=2))
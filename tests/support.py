@@ -0,0 +1,26 @@
+"""
+Captures for the tests, built in memory with benchmarks.synthetic
+"""
+
+import io
+
+from benchmarks import synthetic
+
+__author__ = 'wmoorefi'
+
+
+def synthetic_capture(**kwargs):
+    """
+    Bytes of a synthetic pcap capture, kwargs are SyntheticConfig fields
+    """
+    output_file = io.BytesIO()
+    synthetic.write_capture(output_file, synthetic.SyntheticConfig(**kwargs))
+    return output_file.getvalue()
+
+
+def fragmented_capture(packets=1600, flows=3):
+    """
+    Capture whose every rtp datagram is sent as IPv4 fragments, 1000 byte
+    frames over a 300 byte MTU
+    """
+    return synthetic_capture(packets=packets, flows=flows, frame_size=1000, ip_mtu=300)
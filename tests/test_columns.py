@@ -0,0 +1,37 @@
+import struct
+import unittest
+
+import numpy as np
+
+from capture import columns
+from network import pcap
+from tests import support
+
+__author__ = 'wmoorefi'
+
+
+class DecodeColumnsTest(unittest.TestCase):
+
+    def test_later_fragments_have_no_transport_fields(self):
+        decoded = columns.decode_columns(support.fragmented_capture())
+        later = decoded.ipv4['fragment_offset'] != 0
+        self.assertTrue(later.any())
+        self.assertFalse((decoded.has_udp & later).any())
+        self.assertFalse((decoded.has_rtp & later).any())
+        self.assertFalse((decoded.has_nalu & later).any())
+        self.assertEqual(sorted(set(decoded.rtp['ssrc'][decoded.has_rtp])), [0x10000, 0x10001, 0x10002])
+
+    def test_ethernet_trailer_is_not_payload(self):
+        capture = bytearray(support.synthetic_capture(packets=1, frame_size=1))
+        # shorten the datagram by its one byte nal unit, which is left in
+        # the frame as an ethernet trailer
+        ip_offset = pcap.PCAP_HDR_LENGTH + pcap.PCAPREC_HDR_LENGTH + 14
+        (total_length,) = struct.unpack_from('>H', capture, ip_offset + 2)
+        struct.pack_into('>H', capture, ip_offset + 2, total_length - 1)
+
+        decoded = columns.decode_columns(bytes(capture))
+        np.testing.assert_array_equal(decoded.has_rtp, [True])
+        np.testing.assert_array_equal(decoded.has_nalu, [False])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+import unittest
+
+from network import filter as capture_filter
+from network import pcap
+from tests import support
+
+__author__ = 'wmoorefi'
+
+
+def _matching(capture, expression):
+    pcap_hdr = pcap.unpack_pcap_header(capture[:pcap.PCAP_HDR_LENGTH])
+    compiled = capture_filter.compile_filter(expression)
+    return len(list(capture_filter.filter_records(pcap_hdr, capture, compiled)))
+
+
+class CaptureFilterTest(unittest.TestCase):
+
+    def test_later_fragments_have_no_udp_layer(self):
+        capture = support.fragmented_capture(flows=1)
+        total = _matching(capture, 'ipv4')
+        first = _matching(capture, 'ipv4.fragment_offset == 0')
+        self.assertTrue(0 < first < total)
+        self.assertEqual(_matching(capture, 'udp'), first)
+        self.assertEqual(_matching(capture, 'rtp'), first)
+        self.assertEqual(_matching(capture, 'ipv4.source_ip == 10.0.0.1 and not rtp'), total - first)
+        self.assertEqual(_matching(capture, 'udp.destination_port == 20000'), first)
+
+
+if __name__ == '__main__':
+    unittest.main()
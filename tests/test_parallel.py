@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from capture import parallel
+from network import ipv4
+from network import pcap
+from tests import support
+
+__author__ = 'wmoorefi'
+
+
+def _summary(result):
+    (record_hdr, layers) = result
+    return record_hdr.ts_sec, record_hdr.ts_usec, record_hdr.incl_len, [type(layer).__name__ for layer in layers]
+
+
+class ParallelDecodeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'fragmented.pcap')
+        self.capture = support.fragmented_capture(packets=400)
+        with open(self.path, 'wb') as output_file:
+            output_file.write(self.capture)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _serial(self):
+        pcap_hdr = pcap.unpack_pcap_header(self.capture)
+        return [_summary(parallel.decode_packet(pcap_hdr, record_hdr, packet))
+                for record_hdr, packet in pcap.iter_pcap_records(pcap_hdr, self.capture)]
+
+    def test_later_fragments_stop_at_ipv4(self):
+        pcap_hdr = pcap.unpack_pcap_header(self.capture)
+        for record_hdr, packet in pcap.iter_pcap_records(pcap_hdr, self.capture):
+            layers = parallel.decode_packet(pcap_hdr, record_hdr, packet)[1]
+            if isinstance(layers[-1], ipv4.Ipv4Header):
+                self.assertTrue(layers[-1].fragment_offset)
+            else:
+                self.assertEqual(len(layers), 5)
+
+    def test_ranges_resync_to_records(self):
+        serial = self._serial()
+        for chunk_bytes in (61, 333, 4096, len(self.capture)):
+            decoded = [_summary(result) for result in parallel.parallel_decode(self.path, workers=1,
+                                                                               chunk_bytes=chunk_bytes)]
+            self.assertEqual(decoded, serial, chunk_bytes)
+
+    def test_truncated_capture(self):
+        with open(self.path, 'wb') as output_file:
+            output_file.write(self.capture[:-100])
+        serial = self._serial()[:-1]
+        decoded = [_summary(result) for result in parallel.parallel_decode(self.path, workers=1, chunk_bytes=500)]
+        self.assertEqual(decoded, serial)
+
+
+if __name__ == '__main__':
+    unittest.main()
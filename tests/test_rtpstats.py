@@ -0,0 +1,38 @@
+import unittest
+
+from network import rtpstats
+
+__author__ = 'wmoorefi'
+
+
+def _stats(sequence_numbers):
+    stats = rtpstats.RtpStreamStats(0x1234)
+    for index, sequence_number in enumerate(sequence_numbers):
+        stats.update(sequence_number, index * 3000, index / 30.0)
+    return stats
+
+
+class RtpStreamStatsTest(unittest.TestCase):
+
+    def test_in_order(self):
+        stats = _stats(range(10))
+        self.assertEqual((stats.received, stats.expected, stats.lost), (10, 10, 0))
+
+    def test_gap_is_lost(self):
+        stats = _stats([0, 1, 2, 5, 6])
+        self.assertEqual((stats.received, stats.expected, stats.lost), (5, 7, 2))
+
+    def test_resync_loses_nothing(self):
+        # the jump to 20000 is confirmed by 20001, the probation packet
+        # itself is neither received nor expected
+        stats = _stats(list(range(10)) + [20000, 20001, 20002])
+        self.assertEqual(stats.resyncs, 1)
+        self.assertEqual((stats.received, stats.expected, stats.lost), (12, 12, 0))
+
+    def test_resync_then_gap(self):
+        stats = _stats(list(range(10)) + [20000, 20001, 20002, 20005])
+        self.assertEqual((stats.received, stats.expected, stats.lost), (13, 15, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
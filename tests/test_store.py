@@ -0,0 +1,55 @@
+import struct
+import unittest
+
+import numpy as np
+
+from capture import columns
+from capture import store
+from network import pcap
+from tests import support
+
+__author__ = 'wmoorefi'
+
+
+def _rows_of_packets(capture):
+    packet_store = store.PacketStore()
+    offset = pcap.PCAP_HDR_LENGTH
+    for record_hdr, packet in pcap.iter_pcap_records(pcap.unpack_pcap_header(capture), capture):
+        packet_store.append_packet(record_hdr, packet, offset)
+        offset += pcap.PCAPREC_HDR_LENGTH + record_hdr.incl_len
+    return packet_store.rows()
+
+
+def _rows_of_columns(capture):
+    packet_store = store.PacketStore()
+    packet_store.extend_columns(columns.decode_columns(capture))
+    return packet_store.rows()
+
+
+class PacketStoreTest(unittest.TestCase):
+
+    def assert_same_rows(self, capture):
+        rows = _rows_of_packets(capture)
+        self.assertTrue(rows['has_rtp'].any())
+        np.testing.assert_array_equal(rows, _rows_of_columns(capture))
+
+    def test_append_packet_matches_extend_columns(self):
+        self.assert_same_rows(support.synthetic_capture(packets=500, flows=2, vlan_tags=2))
+
+    def test_append_packet_matches_extend_columns_on_fragments(self):
+        self.assert_same_rows(support.fragmented_capture())
+
+    def test_truncated_csrc_list_is_not_rtp(self):
+        capture = bytearray(support.synthetic_capture(packets=2, frame_size=1))
+        # one csrc in the first packet, its four bytes do not fit in the
+        # one byte nal unit that follows the fixed header
+        rtp_offset = pcap.PCAP_HDR_LENGTH + pcap.PCAPREC_HDR_LENGTH + 14 + 20 + 8
+        struct.pack_into('>B', capture, rtp_offset, 0x81)
+        capture = bytes(capture)
+
+        rows = _rows_of_packets(capture)
+        np.testing.assert_array_equal(rows['has_rtp'], [0, 1])
+        np.testing.assert_array_equal(rows, _rows_of_columns(capture))
+
+if __name__ == '__main__':
+    unittest.main()